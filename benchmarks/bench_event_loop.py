@@ -0,0 +1,93 @@
+"""
+Бенчмарк: отвечает ли бот другим пользователям, пока идет большая загрузка.
+
+Сценарии:
+  blocking — синхронный вызов upload прямо из async-кода (как раньше вызывался y.upload);
+  storage  — тот же вызов через YandexStorage (синхронный клиент в пуле потоков).
+
+Загрузка эмулируется клиентом, который «держит» поток заданное время.
+Пока она идет, N пользователей присылают сообщения; измеряется задержка ответа.
+
+Запуск:
+    python benchmarks/bench_event_loop.py --users 50 --upload-seconds 2
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import YandexStorage  # noqa: E402
+
+
+class SlowUploadClient:
+    """Синхронный клиент, у которого upload занимает upload_seconds."""
+
+    def __init__(self, upload_seconds: float):
+        self.upload_seconds = upload_seconds
+
+    def upload(self, src, dst_path, **kwargs):
+        time.sleep(self.upload_seconds)
+
+
+async def user_request(arrival: float, latencies: list) -> None:
+    # Пользователь пишет в момент arrival; задержка считается от него до ответа
+    await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+    await asyncio.sleep(0)  # имитация легкого обработчика
+    latencies.append(time.perf_counter() - arrival)
+
+
+async def run_scenario(name: str, users: int, upload_seconds: float) -> list:
+    client = SlowUploadClient(upload_seconds)
+    storage = YandexStorage("", sync_client=client)
+    latencies = []
+
+    async def big_upload():
+        if name == "blocking":
+            client.upload("/tmp/video.mp4", "/video.mp4")
+        else:
+            await storage.upload("/tmp/video.mp4", "/video.mp4")
+
+    # Пользователи приходят равномерно в первой половине загрузки
+    started = time.perf_counter() + 0.05
+    interval = upload_seconds / (users * 2)
+    tasks = [
+        asyncio.create_task(user_request(started + i * interval, latencies))
+        for i in range(users)
+    ]
+    await asyncio.sleep(0.05)
+    upload_task = asyncio.create_task(big_upload())
+    await asyncio.gather(upload_task, *tasks)
+    await storage.close()
+    return latencies
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--upload-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"Пользователей: {args.users}, длительность загрузки: {args.upload_seconds}s")
+    print(f"{'сценарий':<10} {'p50, ms':>10} {'p95, ms':>10} {'max, ms':>10} {'среднее, ms':>12}")
+    for name in ("blocking", "storage"):
+        latencies = asyncio.run(run_scenario(name, args.users, args.upload_seconds))
+        ms = [v * 1000 for v in latencies]
+        print(
+            f"{name:<10} {percentile(ms, 50):>10.1f} {percentile(ms, 95):>10.1f} "
+            f"{max(ms):>10.1f} {statistics.mean(ms):>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+"""
+Нагрузочный прогон: реалистичный поток обновлений через приложение из build_application().
+
+Источники нагрузки:
+  synthetic — пользователи вводят накладные, присылают фото, альбомы, видео и документы,
+              открывают /menu и нажимают кнопки меню, сбрасывают накладную и начинают новую;
+  replay    — поток восстанавливается из лога бота по строкам «📝 Получено сообщение»,
+              «📥 Файл поставлен в очередь» и «✅ Файл загружен» с исходными интервалами
+              (--speed ускоряет). Команды в лог не пишутся, поэтому перед новой накладной
+              пользователя добавляется /reset. Окно сбора альбома (ALBUM_WINDOW) не ускоряется:
+              при большом --speed альбом может разбираться уже после следующей накладной.
+
+Bot API и Яндекс.Диск отвечают из fake_servers.py. События одного пользователя идут по порядку,
+разные пользователи — параллельно, каждое в свое время по расписанию.
+
+Отчет:
+  updates/s           — обработанные обновления за время прогона;
+  задержка по командам — p50/p95/p99 обработки обновления (invoice, /menu, menu_current, photo, album...);
+  задержка цикла       — насколько опаздывает таймер в цикле событий (блокирующий код);
+  отставание           — насколько обновления начинались позже расписания (бот не успевает);
+  загрузка             — от обновления до файла на «диске».
+
+--save-baseline сохраняет итог как базовый; --baseline сравнивает с ним и завершается с кодом 1,
+если пропускная способность упала или задержки выросли больше допустимого.
+
+Запуск:
+    python benchmarks/bench_load.py --users 20 --duration 30 --save-baseline
+    python benchmarks/bench_load.py --users 20 --duration 30 --baseline
+    python benchmarks/bench_load.py --replay bot.log --speed 10
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import (  # noqa: E402
+    ROOT, TOKEN, UpdateFactory, configure_environment, git_commit, percentile, start_bot, stop_bot
+)
+from fake_servers import FakeServers  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "results", "load_baseline.json")
+EXTENSIONS = {"photo": ".jpg", "video": ".mp4", "document": ".pdf"}
+FIRST_USER_ID = 800000
+LAG_INTERVAL = 0.02  # Период проверки задержки цикла событий, секунды
+
+LOG_LINE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - \S+ - \w+ - (.*)$")
+LOG_MESSAGE = re.compile(r"^📝 Получено сообщение от пользователя (\d+): '(.*)'$")
+LOG_QUEUED = re.compile(r"^📥 Файл (альбома )?поставлен в очередь загрузки: (.+)$")
+LOG_UPLOADED = re.compile(r"^✅ Файл загружен на Яндекс.Диск: (.+)$")
+
+
+@dataclass
+class Event:
+    """Действие пользователя в момент at (секунды от начала прогона)"""
+    at: float
+    user_id: int
+    action: str  # text, command, callback, media
+    value: str = ""  # текст, команда или данные кнопки
+    kinds: tuple = ()  # типы файлов; больше одного — альбом
+    files: list = field(default_factory=list)  # (тип, md5, файл Bot API) после подготовки
+
+    @property
+    def label(self) -> str:
+        """Под каким именем учитывается задержка"""
+        if self.action == "media":
+            return "album" if len(self.kinds) > 1 else self.kinds[0]
+        if self.action == "text":
+            return "invoice"
+        return self.value.split()[0]
+
+
+def synthetic_events(users: list, duration: float, think: float, limits: dict, seed: int) -> list:
+    """Сессии пользователей: накладная, файлы вперемешку с меню, сброс и новая накладная"""
+    rng = random.Random(seed)
+    events = []
+    for user_id in users:
+        # Пользователи подключаются в первые 20% прогона
+        at = rng.uniform(0, duration * 0.2)
+        events.append(Event(at, user_id, "command", "/start"))
+        invoice = 0
+        while at < duration:
+            invoice += 1
+            at += rng.expovariate(1 / think)
+            events.append(Event(at, user_id, "text", f"LT-{user_id}-{invoice}"))
+            if rng.random() < 0.3:
+                at += rng.expovariate(1 / think)
+                events.append(Event(at, user_id, "command", "/menu"))
+                if rng.random() < 0.5:
+                    at += rng.expovariate(1 / think)
+                    events.append(Event(at, user_id, "callback", "menu_current"))
+
+            counts = dict.fromkeys(EXTENSIONS, 0)
+            for _ in range(rng.randint(3, 15)):
+                roll = rng.random()
+                if roll < 0.55:
+                    kinds = ("photo",)
+                elif roll < 0.75:
+                    kinds = ("photo",) * rng.randint(2, 6)
+                elif roll < 0.85:
+                    kinds = ("video",)
+                else:
+                    kinds = ("document",)
+                if counts[kinds[0]] + len(kinds) > limits[kinds[0]]:
+                    break
+                counts[kinds[0]] += len(kinds)
+                at += rng.expovariate(1 / think)
+                events.append(Event(at, user_id, "media", kinds=kinds))
+
+                roll = rng.random()
+                if roll < 0.05:
+                    at += rng.expovariate(1 / think)
+                    events.append(Event(at, user_id, "callback", "menu_stats"))
+                elif roll < 0.10:
+                    at += rng.expovariate(1 / think)
+                    events.append(Event(at, user_id, "command", "/current"))
+
+            at += rng.expovariate(1 / think)
+            if rng.random() < 0.7:
+                events.append(Event(at, user_id, "command", "/reset"))
+            else:
+                events.append(Event(at, user_id, "callback", "menu_reset"))
+    return sorted((event for event in events if event.at < duration), key=lambda event: event.at)
+
+
+def replay_events(path: str, bot, speed: float) -> tuple[list, list]:
+    """
+    События из лога бота и задержки загрузки, записанные в нем же (для сравнения с прогоном).
+    Файлы относятся к пользователю, который последним ввел накладную с этой папкой;
+    для папок без такой строки заводится отдельный пользователь.
+    """
+    from config import ALBUM_WINDOW
+
+    events = []
+    folder_users = {}  # папка накладной -> пользователь
+    user_invoices = {}  # пользователь -> накладная
+    queued = {}  # путь -> время постановки в очередь
+    production_latencies = []
+    extra_users = iter(range(FIRST_USER_ID, FIRST_USER_ID + 10 ** 6))
+    album = None  # Последний альбом: файлы альбома приходят подряд
+    first = None
+
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = LOG_LINE.match(line.rstrip("\n"))
+            if match is None:
+                continue
+            timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f").timestamp()
+            message = match.group(2)
+            if first is None:
+                first = timestamp
+            at = (timestamp - first) / speed
+
+            if (found := LOG_MESSAGE.match(message)) is not None:
+                user_id, text = int(found.group(1)), found.group(2)
+                is_invoice, _ = bot.validate_invoice_number(text)
+                if is_invoice:
+                    if user_invoices.get(user_id) not in (None, text):
+                        events.append(Event(at, user_id, "command", "/reset"))
+                    user_invoices[user_id] = text
+                    folder_users[bot.get_safe_folder_name(text)] = user_id
+                events.append(Event(at, user_id, "text", text))
+                album = None
+            elif (found := LOG_QUEUED.match(message)) is not None:
+                file_path = found.group(2)
+                kind = next((kind for kind, policy in bot.MEDIA_POLICIES.items()
+                             if policy.match_extension(file_path)), None)
+                if kind is None:
+                    continue
+                queued[file_path] = timestamp
+                folder = file_path.rsplit("/", 2)[-2]
+                user_id = folder_users.get(folder)
+                if user_id is None:
+                    user_id = folder_users[folder] = next(extra_users)
+                    user_invoices[user_id] = folder
+                    events.append(Event(at, user_id, "text", folder))
+                if found.group(1) and album is not None and album.user_id == user_id \
+                        and at - album.at <= ALBUM_WINDOW / speed:
+                    album.kinds += (kind,)
+                    continue
+                event = Event(at, user_id, "media", kinds=(kind,))
+                events.append(event)
+                album = event if found.group(1) else None
+            elif (found := LOG_UPLOADED.match(message)) is not None:
+                started = queued.pop(found.group(1), None)
+                if started is not None:
+                    production_latencies.append(timestamp - started)
+    return sorted(events, key=lambda event: event.at), production_latencies
+
+
+def prepare_files(events: list, servers: FakeServers, sizes: dict) -> dict:
+    """Регистрирует файлы событий на заглушке Telegram. Возвращает md5 -> событие."""
+    # Общий случайный блок и уникальное начало: содержимое различается, а генерация дешевая
+    block = os.urandom(max(sizes.values()))
+    by_md5 = {}
+    for event in events:
+        for kind in event.kinds:
+            data = os.urandom(16) + block[:max(0, sizes[kind] - 16)]
+            md5 = hashlib.md5(data).hexdigest()
+            event.files.append((kind, md5, servers.add_telegram_file(data, EXTENSIONS[kind])))
+            by_md5[md5] = event
+    return by_md5
+
+
+async def monitor_loop_lag(lags: list, stop: asyncio.Event) -> None:
+    """Задержка срабатывания таймера сверх LAG_INTERVAL"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - started - LAG_INTERVAL))
+
+
+async def run(args, servers: FakeServers) -> dict:
+    from telegram import Update
+    import metrics
+
+    bot, app = await start_bot(args.tmp, args.send_limits)
+    factory = UpdateFactory()
+    limits = {kind: bot.MEDIA_POLICIES[kind].max_per_invoice for kind in EXTENSIONS}
+    production_latencies = []
+    if args.replay:
+        events, production_latencies = replay_events(args.replay, bot, args.speed)
+    else:
+        users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+        events = synthetic_events(users, args.duration, args.think, limits, args.seed)
+    sizes = {"photo": args.photo_size * 1024, "video": args.video_size * 1024, "document": args.document_size * 1024}
+    prepare_files(events, servers, sizes)
+    bot.set_allowed_users(bot.ALLOWED_USERS | frozenset(event.user_id for event in events))
+
+    by_user = defaultdict(list)
+    for event in events:
+        by_user[event.user_id].append(event)
+
+    latencies = defaultdict(list)  # команда -> длительности обработки обновлений
+    lateness = []
+    sent = {}  # md5 -> время отправки обновления
+    total_bytes = 0
+
+    def build_updates(event: Event) -> list:
+        if event.action in ("text", "command"):
+            return [factory.text(event.user_id, event.value)]
+        if event.action == "callback":
+            return [factory.callback(event.user_id, event.value)]
+        group = f"lt{event.user_id}_{id(event)}" if len(event.files) > 1 else None
+        return [factory.media(event.user_id, kind, file, group) for kind, _, file in event.files]
+
+    async def user_session(user_events: list) -> None:
+        nonlocal total_bytes
+        for event in user_events:
+            delay = started + event.at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lateness.append(-delay)
+            for kind, md5, file in event.files:
+                sent[md5] = time.perf_counter()
+                total_bytes += file["file_size"]
+            for payload in build_updates(event):
+                began = time.perf_counter()
+                await app.process_update(Update.de_json(payload, app.bot))
+                latencies[event.label].append(time.perf_counter() - began)
+
+    counters = ("upload_jobs_submitted_total", "upload_jobs_completed_total", "upload_jobs_failed_total")
+    before = {name: metrics.total_counter(name) for name in counters}
+
+    lags = []
+    stop_monitor = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(lags, stop_monitor))
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(user_events) for user_events in by_user.values()))
+    processed_at = time.perf_counter()
+
+    # Дожидаемся разбора альбомов и загрузки принятых файлов (отклоненные по лимитам в очередь не попали)
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        albums = metrics.get_gauge("album_groups_buffered") + len(bot.album_collector._tasks)
+        done = {name: metrics.total_counter(name) - before[name] for name in counters}
+        if not albums and done["upload_jobs_completed_total"] + done["upload_jobs_failed_total"] \
+                >= done["upload_jobs_submitted_total"]:
+            break
+        await asyncio.sleep(0.05)
+    stop_monitor.set()
+    await monitor
+    done = {name: int(metrics.total_counter(name) - before[name]) for name in counters}
+    await stop_bot(bot, app)
+
+    uploads = [servers.state.uploads[md5] - at for md5, at in sent.items() if md5 in servers.state.uploads]
+    elapsed = max(processed_at - started, 1e-9)
+    updates = sum(len(values) for values in latencies.values())
+
+    def distribution(values: list) -> dict:
+        return {
+            "count": len(values),
+            "p50": round(percentile(values, 0.50), 4),
+            "p95": round(percentile(values, 0.95), 4),
+            "p99": round(percentile(values, 0.99), 4),
+            "max": round(max(values, default=0.0), 4),
+        }
+
+    return {
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 2),
+        "users": len(by_user),
+        "commands": {label: distribution(values) for label, values in sorted(latencies.items())},
+        "loop_lag": distribution(lags),
+        "lateness": distribution(lateness),
+        "uploads": {
+            **distribution(uploads),
+            "files": len(sent),
+            "submitted": done["upload_jobs_submitted_total"],
+            "failed": done["upload_jobs_failed_total"],
+            "mb": round(total_bytes / 1024 ** 2, 1),
+        },
+        "production_uploads": distribution(production_latencies) if production_latencies else None,
+    }
+
+
+def print_report(summary: dict) -> None:
+    print(f"\nОбновлений: {summary['updates']} от {summary['users']} пользователей за {summary['seconds']:.1f}с "
+          f"— {summary['updates_per_s']:.1f} updates/s")
+    print(f"\n  {'команда':<14} {'кол-во':>7} {'p50,мс':>8} {'p95,мс':>8} {'p99,мс':>8} {'max,мс':>8}")
+    rows = list(summary["commands"].items()) + [
+        ("задержка цикла", summary["loop_lag"]),
+        ("отставание", summary["lateness"]),
+        ("загрузка", summary["uploads"]),
+    ]
+    if summary["production_uploads"]:
+        rows.append(("загрузка (лог)", summary["production_uploads"]))
+    for label, stats in rows:
+        print(f"  {label:<14} {stats['count']:>7} {stats['p50'] * 1000:>8.1f} {stats['p95'] * 1000:>8.1f} "
+              f"{stats['p99'] * 1000:>8.1f} {stats['max'] * 1000:>8.1f}")
+    uploads = summary["uploads"]
+    print(f"\nФайлов: {uploads['files']} ({uploads['mb']} MB), в очередь: {uploads['submitted']}, "
+          f"загружено: {uploads['count']}, ошибок: {uploads['failed']}")
+
+
+def find_regressions(baseline: dict, summary: dict, tolerance: float, min_delta: float,
+                     min_samples: int) -> list:
+    """Что ухудшилось сильнее допустимого: пропускная способность и p95 задержек"""
+    regressions = []
+    old_rate, new_rate = baseline["updates_per_s"], summary["updates_per_s"]
+    if new_rate < old_rate * (1 - tolerance):
+        regressions.append(f"updates/s: {old_rate:.1f} → {new_rate:.1f}")
+
+    def check(name: str, old: dict, new: dict) -> None:
+        if not old or not new or min(old["count"], new["count"]) < min_samples:
+            return
+        if new["p95"] > old["p95"] * (1 + tolerance) + min_delta:
+            regressions.append(f"{name} p95: {old['p95'] * 1000:.1f}мс → {new['p95'] * 1000:.1f}мс")
+
+    for label, stats in summary["commands"].items():
+        check(label, baseline["commands"].get(label), stats)
+    check("задержка цикла", baseline["loop_lag"], summary["loop_lag"])
+    check("загрузка", baseline["uploads"], summary["uploads"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="пользователей в синтетическом потоке")
+    parser.add_argument("--duration", type=float, default=30, help="длительность синтетического потока, с")
+    parser.add_argument("--think", type=float, default=1.0, help="средняя пауза пользователя между действиями, с")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора потока")
+    parser.add_argument("--replay", metavar="LOG", help="воспроизвести поток из лога бота")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение воспроизведения лога")
+    parser.add_argument("--photo-size", type=int, default=300, help="размер фото, КБ")
+    parser.add_argument("--video-size", type=int, default=2048, help="размер видео, КБ")
+    parser.add_argument("--document-size", type=int, default=200, help="размер документа, КБ")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа серверов, с")
+    parser.add_argument("--bandwidth", type=float, default=0, help="скорость одной передачи, МБ/с (0 — без ограничения)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 от Яндекс.Диска")
+    parser.add_argument("--workers", type=int, default=None, help="воркеров загрузки (UPLOAD_WORKERS)")
+    parser.add_argument("--send-limits", action="store_true", help="оставить лимиты отправки сообщений Telegram")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать загрузок после потока, с")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_PATH, metavar="PATH",
+                        help="сохранить итог как базовый")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE_PATH, metavar="PATH",
+                        help="сравнить с базовым и завершиться с кодом 1 при ухудшении")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    parser.add_argument("--min-delta", type=float, default=5.0, help="прирост p95 меньше стольких мс не считается")
+    parser.add_argument("--min-samples", type=int, default=20, help="сравнивать команды хотя бы с таким числом замеров")
+    parser.add_argument("--json", metavar="PATH", help="записать итог в JSON")
+    args = parser.parse_args()
+    args.tmp = tempfile.mkdtemp(prefix="bench_load_")
+
+    servers = FakeServers(TOKEN, latency=args.latency, bandwidth=int(args.bandwidth * 1024 ** 2),
+                          error_rate=args.error_rate)
+    servers.start()
+    configure_environment(servers, args.tmp, args.workers)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    params = {
+        "source": os.path.basename(args.replay) if args.replay else "synthetic",
+        "users": None if args.replay else args.users, "duration": None if args.replay else args.duration,
+        "think": args.think, "seed": args.seed, "speed": args.speed if args.replay else None,
+        "sizes_kb": [args.photo_size, args.video_size, args.document_size],
+        "latency": args.latency, "bandwidth_mb": args.bandwidth, "error_rate": args.error_rate,
+        "workers": args.workers, "send_limits": args.send_limits,
+    }
+    source = f"лог {args.replay} (x{args.speed:g})" if args.replay else \
+        f"{args.users} пользователей, {args.duration:g}с, пауза ~{args.think:g}с"
+    print(f"Нагрузка: {source}, задержка серверов {args.latency * 1000:.0f} мс")
+    try:
+        summary = asyncio.run(run(args, servers))
+    finally:
+        servers.stop()
+    print_report(summary)
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "params": params,
+        "summary": summary,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            print(f"\nБазовый прогон не найден: {args.baseline}")
+            failed = True
+        else:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            print(f"\nСравнение с базовым прогоном {baseline['timestamp']} ({baseline.get('commit') or 'без коммита'}):")
+            if baseline["params"] != params:
+                print("⚠️ Параметры прогона отличаются от базового — сравнение приблизительное")
+            regressions = find_regressions(
+                baseline["summary"], summary, args.tolerance, args.min_delta / 1000, args.min_samples
+            )
+            for regression in regressions:
+                print(f"  ❌ {regression}")
+            if regressions:
+                failed = True
+            else:
+                print(f"  ✅ Ухудшений больше {args.tolerance:.0%} нет")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        print(f"\nБазовый прогон сохранен: {os.path.relpath(args.save_baseline, ROOT)}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
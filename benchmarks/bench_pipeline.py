@@ -0,0 +1,350 @@
+"""
+Бенчмарк: сквозная загрузка файлов без обращения к настоящим Telegram и Яндекс.Диску.
+
+Обновления с фото, видео и документами проходят через Application.process_update
+(handle_photo / handle_video / handle_document, очередь и воркеры загрузки, перенос файла),
+а Bot API и REST API Яндекс.Диска отвечают из fake_servers.py с заданными задержкой,
+пропускной способностью, долей ошибок и размером диска.
+
+Для каждого уровня параллельности (число пользователей, одновременно присылающих файлы):
+  files/s, MB/s — загруженные файлы и объем за время от первого обновления до последней загрузки;
+  p50/p95/p99   — задержка от обновления до завершения загрузки файла на «диск»;
+  ack p95       — сколько обрабатывалось само обновление (до ответа «файл принят»).
+Лимиты отправки сообщений по умолчанию сняты (--send-limits возвращает их).
+
+Результаты дописываются в benchmarks/results/bench_pipeline.jsonl; --compare сравнивает
+прогон с предыдущим с теми же параметрами.
+
+Запуск:
+    python benchmarks/bench_pipeline.py --files 200 --concurrency 1,4,16 --size 512 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeServers  # noqa: E402
+
+TOKEN = "123456:bench"
+RESULTS_PATH = os.path.join(ROOT, "benchmarks", "results", "bench_pipeline.jsonl")
+EXTENSIONS = {"photo": ".jpg", "video": ".mp4", "document": ".pdf"}
+FIRST_USER_ID = 900000
+
+
+def percentile(values: list, q: float) -> float:
+    """Квантиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+class UpdateFactory:
+    """Обновления Telegram в виде словарей Bot API"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                **fields,
+            },
+        }
+
+    def text(self, user_id: int, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._message(user_id, **fields)
+
+    def media(self, user_id: int, kind: str, file: dict, media_group_id: str = None) -> dict:
+        fields = {"media_group_id": media_group_id} if media_group_id else {}
+        if kind == "photo":
+            return self._message(user_id, photo=[{**file, "width": 1280, "height": 960}], **fields)
+        if kind == "video":
+            return self._message(user_id, video={**file, "width": 1920, "height": 1080, "duration": 10}, **fields)
+        return self._message(
+            user_id, document={**file, "file_name": "bench.pdf", "mime_type": "application/pdf"}, **fields
+        )
+
+    def callback(self, user_id: int, data: str) -> dict:
+        """Нажатие inline-кнопки под сообщением бота"""
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Benchmark"},
+                    "text": "Меню",
+                },
+            },
+        }
+
+
+async def run_level(bot, app, servers: FakeServers, factory: UpdateFactory, users: list,
+                    files_per_user: int, kinds: list, size: int, timeout: float) -> dict:
+    from telegram import Update
+    import metrics
+
+    async def process(payload: dict) -> float:
+        started = time.perf_counter()
+        await app.process_update(Update.de_json(payload, app.bot))
+        return time.perf_counter() - started
+
+    sent = {}  # md5 -> время отправки обновления
+    acks = []
+    limits = {kind: bot.MEDIA_POLICIES[kind].max_per_invoice for kind in EXTENSIONS}
+
+    # Файлы готовим заранее, чтобы генерация данных не попала в измерение
+    plans = []
+    for user_id in users:
+        plan = []
+        for number in range(files_per_user):
+            kind = kinds[number % len(kinds)]
+            data = os.urandom(size)
+            plan.append((kind, hashlib.md5(data).hexdigest(), servers.add_telegram_file(data, EXTENSIONS[kind])))
+        plans.append((user_id, plan))
+
+    async def user_session(user_id: int, plan: list) -> None:
+        invoice = 0
+        counts = dict.fromkeys(EXTENSIONS, 0)
+
+        async def new_invoice() -> None:
+            nonlocal invoice
+            if invoice:
+                await process(factory.text(user_id, "/reset"))
+            invoice += 1
+            await process(factory.text(user_id, f"BENCH-{user_id}-{invoice}"))
+            counts.update(dict.fromkeys(EXTENSIONS, 0))
+
+        await new_invoice()
+        for kind, md5, file in plan:
+            if counts[kind] >= limits[kind]:
+                await new_invoice()
+            counts[kind] += 1
+            sent[md5] = time.perf_counter()
+            acks.append(await process(factory.media(user_id, kind, file)))
+
+    failed_before = sum(metrics.get_counter("upload_jobs_failed_total", kind=kind) for kind in EXTENSIONS)
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(user_id, plan) for user_id, plan in plans))
+
+    # Ждем, пока каждый файл будет загружен или его задача окончательно не удастся
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        failed = sum(metrics.get_counter("upload_jobs_failed_total", kind=kind) for kind in EXTENSIONS) - failed_before
+        done = sum(1 for md5 in sent if md5 in servers.state.uploads)
+        if done + failed >= len(sent):
+            break
+        await asyncio.sleep(0.01)
+    failed = int(sum(metrics.get_counter("upload_jobs_failed_total", kind=kind) for kind in EXTENSIONS) - failed_before)
+
+    latencies = [servers.state.uploads[md5] - at for md5, at in sent.items() if md5 in servers.state.uploads]
+    finished = max((servers.state.uploads[md5] for md5 in sent if md5 in servers.state.uploads), default=started)
+    elapsed = max(finished - started, 1e-9)
+    uploaded = len(latencies)
+    return {
+        "users": len(users),
+        "files": len(sent),
+        "uploaded": uploaded,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "files_per_s": round(uploaded / elapsed, 2),
+        "mb_per_s": round(uploaded * size / elapsed / 1024 ** 2, 2),
+        "p50": round(percentile(latencies, 0.50), 4),
+        "p95": round(percentile(latencies, 0.95), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "ack_p95": round(percentile(acks, 0.95), 4),
+    }
+
+
+def configure_environment(servers: FakeServers, tmp: str, workers: int = None) -> None:
+    """Переменные окружения для config.py: до импорта bot, чтобы он смотрел на заглушки"""
+    servers.configure_yadisk()
+    os.environ.update({
+        "TELEGRAM_TOKEN": TOKEN,
+        "YANDEX_DISK_TOKEN": "bench",
+        "TELEGRAM_BASE_URL": servers.base_url,
+        "TELEGRAM_BASE_FILE_URL": servers.base_file_url,
+        "STATE_BACKEND": "memory",
+        "JOBS_DB_PATH": os.path.join(tmp, "jobs.sqlite3"),
+        "DEDUP_DB_PATH": os.path.join(tmp, "dedup.sqlite3"),
+        "MANIFEST_DB_PATH": os.path.join(tmp, "manifests.sqlite3"),
+        "TRACE_SAMPLE_RATE": "0",
+        "METRICS_PATH": "",
+    })
+    if workers:
+        os.environ["UPLOAD_WORKERS"] = str(workers)
+
+
+async def start_bot(tmp: str, send_limits: bool = False):
+    """Приложение из build_application(), прошедшее запуск как в main(). Возвращает (модуль bot, app)."""
+    import bot
+
+    bot.USERS_FILE = os.path.join(tmp, "allowed_users.txt")
+    if not send_limits:
+        # Ответы бота иначе упираются в лимит 1 сообщение/с на чат, а не в загрузку
+        from outbound import OutboundRateLimiter
+        bot.outbound_limiter = OutboundRateLimiter(global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    app = bot.build_application()
+    await app.initialize()
+    await bot.post_init(app)
+    await bot.bot_ready.wait()
+    return bot, app
+
+
+async def stop_bot(bot, app) -> None:
+    await bot.post_shutdown(app)
+    await app.shutdown()
+
+
+async def run(args, servers: FakeServers) -> list:
+    bot, app = await start_bot(args.tmp, args.send_limits)
+
+    factory = UpdateFactory()
+    kinds = ["photo", "video", "document"] if args.kind == "mix" else [args.kind]
+    results = []
+    user_ids = itertools.count(FIRST_USER_ID)
+    for concurrency in args.concurrency:
+        users = [next(user_ids) for _ in range(concurrency)]
+        bot.set_allowed_users(bot.ALLOWED_USERS | frozenset(users))
+        files_per_user = max(1, args.files // concurrency)
+        result = await run_level(bot, app, servers, factory, users, files_per_user, kinds, args.size * 1024, args.timeout)
+        results.append(result)
+        print(
+            f"  {concurrency:>5} {result['files']:>6} {result['uploaded']:>6} {result['failed']:>5} "
+            f"{result['files_per_s']:>8.1f} {result['mb_per_s']:>7.1f} "
+            f"{result['p50'] * 1000:>7.0f} {result['p95'] * 1000:>7.0f} {result['p99'] * 1000:>7.0f} "
+            f"{result['ack_p95'] * 1000:>8.0f}"
+        )
+
+    await stop_bot(bot, app)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def load_previous(params: dict) -> dict:
+    """Последний сохраненный прогон с теми же параметрами"""
+    if not os.path.exists(RESULTS_PATH):
+        return {}
+    previous = {}
+    with open(RESULTS_PATH, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("params") == params:
+                previous = record
+    return previous
+
+
+def compare(previous: dict, results: list) -> None:
+    old_levels = {level["users"]: level for level in previous.get("levels", [])}
+    print(f"\nСравнение с прогоном {previous['timestamp']} ({previous.get('commit') or 'без коммита'}):")
+    for level in results:
+        old = old_levels.get(level["users"])
+        if old is None:
+            continue
+        changes = []
+        for key, label in (("files_per_s", "files/s"), ("mb_per_s", "MB/s"), ("p95", "p95"), ("p99", "p99")):
+            if old[key]:
+                changes.append(f"{label} {(level[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"  {level['users']:>5}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200, help="файлов на уровень параллельности")
+    parser.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16],
+                        help="уровни параллельности через запятую (число пользователей)")
+    parser.add_argument("--size", type=int, default=512, help="размер файла, КБ")
+    parser.add_argument("--kind", choices=["photo", "video", "document", "mix"], default="photo")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа серверов, с")
+    parser.add_argument("--bandwidth", type=float, default=0, help="скорость одной передачи, МБ/с (0 — без ограничения)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 от Яндекс.Диска")
+    parser.add_argument("--quota", type=int, default=10 * 1024, help="размер диска, МБ")
+    parser.add_argument("--workers", type=int, default=None, help="воркеров загрузки (UPLOAD_WORKERS)")
+    parser.add_argument("--send-limits", action="store_true", help="оставить лимиты отправки сообщений Telegram")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько ждать загрузок одного уровня, с")
+    parser.add_argument("--compare", action="store_true", help="сравнить с предыдущим прогоном с теми же параметрами")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результат")
+    args = parser.parse_args()
+    args.tmp = tempfile.mkdtemp(prefix="bench_pipeline_")
+
+    servers = FakeServers(
+        TOKEN, latency=args.latency, bandwidth=int(args.bandwidth * 1024 ** 2),
+        error_rate=args.error_rate, quota=args.quota * 1024 ** 2
+    )
+    servers.start()
+    configure_environment(servers, args.tmp, args.workers)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    params = {
+        "files": args.files, "concurrency": args.concurrency, "size_kb": args.size, "kind": args.kind,
+        "latency": args.latency, "bandwidth_mb": args.bandwidth, "error_rate": args.error_rate,
+        "quota_mb": args.quota, "workers": args.workers, "send_limits": args.send_limits,
+    }
+    print(f"Файлы по {args.size} КБ ({args.kind}), задержка серверов {args.latency * 1000:.0f} мс, "
+          f"ошибки {args.error_rate:.0%}")
+    print(f"  {'польз.':>5} {'файлов':>6} {'загр.':>6} {'ошиб.':>5} {'files/s':>8} {'MB/s':>7} "
+          f"{'p50,мс':>7} {'p95,мс':>7} {'p99,мс':>7} {'ack p95':>8}")
+    try:
+        results = asyncio.run(run(args, servers))
+    finally:
+        servers.stop()
+
+    previous = load_previous(params) if args.compare else {}
+    if previous:
+        compare(previous, results)
+    elif args.compare:
+        print("\nПредыдущих прогонов с такими параметрами нет.")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "params": params,
+            "levels": results,
+        }
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"\nРезультат сохранен: {os.path.relpath(RESULTS_PATH, ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Бенчмарк: время холодного запуска бота.
+
+Этапы:
+  import — импорт зависимостей и модуля bot (в отдельном процессе, с нуля);
+  build  — создание Application и регистрация обработчиков;
+  bind   — сколько проходит от начала post_init до момента, когда webhook может открыть порт;
+  ready  — когда завершены проверка Яндекс.Диска и загрузка пользователей.
+
+Сценарии для bind/ready:
+  eager — проверки выполняются в post_init последовательно (как раньше при импорте и в main);
+  lazy  — post_init выполняет только локальную работу, проверки идут в фоне параллельно.
+
+Яндекс.Диск эмулируется клиентом с задержкой на каждый запрос.
+
+Запуск:
+    python benchmarks/bench_startup.py --latency 0.3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TMP = tempfile.mkdtemp(prefix="bench_startup_")
+ENV = {
+    "TELEGRAM_TOKEN": "123456:bench",
+    "YANDEX_DISK_TOKEN": "bench",
+    "STATE_BACKEND": "memory",
+    "JOBS_DB_PATH": os.path.join(TMP, "jobs.sqlite3"),
+}
+os.environ.update(ENV)
+
+IMPORT_SNIPPET = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+marks = []
+t = time.perf_counter()
+for name in ("telegram.ext", "httpx", "yadisk", "bot"):
+    __import__(name)
+    now = time.perf_counter()
+    marks.append((name, now - t))
+    t = now
+print(json.dumps(marks))
+"""
+
+
+class SlowDiskClient:
+    """Синхронный клиент Яндекс.Диска, каждый запрос которого занимает latency секунд."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.files = {}
+
+    def _wait(self):
+        time.sleep(self.latency)
+
+    def get_disk_info(self, **kwargs):
+        self._wait()
+        return types.SimpleNamespace(total_space=10 * 1024 ** 3, used_space=1024 ** 3)
+
+    def mkdir(self, path, **kwargs):
+        self._wait()
+
+    def exists(self, path, **kwargs):
+        self._wait()
+        return True
+
+    def get_meta(self, path, **kwargs):
+        self._wait()
+        return types.SimpleNamespace(md5="bench", modified=None, size=10)
+
+    def download(self, path, dst, **kwargs):
+        self._wait()
+        dst.write(b"177611260\n")
+
+    def upload(self, src, path, **kwargs):
+        self._wait()
+
+
+def measure_imports() -> list:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(root=ROOT)],
+        env={**os.environ, **ENV}, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+async def run_scenario(bot, name: str, latency: float) -> tuple:
+    from storage import YandexStorage
+
+    bot.storage = YandexStorage("", sync_client=SlowDiskClient(latency))
+    bot.quota.storage = bot.storage
+    bot.USERS_FILE = os.path.join(TMP, "allowed_users.txt")
+    bot.bot_ready.clear()
+    app = bot.build_application()
+
+    started = time.perf_counter()
+    if name == "eager":
+        await bot.state.start()
+        await bot.check_yandex_connection()
+        bot.set_allowed_users(await bot.load_allowed_users())
+        bot.upload_pool.start()
+        bot.bot_ready.set()
+    else:
+        await bot.post_init(app)
+    bind = time.perf_counter() - started
+    await bot.bot_ready.wait()
+    ready = time.perf_counter() - started
+
+    await bot.post_shutdown(app)
+    return bind, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка одного запроса к Яндекс.Диску, с")
+    args = parser.parse_args()
+
+    print("Импорт (отдельный процесс):")
+    total = 0.0
+    for name, seconds in measure_imports():
+        total += seconds
+        print(f"  {name:<14} {seconds * 1000:8.1f} мс")
+    print(f"  {'итого':<14} {total * 1000:8.1f} мс")
+
+    import logging
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    started = time.perf_counter()
+    bot.build_application()
+    print(f"\nСоздание приложения: {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    print(f"\nЗапуск при задержке Яндекс.Диска {args.latency * 1000:.0f} мс на запрос:")
+    print(f"  {'сценарий':<8} {'до bind':>10} {'до готовности':>15}")
+    for name in ("eager", "lazy"):
+        bind, ready = asyncio.run(run_scenario(bot, name, args.latency))
+        print(f"  {name:<8} {bind * 1000:8.0f}мс {ready * 1000:13.0f}мс")
+
+
+if __name__ == "__main__":
+    main()
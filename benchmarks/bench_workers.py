@@ -0,0 +1,208 @@
+"""
+Бенчмарк: пропускная способность webhook в зависимости от числа процессов-обработчиков.
+
+Для каждого значения --workers запускается `python bot.py` с WEBHOOK_WORKERS=N: диспетчер
+принимает POST-запросы на порту webhook и раздает обновления обработчикам по id пользователя.
+Bot API и Яндекс.Диск заменены fake_servers.py, лимиты отправки сообщений сняты, чтобы
+измерялась обработка обновлений (разбор JSON, обработчики, ответы), а не ограничения Telegram.
+
+Каждый из --users пользователей присылает --updates команд /start подряд, всего --clients
+одновременных HTTP-клиентов. Для каждого числа обработчиков:
+  upd/s   — обновления от первого запроса до последнего ответа бота;
+  speedup — во сколько раз быстрее, чем с первым значением --workers;
+  post p95 — сколько диспетчер отвечал на запрос webhook.
+С одним обработчиком bot.py работает как раньше (run_webhook без диспетчера), поэтому первая
+строка — это и цена лишнего перехода через диспетчер. Прирост ограничен числом ядер машины
+(os.cpu_count() печатается в заголовке): на одном ядре процессы только делят его между собой.
+
+Запуск:
+    python benchmarks/bench_workers.py --workers 1,2,4 --users 64 --updates 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import ROOT, TOKEN, UpdateFactory, percentile  # noqa: E402
+from fake_servers import FakeServers  # noqa: E402
+
+# Подключается к каждому процессу через PYTHONPATH: направляет yadisk на заглушку и снимает
+# лимиты отправки до того, как bot.py прочитает их из config
+SITECUSTOMIZE = """
+import sys
+sys.path.insert(0, {root!r})
+import yadisk.settings
+yadisk.settings.BASE_API_URL = {yandex_url!r}
+import config
+config.SEND_GLOBAL_RATE = config.SEND_GLOBAL_BURST = 10 ** 6
+config.SEND_PER_CHAT_RATE = config.SEND_PER_CHAT_BURST = config.SEND_GROUP_CHAT_RATE = 10 ** 6
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_bot_process(servers: FakeServers, workers: int, port: int, tmp: str) -> subprocess.Popen:
+    workdir = tempfile.mkdtemp(prefix=f"w{workers}_", dir=tmp)
+    site = os.path.join(workdir, "site")
+    os.makedirs(site)
+    with open(os.path.join(site, "sitecustomize.py"), "w", encoding="utf-8") as f:
+        f.write(SITECUSTOMIZE.format(root=ROOT, yandex_url=servers.yandex_url))
+    env = dict(
+        os.environ,
+        PYTHONPATH=site,
+        TELEGRAM_TOKEN=TOKEN,
+        YANDEX_DISK_TOKEN="bench",
+        TELEGRAM_BASE_URL=servers.base_url,
+        TELEGRAM_BASE_FILE_URL=servers.base_file_url,
+        WEBHOOK_WORKERS=str(workers),
+        WEBHOOK_URL="https://bench.invalid/",
+        PORT=str(port),
+        METRICS_PORT=str(free_port()),
+        STATE_DB_PATH=os.path.join(workdir, "state.sqlite3"),
+        JOBS_DB_PATH=os.path.join(workdir, "jobs.sqlite3"),
+        DEDUP_DB_PATH=os.path.join(workdir, "dedup.sqlite3"),
+        MANIFEST_DB_PATH=os.path.join(workdir, "manifests.sqlite3"),
+        TRACE_SAMPLE_RATE="0",
+    )
+    log = open(os.path.join(workdir, "bot.log"), "w", encoding="utf-8")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_bot_process(process: subprocess.Popen) -> None:
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def wait_replies(servers: FakeServers, expected: int, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while len(servers.state.sent) < expected:
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def run_level(servers: FakeServers, factory: UpdateFactory, workers: int, args) -> dict:
+    port = free_port()
+    process = start_bot_process(servers, workers, port, args.tmp)
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.clients), timeout=30) as client:
+            # Прогрев: по одному обновлению в каждый обработчик, заодно дожидаемся их запуска
+            deadline = time.perf_counter() + args.timeout
+            while True:
+                try:
+                    await client.get(url)
+                    break
+                except httpx.TransportError:
+                    if time.perf_counter() > deadline or process.poll() is not None:
+                        raise RuntimeError(f"bot.py с {workers} обработчиками не запустился")
+                    await asyncio.sleep(0.1)
+            baseline = len(servers.state.sent)
+            for index in range(workers):
+                await client.post(url, json=factory.text(args.first_user + index, "/start"))
+            if not await wait_replies(servers, baseline + workers, args.timeout):
+                raise RuntimeError("обработчики не ответили на прогрев")
+
+            users = [args.first_user + workers + index for index in range(args.users)]
+            bodies = [
+                json.dumps(factory.text(user_id, "/start")).encode()
+                for _ in range(args.updates) for user_id in users
+            ]
+            posts = []
+            queue = asyncio.Queue()
+            for body in bodies:
+                queue.put_nowait(body)
+
+            async def client_loop() -> None:
+                while not queue.empty():
+                    body = queue.get_nowait()
+                    started = time.perf_counter()
+                    response = await client.post(url, content=body, headers={"Content-Type": "application/json"})
+                    response.raise_for_status()
+                    posts.append(time.perf_counter() - started)
+
+            baseline = len(servers.state.sent)
+            started = time.perf_counter()
+            await asyncio.gather(*(client_loop() for _ in range(args.clients)))
+            completed = await wait_replies(servers, baseline + len(bodies), args.timeout)
+            elapsed = time.perf_counter() - started
+            replies = len(servers.state.sent) - baseline
+    finally:
+        stop_bot_process(process)
+
+    return {
+        "workers": workers,
+        "updates": len(bodies),
+        "replies": replies,
+        "completed": completed,
+        "updates_per_s": round(replies / elapsed, 1) if elapsed else 0.0,
+        "post_p95": round(percentile(posts, 0.95), 4),
+    }
+
+
+async def run(args, servers: FakeServers) -> list:
+    factory = UpdateFactory()
+    results = []
+    for workers in args.workers:
+        result = await run_level(servers, factory, workers, args)
+        result["speedup"] = round(result["updates_per_s"] / results[0]["updates_per_s"], 2) if results else 1.0
+        results.append(result)
+        print(
+            f"  {workers:>9} {result['updates']:>7} {result['replies']:>7} {result['updates_per_s']:>8.1f} "
+            f"{result['speedup']:>8.2f} {result['post_p95'] * 1000:>9.1f}"
+            + ("" if result["completed"] else "  (не дождались всех ответов)")
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4],
+                        help="число процессов-обработчиков через запятую")
+    parser.add_argument("--users", type=int, default=64, help="пользователей")
+    parser.add_argument("--updates", type=int, default=20, help="обновлений от каждого пользователя")
+    parser.add_argument("--clients", type=int, default=32, help="одновременных HTTP-запросов к webhook")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать ответов бота, с")
+    parser.add_argument("--first-user", type=int, default=700000, help="первый id пользователя")
+    args = parser.parse_args()
+    args.tmp = tempfile.mkdtemp(prefix="bench_workers_")
+
+    servers = FakeServers(TOKEN, latency=args.latency)
+    servers.start()
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    print(f"{args.users} пользователей × {args.updates} обновлений, {args.clients} клиентов, "
+          f"ядер: {os.cpu_count()}")
+    print(f"  {'процессов':>9} {'обновл.':>7} {'ответов':>7} {'upd/s':>8} {'speedup':>8} {'post p95':>9}")
+    try:
+        asyncio.run(run(args, servers))
+    finally:
+        servers.stop()
+
+
+if __name__ == "__main__":
+    main()
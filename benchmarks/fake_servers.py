@@ -0,0 +1,413 @@
+"""
+Локальные заменители Telegram Bot API и REST API Яндекс.Диска для бенчмарков.
+
+Один HTTP-сервер (tornado) в отдельном потоке со своим циклом событий, чтобы
+работа «серверов» не отнимала время у цикла событий бота:
+
+  /bot<token>/<method>       — Bot API: getMe, getFile, sendMessage, editMessageText и прочие;
+  /file/bot<token>/<path>    — скачивание файлов (поддерживает Range);
+  /v1/disk...                — Яндекс.Диск: информация о диске, метаданные и содержимое папок,
+                               создание папок, удаление, копирование, ссылки на загрузку и скачивание;
+  /upload/<id>, /download/<id> — передача содержимого по этим ссылкам.
+
+Параметры: задержка ответа (latency), пропускная способность одной передачи (bandwidth, байт/с),
+доля ответов 503 от Яндекс.Диска (error_rate) и размер диска (quota; при переполнении — 507).
+
+Использование:
+    servers = FakeServers(token, latency=0.05, bandwidth=20 * 1024 ** 2)
+    servers.start()
+    servers.configure_yadisk()
+    app = ApplicationBuilder().token(token).base_url(servers.base_url).base_file_url(servers.base_file_url)...
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import posixpath
+import random
+import socket
+import threading
+import time
+from typing import Optional
+from urllib.parse import unquote
+
+import tornado.httpserver
+import tornado.web
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _disk_path(path: str) -> str:
+    path = unquote(path)
+    if path.startswith("disk:"):
+        path = path[5:]
+    return "/" + path.strip("/") if path.strip("/") else "/"
+
+
+class FakeState:
+    """Содержимое «серверов» и журнал запросов (общие для потоков)"""
+
+    def __init__(self, quota: int):
+        self.quota = quota
+        self.tg_files: dict = {}  # file_id -> (file_unique_id, file_path, data)
+        self.tg_paths: dict = {}  # file_path -> data
+        self.files: dict = {}  # путь на диске -> bytes
+        self.dirs: set = {"/"}
+        self.links: dict = {}  # id ссылки -> путь
+        self.uploads: dict = {}  # md5 -> время завершения загрузки (time.perf_counter)
+        self.sent: list = []  # (время, метод, параметры) исходящих сообщений бота
+        self.requests: dict = {}  # счетчики запросов по имени
+        self.errors_injected = 0
+        self._ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    @property
+    def used(self) -> int:
+        return sum(len(data) for data in self.files.values())
+
+
+class _Handler(tornado.web.RequestHandler):
+    def initialize(self, servers: "FakeServers") -> None:
+        self.servers = servers
+        self.state = servers.state
+
+    def json(self, status: int, payload) -> None:
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload))
+
+    def disk_error(self, status: int, error: str, message: str = "") -> None:
+        self.json(status, {"error": error, "description": message or error, "message": message or error})
+
+    async def delay(self) -> None:
+        if self.servers.latency:
+            await asyncio.sleep(self.servers.latency)
+
+    def inject_error(self) -> bool:
+        """Случайный 503 от Яндекс.Диска (error_rate)"""
+        if self.servers.error_rate and random.random() < self.servers.error_rate:
+            self.state.errors_injected += 1
+            self.disk_error(503, "ServiceUnavailable", "Сервис временно недоступен")
+            return True
+        return False
+
+    async def throttle(self, size: int) -> None:
+        if self.servers.bandwidth:
+            await asyncio.sleep(size / self.servers.bandwidth)
+
+    def log_exception(self, typ, value, tb) -> None:
+        # Разрыв соединения клиентом — обычное дело при отмене задачи
+        pass
+
+
+class BotApiHandler(_Handler):
+    """Bot API: ответы в формате {"ok": true, "result": ...}"""
+
+    def params(self) -> dict:
+        content_type = self.request.headers.get("Content-Type", "")
+        if content_type.startswith("application/json") and self.request.body:
+            return json.loads(self.request.body)
+        return {key: self.get_argument(key) for key in self.request.arguments}
+
+    async def get(self, method: str) -> None:
+        await self.post(method)
+
+    async def post(self, method: str) -> None:
+        await self.delay()
+        self.state.count(f"bot.{method}")
+        params = self.params()
+        handler = getattr(self, f"api_{method}", None)
+        if handler is not None:
+            result = handler(params)
+        elif method.startswith(("send", "edit")):
+            result = self.message(params)
+        else:
+            result = True
+        if method.startswith(("send", "edit", "delete")):
+            self.state.sent.append((time.perf_counter(), method, params))
+        self.json(200, {"ok": True, "result": result})
+
+    def api_getMe(self, params: dict) -> dict:
+        return {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+
+    def api_getFile(self, params: dict) -> dict:
+        file_id = params["file_id"]
+        unique_id, file_path, data = self.state.tg_files[file_id]
+        return {"file_id": file_id, "file_unique_id": unique_id, "file_size": len(data), "file_path": file_path}
+
+    def message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id", 0)) or self.state.next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+
+class TelegramFileHandler(_Handler):
+    async def get(self, file_path: str) -> None:
+        await self.delay()
+        self.state.count("bot.file")
+        data = self.state.tg_paths.get(unquote(file_path))
+        if data is None:
+            self.set_status(404)
+            self.finish()
+            return
+        start = 0
+        range_header = self.request.headers.get("Range")
+        if range_header:
+            start = int(range_header.split("=", 1)[1].split("-", 1)[0])
+            self.set_status(206)
+            self.set_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.set_header("Content-Length", str(len(data) - start))
+        for offset in range(start, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            self.write(chunk)
+            await self.flush()
+            await self.throttle(len(chunk))
+        self.finish()
+
+
+class DiskInfoHandler(_Handler):
+    async def get(self) -> None:
+        await self.delay()
+        self.state.count("disk.info")
+        if self.inject_error():
+            return
+        self.json(200, {"total_space": self.state.quota, "used_space": self.state.used, "trash_size": 0})
+
+
+class ResourcesHandler(_Handler):
+    def resource(self, path: str) -> dict:
+        name = posixpath.basename(path)
+        if path in self.state.dirs:
+            return {"type": "dir", "path": f"disk:{path}", "name": name}
+        data = self.state.files[path]
+        return {
+            "type": "file", "path": f"disk:{path}", "name": name, "size": len(data),
+            "md5": hashlib.md5(data).hexdigest(), "sha256": hashlib.sha256(data).hexdigest(),
+        }
+
+    async def get(self) -> None:
+        await self.delay()
+        self.state.count("disk.get_meta")
+        if self.inject_error():
+            return
+        path = _disk_path(self.get_argument("path"))
+        if path not in self.state.dirs and path not in self.state.files:
+            return self.disk_error(404, "DiskNotFoundError", "Не удалось найти запрошенный ресурс.")
+        meta = self.resource(path)
+        if path in self.state.dirs:
+            limit = int(self.get_argument("limit", "20"))
+            offset = int(self.get_argument("offset", "0"))
+            children = sorted(
+                p for p in itertools.chain(self.state.dirs, self.state.files)
+                if p != path and posixpath.dirname(p) == path
+            )
+            meta["_embedded"] = {
+                "items": [self.resource(p) for p in children[offset:offset + limit]],
+                "limit": limit, "offset": offset, "total": len(children), "path": f"disk:{path}",
+            }
+        self.json(200, meta)
+
+    async def put(self) -> None:
+        await self.delay()
+        self.state.count("disk.mkdir")
+        if self.inject_error():
+            return
+        path = _disk_path(self.get_argument("path"))
+        if path in self.state.dirs:
+            return self.disk_error(409, "DiskPathPointsToExistentDirectoryError", "Папка уже существует.")
+        if posixpath.dirname(path) not in self.state.dirs:
+            return self.disk_error(409, "DiskPathDoesntExistsError", "Родительская папка не существует.")
+        self.state.dirs.add(path)
+        self.json(201, {"href": f"{self.servers.yandex_url}/v1/disk/resources?path={path}", "method": "GET", "templated": False})
+
+    async def delete(self) -> None:
+        await self.delay()
+        self.state.count("disk.remove")
+        if self.inject_error():
+            return
+        path = _disk_path(self.get_argument("path"))
+        if self.state.files.pop(path, None) is None and path not in self.state.dirs:
+            return self.disk_error(404, "DiskNotFoundError", "Не удалось найти запрошенный ресурс.")
+        self.state.dirs.discard(path)
+        self.set_status(204)
+        self.finish()
+
+
+class CopyHandler(_Handler):
+    async def post(self) -> None:
+        await self.delay()
+        self.state.count("disk.copy")
+        if self.inject_error():
+            return
+        source = _disk_path(self.get_argument("from"))
+        target = _disk_path(self.get_argument("path"))
+        if source not in self.state.files:
+            return self.disk_error(404, "DiskNotFoundError", "Не удалось найти запрошенный ресурс.")
+        self.state.files[target] = self.state.files[source]
+        self.json(201, {"href": f"{self.servers.yandex_url}/v1/disk/resources?path={target}", "method": "GET", "templated": False})
+
+
+class LinkHandler(_Handler):
+    """Ссылки на загрузку (/upload) и скачивание (/download)"""
+
+    def initialize(self, servers: "FakeServers", kind: str) -> None:
+        super().initialize(servers)
+        self.kind = kind
+
+    async def get(self) -> None:
+        await self.delay()
+        self.state.count(f"disk.{self.kind}_link")
+        if self.inject_error():
+            return
+        path = _disk_path(self.get_argument("path"))
+        if self.kind == "download" and path not in self.state.files:
+            return self.disk_error(404, "DiskNotFoundError", "Не удалось найти запрошенный ресурс.")
+        if self.kind == "upload" and posixpath.dirname(path) not in self.state.dirs:
+            return self.disk_error(409, "DiskPathDoesntExistsError", "Родительская папка не существует.")
+        link_id = f"{self.state.next_id()}"
+        self.state.links[link_id] = path
+        self.json(200, {"href": f"{self.servers.yandex_url}/{self.kind}/{link_id}", "method": "PUT" if self.kind == "upload" else "GET",
+                        "templated": False, "operation_id": link_id})
+
+
+@tornado.web.stream_request_body
+class UploadHandler(_Handler):
+    def prepare(self) -> None:
+        self.body = bytearray()
+
+    async def data_received(self, chunk: bytes) -> None:
+        self.body += chunk
+        await self.throttle(len(chunk))
+
+    async def put(self, link_id: str) -> None:
+        self.state.count("disk.upload")
+        if self.inject_error():
+            return
+        path = self.state.links.pop(link_id)
+        data = bytes(self.body)
+        if self.state.used - len(self.state.files.get(path, b"")) + len(data) > self.state.quota:
+            return self.disk_error(507, "DiskInsufficientStorageError", "Недостаточно места на диске.")
+        self.state.files[path] = data
+        self.state.uploads[hashlib.md5(data).hexdigest()] = time.perf_counter()
+        self.set_status(201)
+        self.finish()
+
+
+class DownloadHandler(_Handler):
+    async def get(self, link_id: str) -> None:
+        self.state.count("disk.download")
+        data = self.state.files[self.state.links.pop(link_id)]
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            self.write(chunk)
+            await self.flush()
+            await self.throttle(len(chunk))
+        self.finish()
+
+
+class FakeServers:
+    """Сервер-заменитель Telegram Bot API и Яндекс.Диска в отдельном потоке"""
+
+    def __init__(self, token: str, latency: float = 0.0, bandwidth: int = 0,
+                 error_rate: float = 0.0, quota: int = 10 * 1024 ** 3):
+        self.token = token
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.state = FakeState(quota)
+        self.port: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._server: Optional[tornado.httpserver.HTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def base_url(self) -> str:
+        """Для ApplicationBuilder.base_url"""
+        return f"{self.url}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        """Для ApplicationBuilder.base_file_url"""
+        return f"{self.url}/file/bot"
+
+    @property
+    def yandex_url(self) -> str:
+        return self.url
+
+    def _application(self) -> tornado.web.Application:
+        args = {"servers": self}
+        return tornado.web.Application([
+            (r"/bot[^/]+/(\w+)", BotApiHandler, args),
+            (r"/file/bot[^/]+/(.+)", TelegramFileHandler, args),
+            (r"/v1/disk/?", DiskInfoHandler, args),
+            (r"/v1/disk/resources/?", ResourcesHandler, args),
+            (r"/v1/disk/resources/copy/?", CopyHandler, args),
+            (r"/v1/disk/resources/upload/?", LinkHandler, {**args, "kind": "upload"}),
+            (r"/v1/disk/resources/download/?", LinkHandler, {**args, "kind": "download"}),
+            (r"/upload/(\w+)", UploadHandler, args),
+            (r"/download/(\w+)", DownloadHandler, args),
+        ])
+
+    def start(self) -> None:
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1024)
+        sock.setblocking(False)
+        self.port = sock.getsockname()[1]
+        ready = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = tornado.httpserver.HTTPServer(self._application(), max_body_size=2 ** 31)
+            self._server.add_sockets([sock])
+            self._loop.call_soon(ready.set)
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fake-servers", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def shutdown() -> None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._thread.join(timeout=5)
+        self._loop = None
+
+    def configure_yadisk(self) -> None:
+        """Направляет запросы yadisk на этот сервер"""
+        import yadisk
+        yadisk.settings.BASE_API_URL = self.yandex_url
+
+    def add_telegram_file(self, data: bytes, extension: str) -> dict:
+        """Файл, который бот сможет получить через getFile; возвращает поля для объекта Telegram"""
+        number = self.state.next_id()
+        file_id = f"file{number}"
+        file_path = f"files/{file_id}{extension}"
+        unique_id = hashlib.md5(data).hexdigest()[:16]
+        self.state.tg_files[file_id] = (unique_id, file_path, data)
+        self.state.tg_paths[file_path] = data
+        return {"file_id": file_id, "file_unique_id": unique_id, "file_size": len(data)}
@@ -1,21 +1,50 @@
+import asyncio
+import functools
+import hashlib
 import os
 import logging
 import re
 import signal
 import sys
+import time
 from datetime import datetime
+from typing import Optional
 import uuid
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, filters
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler, filters
 import yadisk
 
+import metrics
+import tracing
+from cache import TTLCache
+from locks import KeyedLock
+from outbound import MERGEABLE, OutboundRateLimiter
+from quota import QuotaTracker
+from storage import YandexStorage
+from transfer import DownloadError, MediaTransfer
+from resilience import CircuitOpenError, ErrorCategory, classify
+from jobs import JobStore
+from ledger import InvoiceLedger
+from dedup import DedupIndex
+from manifest import InvoiceManifests, ManifestIndex
+from state import create_state_store
+from sweeper import SessionSweeper
+from webhook import MetricsServer
+from workers import run_dispatcher
+from pipeline import MEDIA_POLICIES, MediaGroupCollector, MediaPolicy, ProgressMessage, UploadGroup, UploadJob, UploadWorkerPool
+
 # Импортируем конфигурацию
 from config import (
-    TELEGRAM_TOKEN, YANDEX_DISK_TOKEN, BASE_FOLDER, WEBHOOK_URL, PORT,
+    TELEGRAM_TOKEN, YANDEX_DISK_TOKEN, TELEGRAM_BASE_URL, TELEGRAM_BASE_FILE_URL, BASE_FOLDER, WEBHOOK_URL, PORT,
     MAX_FILE_SIZE, MAX_VIDEO_SIZE, MAX_DOCUMENT_SIZE, MAX_PHOTOS_PER_INVOICE, MAX_VIDEOS_PER_INVOICE, MAX_DOCUMENTS_PER_INVOICE,
     SUPPORTED_PHOTO_FORMATS, SUPPORTED_VIDEO_FORMATS, SUPPORTED_DOCUMENT_FORMATS, INVOICE_PATTERN,
     ADMIN_IDS, ERROR_MESSAGES, SUCCESS_MESSAGES, INFO_MESSAGES,
-    INACTIVITY_TIMEOUT_SECONDS
+    INACTIVITY_TIMEOUT_SECONDS, SESSION_EXPIRY_NOTIFY,
+    ACL_REFRESH_MIN_INTERVAL, ACL_DENIED_TTL, ACL_DENIED_CACHE_SIZE, STARTUP_READY_TIMEOUT,
+    DEDUP_ENABLED, DEDUP_SCOPE, DEDUP_LIST_PAGE_SIZE, SPOOL_MAX_AGE, TRACE_SAMPLE_RATE, TEMP_DIR,
+    SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, WEBHOOK_WORKERS, CONCURRENT_UPDATES, CONCURRENT_UPDATES_WAITING,
+    MANIFEST_ENABLED, MANIFEST_NAME, JOB_POLL_INTERVAL
 )
 
 # Компилируем регулярное выражение для валидации накладных
@@ -32,92 +61,121 @@ logger = logging.getLogger(__name__)
 # Флаг для корректного завершения
 shutdown_flag = False
 
-# Список разрешенных пользователей (замените на реальные ID)
-ALLOWED_USERS = [
+# Список разрешенных пользователей (замените на реальные ID).
+# Неизменяемый снимок: при обновлении заменяется целиком, проверка доступа — поиск в множестве
+ALLOWED_USERS = frozenset({
     177611260,  # Замените на реальные ID пользователей
-]
+})
+ADMIN_USERS = frozenset(ADMIN_IDS)
 
 # Файл для хранения разрешенных пользователей (локально и на Яндекс.Диске)
 USERS_FILE = os.path.join(os.path.dirname(__file__), "allowed_users.txt")
 REMOTE_USERS_PATH = f"/{BASE_FOLDER}/allowed_users.txt"
 
-# Вспомогательная функция: загрузить текст на Яндекс.Диск через временный файл
-def upload_text_to_yandex(remote_path: str, content: str) -> None:
-    temp_path = f"/tmp/upload_text_{uuid.uuid4().hex}.txt"
-    with open(temp_path, 'w', encoding='utf-8') as tf:
-        tf.write(content)
-    try:
-        y.upload(temp_path, remote_path, overwrite=True)
-    finally:
-        try:
-            os.remove(temp_path)
-        except Exception:
-            pass
+# md5 удаленного списка, из которого построен ALLOWED_USERS, и время последней проверки
+remote_users_md5 = None
+remote_users_checked_at = 0.0
+acl_refresh_lock = asyncio.Lock()
+# Записи списка пользователей по очереди: иначе при одновременных /adduser последней может записаться устаревшая копия
+acl_save_lock = asyncio.Lock()
+
+# Недавно получившие отказ пользователи: их сообщения не вызывают обновления списка
+denied_users = TTLCache("acl_denied", ACL_DENIED_CACHE_SIZE, ACL_DENIED_TTL)
+
+def parse_allowed_users(lines) -> frozenset:
+    return frozenset(int(line.strip()) for line in lines if line.strip().isdigit())
+
+def set_allowed_users(users, md5: str = None) -> None:
+    """Заменяет снимок разрешенных пользователей"""
+    global ALLOWED_USERS, remote_users_md5
+    ALLOWED_USERS = frozenset(users)
+    if md5 is not None:
+        remote_users_md5 = md5
+    denied_users.clear()
+
+async def fetch_remote_allowed_users(known_md5: str = None):
+    """
+    Читает список пользователей с Яндекс.Диска.
+    Возвращает (users, md5); users равен None, если md5 совпал с known_md5 (файл не скачивается).
+    Выбрасывает PathNotFoundError, если файла нет.
+    """
+    meta = await storage.get_meta(REMOTE_USERS_PATH)
+    if known_md5 is not None and meta.md5 == known_md5:
+        return None, meta.md5
+    users = parse_allowed_users((await storage.read_text(REMOTE_USERS_PATH)).splitlines())
+    return users, meta.md5
 
 # Ленивая синхронизация разрешенных пользователей с Яндекс.Диска
-def refresh_allowed_users_from_remote() -> bool:
-    """Пробует обновить ALLOWED_USERS с удаленного файла, если он существует. Возвращает True при успехе."""
-    try:
-        if y.exists(REMOTE_USERS_PATH):
-            temp_path = f"/tmp/allowed_users_{uuid.uuid4().hex}.txt"
-            y.download(REMOTE_USERS_PATH, temp_path)
-            with open(temp_path, 'r', encoding='utf-8') as f:
-                users = [int(line.strip()) for line in f if line.strip().isdigit()]
-            try:
-                os.remove(temp_path)
-            except Exception:
-                pass
-            if users:
-                global ALLOWED_USERS
-                ALLOWED_USERS = sorted(set(users))
-                logger.info(f"🔄 Обновлен список разрешенных пользователей из удаленного файла: {len(ALLOWED_USERS)}")
-            return True
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось обновить список разрешенных пользователей с Яндекс.Диска: {e}")
-    return False
+async def refresh_allowed_users_from_remote(force: bool = False) -> bool:
+    """
+    Обновляет ALLOWED_USERS из удаленного файла, если он изменился.
+    Проверка выполняется не чаще раза в ACL_REFRESH_MIN_INTERVAL секунд (если не force),
+    файл скачивается только при изменении md5. Возвращает True, если список обновлен.
+    """
+    global remote_users_checked_at
+    async with acl_refresh_lock:
+        now = time.monotonic()
+        if not force and now - remote_users_checked_at < ACL_REFRESH_MIN_INTERVAL:
+            metrics.inc("acl_refresh_total", result="throttled")
+            return False
+        remote_users_checked_at = now
+        try:
+            users, md5 = await fetch_remote_allowed_users(remote_users_md5)
+        except yadisk.exceptions.PathNotFoundError:
+            metrics.inc("acl_refresh_total", result="missing")
+            return False
+        except Exception as e:
+            metrics.inc("acl_refresh_total", result="error")
+            logger.warning(f"⚠️ Не удалось обновить список разрешенных пользователей с Яндекс.Диска: {e}")
+            return False
+        if users is None:
+            metrics.inc("acl_refresh_total", result="unchanged")
+            return False
+        if users:
+            set_allowed_users(users, md5)
+            logger.info(f"🔄 Обновлен список разрешенных пользователей из удаленного файла: {len(ALLOWED_USERS)}")
+        metrics.inc("acl_refresh_total", result="updated")
+        return True
 
-def load_allowed_users() -> list:
+async def load_allowed_users() -> frozenset:
     """Загружает список разрешенных пользователей (приоритет: Яндекс.Диск → локально)"""
+    global remote_users_md5, remote_users_checked_at
     try:
         # 1) Пробуем загрузить с Яндекс.Диска
         try:
-            if y.exists(REMOTE_USERS_PATH):
-                temp_path = f"/tmp/allowed_users_{uuid.uuid4().hex}.txt"
-                y.download(REMOTE_USERS_PATH, temp_path)
-                with open(temp_path, 'r', encoding='utf-8') as f:
-                    users = [int(line.strip()) for line in f if line.strip().isdigit()]
-                try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
-                logger.info(f"✅ Загружено {len(users)} разрешенных пользователей с Яндекс.Диска")
-                # Также обновим локальную копию для отладки (не критично, может не сохраниться)
-                try:
-                    with open(USERS_FILE, 'w', encoding='utf-8') as lf:
-                        for uid in sorted(users):
-                            lf.write(f"{uid}\n")
-                except Exception:
-                    pass
-                return users
+            users, md5 = await fetch_remote_allowed_users()
+            remote_users_md5 = md5
+            remote_users_checked_at = time.monotonic()
+            logger.info(f"✅ Загружено {len(users)} разрешенных пользователей с Яндекс.Диска")
+            # Также обновим локальную копию для отладки (не критично, может не сохраниться)
+            try:
+                with open(USERS_FILE, 'w', encoding='utf-8') as lf:
+                    for uid in sorted(users):
+                        lf.write(f"{uid}\n")
+            except Exception:
+                pass
+            return users
+        except yadisk.exceptions.PathNotFoundError:
+            pass
         except Exception as remote_err:
             logger.warning(f"⚠️ Не удалось загрузить список пользователей с Яндекс.Диска: {remote_err}")
 
         # 2) Фоллбэк: пробуем локально
         if os.path.exists(USERS_FILE):
             with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                users = [int(line.strip()) for line in f if line.strip().isdigit()]
+                users = parse_allowed_users(f)
             logger.info(f"✅ Загружено {len(users)} разрешенных пользователей (локально)")
             return users
 
         # 3) Нет ни удаленного, ни локального — создаем удаленный файл с базовым списком
-        save_allowed_users(ALLOWED_USERS)
-        return ALLOWED_USERS.copy()
+        await save_allowed_users(ALLOWED_USERS)
+        return ALLOWED_USERS
 
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки пользователей: {e}")
-        return ALLOWED_USERS.copy()
+        return ALLOWED_USERS
 
-def save_allowed_users(users: list) -> bool:
+async def save_allowed_users(users) -> bool:
     """Сохраняет список разрешенных пользователей (Яндекс.Диск + локальная копия при возможности)"""
     try:
         # Готовим содержимое
@@ -126,10 +184,11 @@ def save_allowed_users(users: list) -> bool:
         # 1) Сохраняем на Яндекс.Диск
         try:
             # Убедимся, что базовая папка существует
-            base_folder_path = f"/{BASE_FOLDER}"
-            if not y.exists(base_folder_path):
-                y.mkdir(base_folder_path)
-            upload_text_to_yandex(REMOTE_USERS_PATH, content)
+            await storage.ensure_folder(f"/{BASE_FOLDER}")
+            await storage.write_text(REMOTE_USERS_PATH, content)
+            # Свою запись не нужно скачивать обратно при следующей проверке
+            global remote_users_md5
+            remote_users_md5 = hashlib.md5(content.encode('utf-8')).hexdigest()
             logger.info(f"✅ Список пользователей сохранен на Яндекс.Диске: {REMOTE_USERS_PATH}")
         except Exception as remote_err:
             logger.error(f"❌ Не удалось сохранить список пользователей на Яндекс.Диск: {remote_err}")
@@ -147,22 +206,22 @@ def save_allowed_users(users: list) -> bool:
         logger.error(f"❌ Ошибка сохранения пользователей: {e}")
         return False
 
-def add_user_access(user_id: int) -> bool:
+async def add_user_access(user_id: int) -> bool:
     """Добавляет пользователя в список разрешенных"""
-    global ALLOWED_USERS
     if user_id not in ALLOWED_USERS:
-        ALLOWED_USERS.append(user_id)
-        save_allowed_users(ALLOWED_USERS)
+        set_allowed_users(ALLOWED_USERS | {user_id})
+        async with acl_save_lock:
+            await save_allowed_users(ALLOWED_USERS)
         logger.info(f"✅ Добавлен доступ для пользователя {user_id}")
         return True
     return False
 
-def remove_user_access(user_id: int) -> bool:
+async def remove_user_access(user_id: int) -> bool:
     """Удаляет пользователя из списка разрешенных"""
-    global ALLOWED_USERS
     if user_id in ALLOWED_USERS:
-        ALLOWED_USERS.remove(user_id)
-        save_allowed_users(ALLOWED_USERS)
+        set_allowed_users(ALLOWED_USERS - {user_id})
+        async with acl_save_lock:
+            await save_allowed_users(ALLOWED_USERS)
         logger.info(f"✅ Удален доступ для пользователя {user_id}")
         return True
     return False
@@ -170,7 +229,7 @@ def remove_user_access(user_id: int) -> bool:
 def is_user_allowed(user_id: int) -> bool:
     """Проверяет, имеет ли пользователь доступ к боту"""
     # Администраторы всегда имеют доступ
-    return user_id in ALLOWED_USERS or user_id in ADMIN_IDS
+    return user_id in ALLOWED_USERS or user_id in ADMIN_USERS
 
 def signal_handler(signum, _):
     """Обработчик сигналов для корректного завершения"""
@@ -198,109 +257,64 @@ if not YANDEX_DISK_TOKEN:
 
 logger.info("✅ Все необходимые токены найдены")
 
-def get_disk_info_safe():
-    """Безопасно получает информацию о диске"""
+# Подключение к Яндекс.Диску (асинхронный клиент с пулом соединений)
+storage = YandexStorage(YANDEX_DISK_TOKEN)
+
+# Свободное место на диске (обновляется по таймеру, уменьшается на размер загруженных файлов)
+quota = QuotaTracker(storage, f"/{BASE_FOLDER}")
+
+# Перенос файлов из Telegram на Яндекс.Диск
+media_transfer = MediaTransfer(storage)
+# Ограничение частоты и объединение исходящих сообщений
+# Общий лимит Telegram делится между процессами-обработчиками
+outbound_limiter = OutboundRateLimiter(
+    global_rate=SEND_GLOBAL_RATE / WEBHOOK_WORKERS, global_burst=max(1, SEND_GLOBAL_BURST // WEBHOOK_WORKERS)
+)
+
+# Логируем версию библиотеки
+try:
+    logger.info(f"📦 Версия библиотеки yadisk: {yadisk.__version__}, режим клиента: {storage.mode}")
+except AttributeError:
+    logger.info(f"📦 Версия библиотеки yadisk: неизвестна, режим клиента: {storage.mode}")
+
+async def check_yandex_connection() -> None:
+    """Проверяет подключение к Яндекс.Диску и наличие базовой папки"""
     try:
-        disk_info = y.get_disk_info()
-        
-        # Пытаемся получить информацию разными способами
-        if hasattr(disk_info, 'space') and hasattr(disk_info.space, 'free'):
-            return {
-                'free': disk_info.space.free,
-                'total': disk_info.space.total,
-                'available': True
-            }
-        elif hasattr(disk_info, 'free'):
-            return {
-                'free': disk_info.free,
-                'total': disk_info.total,
-                'available': True
-            }
-        elif hasattr(disk_info, 'available'):
-            return {
-                'free': disk_info.available,
-                'total': disk_info.total if hasattr(disk_info, 'total') else 0,
-                'available': True
-            }
+        # Проверяем подключение и логируем свободное место (заодно заполняем кэш для /status)
+        await quota.refresh()
+        if quota.available:
+            free_gb = quota.free // (1024**3)
+            logger.info(f"✅ Подключение к Яндекс.Диску установлено. Свободно: {free_gb}GB")
         else:
-            logger.warning(f"⚠️ Неизвестная структура ответа API: {type(disk_info)}")
-            return {
-                'free': 0,
-                'total': 0,
-                'available': False
-            }
+            logger.warning("⚠️ Не удалось определить свободное место на диске")
+
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении информации о диске: {e}")
-        return {
-            'free': 0,
-            'total': 0,
-            'available': False
-        }
-
-# Подключение к Яндекс.Диску
-try:
-    y = yadisk.YaDisk(token=YANDEX_DISK_TOKEN)
-    
-    # Логируем версию библиотеки
+        logger.error(f"❌ Ошибка подключения к Яндекс.Диску: {e}")
+        raise
+
+    # Проверяем и создаем базовую папку при запуске
     try:
-        logger.info(f"📦 Версия библиотеки yadisk: {yadisk.__version__}")
-    except AttributeError:
-        logger.info("📦 Версия библиотеки yadisk: неизвестна")
-    
-    # Проверяем подключение и логируем базовую информацию
-    raw_info = y.get_disk_info()
-    logger.info(f"📊 Структура ответа API: {type(raw_info)}")
-    logger.info(f"📊 Атрибуты объекта: {dir(raw_info)}")
-    safe_info = get_disk_info_safe()
-    if safe_info['available']:
-        free_gb = safe_info['free'] // (1024**3)
-        logger.info(f"✅ Подключение к Яндекс.Диску установлено. Свободно: {free_gb}GB")
-    else:
-        logger.warning("⚠️ Не удалось определить свободное место на диске")
-            
-except Exception as e:
-    logger.error(f"❌ Ошибка подключения к Яндекс.Диску: {e}")
-    raise
+        base_folder_path = f"/{BASE_FOLDER}"
+        if await storage.ensure_folder(base_folder_path):
+            logger.info(f"✅ Создана базовая папка: {base_folder_path}")
+        else:
+            logger.info(f"📁 Базовая папка уже существует: {base_folder_path}")
+        quota.base_folder_exists = True
+    except Exception as e:
+        logger.error(f"❌ Ошибка при создании базовой папки: {e}")
+        raise
 
-# Основные папки
-# BASE_FOLDER = "Фото оборудования"
+# Состояние пользователей (накладные, активность, счетчики файлов) и статистика использования
+state = create_state_store()
+# Резервы мест в накладных под файлы, которые еще загружаются
+ledger = InvoiceLedger(state)
+# Накопленная статистика (как в /stats) видна и в /metrics
+for stat_key in ("total_photos", "total_videos", "total_documents", "total_invoices",
+                 "duplicates_skipped", "duplicate_bytes_saved", "errors"):
+    metrics.register_gauge("bot_stat", functools.partial(state.get_stat, stat_key), stat=stat_key)
 
-# Проверяем и создаем базовую папку при запуске
-try:
-    base_folder_path = f"/{BASE_FOLDER}"
-    if not y.exists(base_folder_path):
-        y.mkdir(base_folder_path)
-        logger.info(f"✅ Создана базовая папка: {base_folder_path}")
-    else:
-        logger.info(f"📁 Базовая папка уже существует: {base_folder_path}")
-except Exception as e:
-    logger.error(f"❌ Ошибка при создании базовой папки: {e}")
-    raise
-
-# Хранение состояния пользователя (номер накладной)
-user_invoice = {}
-
-# Время последней активности пользователя
-user_last_activity = {}
-
-# Хранение количества фото для каждой накладной
-invoice_photo_count = {}
-
-# Хранение количества видео для каждой накладной
-invoice_video_count = {}
-
-# Хранение количества документов для каждой накладной
-invoice_document_count = {}
-
-# Статистика использования
-bot_stats = {
-    "total_photos": 0,
-    "total_videos": 0,
-    "total_documents": 0,
-    "total_invoices": 0,
-    "errors": 0,
-    "start_time": datetime.now()
-}
+# Время запуска бота
+bot_start_time = datetime.now()
 
 
 def get_effective_message(update: Update):
@@ -321,7 +335,7 @@ def get_user_id(update: Update) -> int | None:
 
 def get_main_menu_keyboard(user_id: int | None = None) -> InlineKeyboardMarkup:
     """Основное меню бота с inline-кнопками."""
-    has_invoice = user_id is not None and user_id in user_invoice
+    has_invoice = user_id is not None and state.get_invoice(user_id) is not None
 
     if not has_invoice:
         return InlineKeyboardMarkup([
@@ -361,7 +375,7 @@ def format_file_size(size_bytes: int) -> str:
 
 def get_uptime() -> str:
     """Возвращает время работы бота"""
-    uptime = datetime.now() - bot_stats["start_time"]
+    uptime = datetime.now() - bot_start_time
     days = uptime.days
     hours, remainder = divmod(uptime.seconds, 3600)
     minutes, _ = divmod(remainder, 60)
@@ -381,29 +395,33 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uptime = get_uptime()
-    active_users = len(user_invoice)
+    sessions = state.sessions()
+    active_users = len(sessions)
     
     # Подсчитываем общее количество уникальных накладных
-    unique_invoices = len(set(user_invoice.values()))
+    unique_invoices = len(set(sessions.values()))
     
     # Подсчитываем общее количество фото, видео и документов по всем накладным
-    total_photos_in_invoices = sum(invoice_photo_count.values())
-    total_videos_in_invoices = sum(invoice_video_count.values())
-    total_documents_in_invoices = sum(invoice_document_count.values())
+    totals = state.count_totals()
+    total_photos_in_invoices = totals["photo"]
+    total_videos_in_invoices = totals["video"]
+    total_documents_in_invoices = totals["document"]
     
     stats_text = (
         f"📊 **Статистика бота**\n\n"
         f"⏱️ Время работы: {uptime}\n"
         f"👥 Активных пользователей: {active_users}\n"
         f"📋 Активных накладных: {unique_invoices}\n"
-        f"📸 Всего загружено фото: {bot_stats['total_photos']}\n"
-        f"🎥 Всего загружено видео: {bot_stats['total_videos']}\n"
-        f"📄 Всего загружено документов: {bot_stats['total_documents']}\n"
+        f"📸 Всего загружено фото: {state.get_stat('total_photos')}\n"
+        f"🎥 Всего загружено видео: {state.get_stat('total_videos')}\n"
+        f"📄 Всего загружено документов: {state.get_stat('total_documents')}\n"
         f"📸 Фото в накладных: {total_photos_in_invoices}\n"
         f"🎥 Видео в накладных: {total_videos_in_invoices}\n"
         f"📄 Документы в накладных: {total_documents_in_invoices}\n"
-        f"📋 Всего накладных: {bot_stats['total_invoices']}\n"
-        f"❌ Ошибок: {bot_stats['errors']}\n\n"
+        f"📋 Всего накладных: {state.get_stat('total_invoices')}\n"
+        f"♻️ Пропущено дубликатов: {state.get_stat('duplicates_skipped')} "
+        f"({format_file_size(state.get_stat('duplicate_bytes_saved'))})\n"
+        f"❌ Ошибок: {state.get_stat('errors')}\n\n"
         f"🔄 Используйте /reset для сброса накладной\n"
         f"🔍 Используйте /status для проверки сервисов"
     )
@@ -435,6 +453,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• /adduser <ID> - Добавить пользователя в список разрешенных\n"
         f"• /removeuser <ID> - Удалить пользователя из списка разрешенных\n"
         f"• /listusers - Показать список всех разрешенных пользователей\n"
+        f"• /failed - Неудачные загрузки\n"
+        f"• /requeue <ID> - Повторить неудачную загрузку\n"
+        f"• /reindex [накладная] - Перестроить индекс дубликатов\n"
+        f"• /manifests [накладная] - Перестроить манифесты накладных\n"
+        f"• /slow - Самые медленные этапы обработки\n"
         f"• /cleanup - Очистка временных файлов\n\n"
         f"📋 **Как использовать:**\n"
         f"1. Отправьте /start\n"
@@ -480,42 +503,65 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning("Не удалось определить сообщение для ответа в status")
             return
 
-        # Проверяем подключение к Яндекс.Диску
-        disk_info = get_disk_info_safe()
-        
-        # Проверяем доступность базовой папки
-        base_folder_exists = y.exists(f"/{BASE_FOLDER}")
-        
+        # Место на диске и наличие базовой папки берем из кэша; устаревший кэш обновится в фоне
+        if quota.stale:
+            quota.refresh_in_background()
+        base_folder_exists = quota.base_folder_exists
+        if base_folder_exists is None:
+            base_folder_state = 'Не проверена'
+        else:
+            base_folder_state = 'Существует' if base_folder_exists else 'Не найдена'
+
         status_text = (
             f"🔍 **Статус бота**\n\n"
             f"✅ **Telegram Bot**: Активен\n"
-            f"✅ **Яндекс.Диск**: Подключен\n"
-            f"📁 **Базовая папка**: {'Существует' if base_folder_exists else 'Не найдена'}\n\n"
+            f"{'✅' if quota.available else '⚠️'} **Яндекс.Диск**: {'Подключен' if quota.available else 'Нет данных'}\n"
+            f"📁 **Базовая папка**: {base_folder_state}\n\n"
         )
         
-        if disk_info['available']:
-            free_space = format_file_size(disk_info['free'])
-            total_space = format_file_size(disk_info['total'])
+        if quota.available:
             used_percent = 0
-            if disk_info['total'] > 0:
-                used_percent = round((disk_info['total'] - disk_info['free']) / disk_info['total'] * 100, 1)
+            if quota.total > 0:
+                used_percent = round((quota.total - quota.free) / quota.total * 100, 1)
             
             status_text += (
                 f"💾 **Место на диске:**\n"
-                f"• Свободно: {free_space}\n"
-                f"• Всего: {total_space}\n"
-                f"• Использовано: {used_percent}%\n\n"
+                f"• Свободно: {format_file_size(quota.free)}\n"
+                f"• Всего: {format_file_size(quota.total)}\n"
+                f"• Использовано: {used_percent}%\n"
+                f"• Ожидает загрузки: {format_file_size(upload_pool.pending_bytes)}\n"
+                f"• Обновлено: {quota.refreshed_at.strftime('%d.%m.%Y %H:%M:%S')}\n\n"
             )
         else:
             status_text += "💾 **Место на диске:** Информация недоступна\n\n"
         
+        breaker = storage.breaker.snapshot()
+        breaker_state = {"closed": "✅ Замкнут", "half_open": "🔄 Пробный запрос", "open": "⛔ Разомкнут"}
+        status_text += (
+            f"🔌 **Запросы к Яндекс.Диску:**\n"
+            f"• Выключатель: {breaker_state[breaker['state']]}\n"
+            f"• Ошибок подряд: {breaker['failures']}\n"
+            f"• Повторов: {int(metrics.total_counter('yandex_retries_total'))}\n"
+            f"• Отклонено выключателем: {breaker['rejections']}\n\n"
+        )
+
+        folder_cache = storage.folders.stats()
         status_text += (
             f"📊 **Статистика:**\n"
-            f"• Фото: {bot_stats['total_photos']}\n"
-            f"• Видео: {bot_stats['total_videos']}\n"
-            f"• Документы: {bot_stats['total_documents']}\n"
-            f"• Накладные: {bot_stats['total_invoices']}\n"
-            f"• Ошибки: {bot_stats['errors']}\n\n"
+            f"• Фото: {state.get_stat('total_photos')}\n"
+            f"• Видео: {state.get_stat('total_videos')}\n"
+            f"• Документы: {state.get_stat('total_documents')}\n"
+            f"• Накладные: {state.get_stat('total_invoices')}\n"
+            f"• Дубликаты: {state.get_stat('duplicates_skipped')}\n"
+            f"• Ошибки: {state.get_stat('errors')}\n\n"
+            f"🗂️ **Кэш папок:**\n"
+            f"• Записей: {folder_cache['size']}\n"
+            f"• Попаданий: {folder_cache['hits']}\n"
+            f"• Промахов: {folder_cache['misses']}\n\n"
+            f"📤 **Исходящие сообщения:**\n"
+            f"• В очереди: {outbound_limiter.queue_depth}\n"
+            f"• Объединено: {int(metrics.get_counter('outbound_merged_total'))}\n"
+            f"• Повторов после RetryAfter: {int(metrics.get_counter('outbound_retry_after_total', endpoint='sendMessage'))}\n\n"
             f"⚙️ **Настройки:**\n"
             f"• Максимальный размер видео: {format_file_size(MAX_VIDEO_SIZE)}\n"
             f"• Максимальный размер документов: {format_file_size(MAX_DOCUMENT_SIZE)}\n"
@@ -551,20 +597,23 @@ async def current_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.effective_user.id
     
-    if user_id not in user_invoice:
+    invoice_number = state.get_invoice(user_id)
+    if invoice_number is None:
         await message.reply_text(
             "ℹ️ У вас нет активной накладной.\n\nИспользуйте /start для начала работы.",
             reply_markup=get_main_menu_keyboard(get_user_id(update))
         )
         return
     
-    invoice_number = user_invoice[user_id]
-    photo_count = invoice_photo_count.get(invoice_number, 0)
-    video_count = invoice_video_count.get(invoice_number, 0)
-    document_count = invoice_document_count.get(invoice_number, 0)
-    remaining_photos = MAX_PHOTOS_PER_INVOICE - photo_count
-    remaining_videos = MAX_VIDEOS_PER_INVOICE - video_count
-    remaining_documents = MAX_DOCUMENTS_PER_INVOICE - document_count
+    counts = state.get_counts(user_id, invoice_number)
+    photo_count = counts["photo"]
+    video_count = counts["video"]
+    document_count = counts["document"]
+    # Файлы в очереди загрузки уже заняли места в накладной
+    reserved = ledger.reservations(user_id, invoice_number)
+    remaining_photos = MAX_PHOTOS_PER_INVOICE - photo_count - reserved["photo"]
+    remaining_videos = MAX_VIDEOS_PER_INVOICE - video_count - reserved["video"]
+    remaining_documents = MAX_DOCUMENTS_PER_INVOICE - document_count - reserved["document"]
     
     invoice_info = (
         f"📋 **Текущая накладная**\n\n"
@@ -572,13 +621,20 @@ async def current_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📸 Загружено фото: {photo_count}\n"
         f"🎥 Загружено видео: {video_count}\n"
         f"📄 Загружено документов: {document_count}\n"
+    )
+    if any(reserved.values()):
+        invoice_info += (
+            f"⏳ Загружается: {reserved['photo']} фото, {reserved['video']} видео, "
+            f"{reserved['document']} документов\n"
+        )
+    invoice_info += (
         f"📸 Осталось фото: {remaining_photos}\n"
         f"🎥 Осталось видео: {remaining_videos}\n"
         f"📄 Осталось документов: {remaining_documents}\n"
         f"📁 Папка: {BASE_FOLDER}/{get_safe_folder_name(invoice_number)}\n\n"
     )
     
-    if photo_count == 0 and video_count == 0 and document_count == 0:
+    if photo_count == 0 and video_count == 0 and document_count == 0 and not any(reserved.values()):
         invoice_info += f"📸 Отправьте первое фото, видео или документ оборудования"
     elif remaining_photos <= 0 and remaining_videos <= 0 and remaining_documents <= 0:
         invoice_info += "❌ Достигнут лимит файлов\nИспользуйте /reset для новой накладной"
@@ -595,31 +651,45 @@ async def current_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def is_session_expired(user_id: int) -> bool:
     """Проверяет, истекла ли сессия пользователя по таймауту бездействия."""
-    last = user_last_activity.get(user_id)
+    last = state.get_activity(user_id)
     if not last:
         return False
     return (datetime.now() - last).total_seconds() > INACTIVITY_TIMEOUT_SECONDS
 
 def reset_user_session(user_id: int) -> tuple[bool, str, int, int, int]:
     """Сбрасывает накладную пользователя. Возвращает (was_active, invoice, photo_count, video_count, document_count)."""
-    if user_id in user_invoice:
-        old_invoice = user_invoice[user_id]
-        old_photo_count = invoice_photo_count.get(old_invoice, 0)
-        old_video_count = invoice_video_count.get(old_invoice, 0)
-        old_document_count = invoice_document_count.get(old_invoice, 0)
-        del user_invoice[user_id]
-        if old_invoice in invoice_photo_count:
-            del invoice_photo_count[old_invoice]
-        if old_invoice in invoice_video_count:
-            del invoice_video_count[old_invoice]
-        if old_invoice in invoice_document_count:
-            del invoice_document_count[old_invoice]
-        return True, old_invoice, old_photo_count, old_video_count, old_document_count
-    return False, "", 0, 0, 0
+    ended = state.end_session(user_id)
+    if ended is None:
+        return False, "", 0, 0, 0
+    old_invoice, old_counts = ended
+    storage.forget_folder(f"/{BASE_FOLDER}/{get_safe_folder_name(old_invoice)}")
+    return True, old_invoice, old_counts["photo"], old_counts["video"], old_counts["document"]
 
 def touch_activity(user_id: int) -> None:
     """Обновляет время последней активности пользователя."""
-    user_last_activity[user_id] = datetime.now()
+    now = datetime.now()
+    state.touch(user_id, now)
+    session_sweeper.touch(user_id, now.timestamp())
+
+async def expire_session(user_id: int, bot) -> None:
+    """Сбрасывает накладную по таймауту бездействия и забывает неактивного пользователя (вызывается SessionSweeper)"""
+    # Не посреди обработки сообщения этого пользователя
+    async with update_locks.hold(user_id):
+        # Пока ждали блокировку, пользователь мог прислать сообщение — тогда сессия продолжается
+        last = state.get_activity(user_id)
+        if last is not None and not is_session_expired(user_id):
+            session_sweeper.touch(user_id, last.timestamp())
+            return
+        was_active, old_invoice, old_photo_count, old_video_count, old_document_count = reset_user_session(user_id)
+        state.forget_user(user_id)
+    if not was_active:
+        return
+    logger.info(f"⏳ Накладная '{old_invoice}' пользователя {user_id} сброшена по таймауту бездействия")
+    if SESSION_EXPIRY_NOTIFY:
+        await bot.send_message(user_id, INFO_MESSAGES["session_expired"])
+
+# Истечение сессий по таймеру
+session_sweeper = SessionSweeper(expire_session)
 
 def validate_invoice_number(invoice: str) -> tuple[bool, str]:
     """
@@ -660,6 +730,19 @@ def get_safe_folder_name(invoice: str) -> str:
     safe_name = re.sub(r'[<>:"/\\|?*]', '_', invoice)
     return safe_name
 
+def get_invoice_folder_path(invoice: str) -> str:
+    """Путь папки накладной на Яндекс.Диске"""
+    return f"/{BASE_FOLDER}/{get_safe_folder_name(invoice)}"
+
+def get_temp_file_path(file_id: str, file_name: str) -> str:
+    """
+    Временный файл задачи в TEMP_DIR.
+    Имя файла присылает пользователь: оставляем только последнюю часть пути без недопустимых символов
+    и обрезаем с начала, чтобы вместе с file_id оно не превысило лимит длины имени в файловой системе.
+    """
+    safe_name = get_safe_folder_name(os.path.basename(file_name.replace("\\", "/")))
+    return os.path.join(TEMP_DIR, f"{file_id}_{safe_name[-60:]}")
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     touch_activity(user_id)
@@ -684,9 +767,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверка доступа пользователя (с попыткой ленивой синхронизации из удаленного файла)
     if not is_user_allowed(user_id):
-        if refresh_allowed_users_from_remote() and is_user_allowed(user_id):
+        # Недавний отказ кэшируется, чтобы повторные сообщения не обращались к Яндекс.Диску
+        if user_id not in denied_users and await refresh_allowed_users_from_remote() and is_user_allowed(user_id):
             logger.info(f"✅ Пользователь {user_id} получил доступ после синхронизации")
         else:
+            denied_users.set(user_id)
             logger.warning(f"🚫 Пользователь {user_id} не имеет доступа к боту")
             await update.message.reply_text("❌ У вас нет прав для использования бота.")
             return
@@ -703,19 +788,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if user_id not in user_invoice:
-        user_invoice[user_id] = text
-        invoice_photo_count[text] = 0
-        invoice_video_count[text] = 0
-        invoice_document_count[text] = 0
-        bot_stats["total_invoices"] += 1
-        logger.info(f"✅ Создана новая накладная '{text}' для пользователя {user_id}")
-        await update.message.reply_text(
-            f"✅ Накладная '{text}' сохранена.\n\nТеперь пришлите фото, видео или документы оборудования.",
-            reply_markup=get_main_menu_keyboard(user_id)
-        )
+    active_invoice = state.get_invoice(user_id)
+    if active_invoice is None:
+        # Накладная могла быть начата раньше: уже загруженные файлы восстанавливаются из манифеста
+        counts = None
+        if MANIFEST_ENABLED:
+            with tracing.stage("manifest_restore"):
+                counts = await manifests.restore_counts(get_invoice_folder_path(text), text, user_id)
+        state.start_invoice(user_id, text, counts)
+        state.incr_stat("total_invoices")
+        if counts and any(counts.values()):
+            logger.info(f"📒 Продолжена накладная '{text}' пользователя {user_id}: {counts}")
+            await update.message.reply_text(
+                f"✅ Накладная '{text}' продолжена.\n\n"
+                f"📊 Уже загружено: {counts['photo']} фото, {counts['video']} видео, {counts['document']} документов.\n"
+                f"Пришлите фото, видео или документы оборудования.",
+                reply_markup=get_main_menu_keyboard(user_id)
+            )
+        else:
+            logger.info(f"✅ Создана новая накладная '{text}' для пользователя {user_id}")
+            await update.message.reply_text(
+                f"✅ Накладная '{text}' сохранена.\n\nТеперь пришлите фото, видео или документы оборудования.",
+                reply_markup=get_main_menu_keyboard(user_id)
+            )
     else:
-        logger.info(f"📸 Пользователь {user_id} уже имеет активную накладную '{user_invoice[user_id]}'")
+        logger.info(f"📸 Пользователь {user_id} уже имеет активную накладную '{active_invoice}'")
         await update.message.reply_text(
             "📸 Я жду фото, видео или документы, пришлите файл.",
             reply_markup=get_main_menu_keyboard(user_id)
@@ -724,572 +821,643 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обновляем время активности в конце обработки
     touch_activity(user_id)
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
+# Ответы пользователю по категории ошибки Яндекс.Диска
+YADISK_ERROR_MESSAGES = {
+    ErrorCategory.QUOTA: ERROR_MESSAGES["quota_exceeded"],
+    ErrorCategory.AUTH: ERROR_MESSAGES["access_denied"],
+    ErrorCategory.TRANSIENT: ERROR_MESSAGES["network_error"],
+    ErrorCategory.RATE_LIMITED: ERROR_MESSAGES["yandex_rate_limited"],
+    ErrorCategory.UNAVAILABLE: ERROR_MESSAGES["yandex_unavailable"],
+}
+
+def yadisk_error_text(e: Exception, error_msg: str) -> str:
+    """Текст ответа пользователю для ошибки Яндекс.Диска"""
+    text = YADISK_ERROR_MESSAGES.get(classify(e))
+    if text is not None:
+        return text
+    return f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору."
+
+async def require_active_invoice(message) -> Optional[str]:
+    """
+    Проверяет таймаут бездействия и наличие накладной у автора сообщения.
+    Возвращает номер накладной или None (пользователю уже отправлен ответ).
+    """
+    user_id = message.from_user.id
+
     # Проверяем таймаут бездействия
     if is_session_expired(user_id):
         was_active, old_invoice, old_photo_count, old_video_count, old_document_count = reset_user_session(user_id)
         if was_active:
-            await update.message.reply_text(INFO_MESSAGES.get("session_expired"))
+            await message.reply_text(INFO_MESSAGES.get("session_expired"))
         # После сброса просим снова отправить накладную
-        await update.message.reply_text(
+        await message.reply_text(
             "ℹ️ У вас нет активной накладной.\n\nИспользуйте /start для начала работы.",
             reply_markup=get_main_menu_keyboard(user_id)
         )
         touch_activity(user_id)
-        return
-    if user_id not in user_invoice:
-        await update.message.reply_text(
+        return None
+
+    invoice_number = state.get_invoice(user_id)
+    if invoice_number is None:
+        await message.reply_text(
             "❌ Сначала пришлите номер накладной командой /start",
             reply_markup=get_main_menu_keyboard(user_id)
         )
         touch_activity(user_id)
-        return
+        return None
 
-    invoice_number = user_invoice[user_id]
-    
-    # Проверяем лимит фото на накладную
-    current_photo_count = invoice_photo_count.get(invoice_number, 0)
-    if current_photo_count >= MAX_PHOTOS_PER_INVOICE:
-        await update.message.reply_text(
-            f"❌ Достигнут лимит фото для накладной '{invoice_number}'\n\n"
-            f"Максимум: {MAX_PHOTOS_PER_INVOICE} фото\n"
-            f"Текущее количество: {current_photo_count}\n\n"
-            f"Используйте /reset для сброса и начала новой накладной."
-        )
-        return
-    
-    photo_file = await update.message.photo[-1].get_file()
-    
-    # Проверка размера файла
-    if photo_file.file_size > MAX_FILE_SIZE:
-        await update.message.reply_text(f"❌ Файл слишком большой!\n\nМаксимальный размер: {MAX_FILE_SIZE // (1024*1024)}MB\nТекущий размер: {photo_file.file_size // (1024*1024)}MB")
-        return
-    
-    # Проверка формата файла
-    if not photo_file.file_path or not photo_file.file_path.lower().endswith(('.jpg', '.jpeg', '.png')):
-        await update.message.reply_text("❌ Неподдерживаемый формат файла!\n\nПоддерживаются только: JPG, JPEG, PNG")
-        return
+    return invoice_number
 
+def new_upload_job(policy: MediaPolicy, message, invoice_number: str, tg_file, file_extension: str, bot) -> UploadJob:
+    """Задача загрузки с уникальным именем файла"""
     # Создаем уникальное имя файла с временной меткой
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     unique_id = str(uuid.uuid4())[:8]
-    safe_invoice = get_safe_folder_name(invoice_number)
-    
-    # Определяем расширение файла
-    file_extension = '.jpg'  # По умолчанию
-    if photo_file.file_path:
-        if photo_file.file_path.lower().endswith('.png'):
-            file_extension = '.png'
-        elif photo_file.file_path.lower().endswith('.jpeg'):
-            file_extension = '.jpeg'
-    
-    file_name = f"{timestamp}_{unique_id}{file_extension}"
-    
-    # Пути для загрузки
-    folder_path = f"/{BASE_FOLDER}/{safe_invoice}"
-    file_path = f"{folder_path}/{file_name}"
 
-    # Создаем папку на Яндекс.Диске, если нет
-    try:
-        if not y.exists(folder_path):
-            y.mkdir(folder_path)
-            logger.info(f"✅ Создана папка на Яндекс.Диске: {folder_path}")
-        else:
-            logger.info(f"📁 Папка уже существует: {folder_path}")
-            
-        # Проверяем доступность папки для записи
-        try:
-            test_file_path = f"{folder_path}/.test_write"
-            upload_text_to_yandex(test_file_path, "test")
-            y.remove(test_file_path)
-            logger.info(f"✅ Папка доступна для записи: {folder_path}")
-        except Exception as write_test_error:
-            logger.warning(f"⚠️ Проблема с правами записи в папку {folder_path}: {write_test_error}")
-            await update.message.reply_text("⚠️ Предупреждение: возможны проблемы с правами записи в папку.")
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при создании папки: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "forbidden" in str(e).lower() or "access" in str(e).lower():
-            await update.message.reply_text("❌ Нет доступа к Яндекс.Диску\n\nПроверьте токен и права доступа.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
-        else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
+    return UploadJob(
+        kind=policy.kind,
+        user_id=message.from_user.id,
+        chat_id=message.chat_id,
+        message_id=message.message_id,
+        invoice=invoice_number,
+        folder_path=get_invoice_folder_path(invoice_number),
+        file_name=f"{timestamp}_{unique_id}{file_extension}",
+        file_size=tg_file.file_size or 0,
+        file_id=tg_file.file_id,
+        file_unique_id=tg_file.file_unique_id or "",
+        tg_file=tg_file,
+        bot=bot,
+        trace_id=tracing.current_trace_id(),
+    )
+
+def find_sent_duplicate(invoice_number: str, media) -> Optional[str]:
+    """Путь файла накладной, уже загруженного из этого же файла Telegram (проверка до скачивания)"""
+    if not DEDUP_ENABLED or not media.file_unique_id:
+        return None
+    return dedup_index.find_unique_id(get_invoice_folder_path(invoice_number), media.file_unique_id)
+
+def count_duplicate(size: int) -> None:
+    state.incr_stat("duplicates_skipped")
+    state.incr_stat("duplicate_bytes_saved", size)
+
+async def index_folder(folder_path: str) -> int:
+    """Восстанавливает записи индекса дубликатов по md5 файлов папки на Яндекс.Диске"""
+    entries = []
+    offset = 0
+    while True:
+        page = await storage.list_page(folder_path, DEDUP_LIST_PAGE_SIZE, offset)
+        for item in page:
+            if item.type == "file" and item.md5 and item.name != MANIFEST_NAME:
+                entries.append((item.md5, item.size, f"{folder_path}/{item.name}"))
+        if len(page) < DEDUP_LIST_PAGE_SIZE:
+            break
+        offset += len(page)
+    return dedup_index.replace_folder(folder_path, entries)
+
+async def ensure_folder_indexed(folder_path: str, created: bool) -> None:
+    """Папка, о которой индекс еще не знает (новая установка, потерянный индекс), индексируется один раз"""
+    if not DEDUP_ENABLED or dedup_index.is_indexed(folder_path):
         return
-    except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при создании папки: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
+    if created:
+        dedup_index.replace_folder(folder_path, [])
         return
-
-    # Сохраняем фото во временный файл
-    temp_path = f"/tmp/{photo_file.file_id}_{unique_id}{file_extension}"
     try:
-        await photo_file.download_to_drive(temp_path)
-        logger.info(f"📥 Файл загружен во временную папку: {temp_path}")
-        
-        # Проверяем, что файл действительно загрузился
-        if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-            raise Exception("Файл не был загружен или имеет нулевой размер")
-            
+        count = await index_folder(folder_path)
+        logger.info(f"♻️ Индекс дубликатов восстановлен по папке {folder_path}: файлов {count}")
+    except yadisk.exceptions.PathNotFoundError:
+        dedup_index.replace_folder(folder_path, [])
     except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка при загрузке файла: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте еще раз или отправьте файл меньшего размера.")
-        return
+        logger.warning(f"⚠️ Не удалось проиндексировать папку {folder_path}: {e}")
 
-    # Загружаем на Яндекс.Диск
+async def ensure_folder_manifest(folder_path: str, invoice_number: str, created: bool) -> None:
+    """Список файлов папки, неизвестной индексу манифестов, загружается до первой записи в манифест"""
+    if not MANIFEST_ENABLED:
+        return
     try:
-        y.upload(temp_path, file_path, overwrite=True)
-        bot_stats["total_photos"] += 1
-        invoice_photo_count[invoice_number] = current_photo_count + 1
-        
-        logger.info(f"✅ Файл загружен на Яндекс.Диск: {file_path}")
-        await update.message.reply_text(
-            f"✅ Фото успешно сохранено!\n\n"
-            f"📋 Накладная: {invoice_number}\n"
-            f"📁 Папка: {BASE_FOLDER}/{safe_invoice}\n"
-            f"📸 Файл: {file_name}\n"
-            f"📏 Размер: {format_file_size(photo_file.file_size)}\n"
-            f"📊 Фото в накладной: {invoice_photo_count[invoice_number]}/{MAX_PHOTOS_PER_INVOICE}"
-        )
-        
-        # Предупреждение при приближении к лимиту
-        if invoice_photo_count[invoice_number] >= MAX_PHOTOS_PER_INVOICE * 0.8:
-            await update.message.reply_text(
-                f"⚠️ Внимание! Приближается лимит фото для накладной '{invoice_number}'\n"
-                f"Осталось: {MAX_PHOTOS_PER_INVOICE - invoice_photo_count[invoice_number]} фото"
-            )
-        
-        # Показываем информацию о загруженном фото
-        await update.message.reply_text(
-            f"📸 Фото загружено! Всего в накладной: {invoice_photo_count[invoice_number]}/{MAX_PHOTOS_PER_INVOICE}\n\n"
-            f"Продолжайте загружать фото или используйте /reset для завершения накладной."
-        )
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при загрузке файла: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
-        else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
+        await manifests.ensure_known(folder_path, invoice_number, created)
     except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при загрузке на Яндекс.Диск: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-    finally:
-        # Удаляем локальный файл
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"🗑️ Временный файл удален: {temp_path}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл {temp_path}: {e}")
-            # Пытаемся удалить позже через cleanup
+        logger.warning(f"⚠️ Не удалось загрузить манифест папки {folder_path}: {e}")
 
-    # Обновляем время активности после обработки фото
-    touch_activity(user_id)
-
-async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает загрузку видео"""
+async def list_invoice_folders() -> list:
+    """Все папки накладных в базовой папке, постранично"""
+    folders = []
+    base_folder_path = f"/{BASE_FOLDER}"
+    offset = 0
+    while True:
+        page = await storage.list_page(base_folder_path, DEDUP_LIST_PAGE_SIZE, offset)
+        folders.extend(f"{base_folder_path}/{item.name}" for item in page if item.type == "dir")
+        if len(page) < DEDUP_LIST_PAGE_SIZE:
+            return folders
+        offset += len(page)
+
+async def get_tg_file(media):
+    """Запрашивает у Telegram ссылку на файл"""
+    with tracing.stage("get_file"):
+        return await media.get_file()
+
+async def ingest_media(update: Update, context: ContextTypes.DEFAULT_TYPE, policy: MediaPolicy):
+    """Проверяет медиафайл и ставит его в очередь загрузки"""
     user_id = update.message.from_user.id
-    
-    # Проверяем таймаут бездействия
-    if is_session_expired(user_id):
-        was_active, old_invoice, old_photo_count, old_video_count, old_document_count = reset_user_session(user_id)
-        if was_active:
-            await update.message.reply_text(INFO_MESSAGES.get("session_expired"))
-        # После сброса просим снова отправить накладную
-        await update.message.reply_text(
-            "ℹ️ У вас нет активной накладной.\n\nИспользуйте /start для начала работы.",
-            reply_markup=get_main_menu_keyboard(user_id)
+
+    # Файлы альбома обрабатываются вместе, одной сводкой
+    if update.message.media_group_id:
+        album_collector.add(
+            (update.message.chat_id, update.message.media_group_id),
+            (policy, update.message, context.bot)
         )
-        touch_activity(user_id)
         return
-        
-    if user_id not in user_invoice:
-        await update.message.reply_text(
-            "❌ Сначала пришлите номер накладной командой /start",
-            reply_markup=get_main_menu_keyboard(user_id)
-        )
-        touch_activity(user_id)
+
+    invoice_number = await require_active_invoice(update.message)
+    if invoice_number is None:
         return
 
-    invoice_number = user_invoice[user_id]
-    
-    # Проверяем лимит видео на накладную
-    current_video_count = invoice_video_count.get(invoice_number, 0)
-    if current_video_count >= MAX_VIDEOS_PER_INVOICE:
+    # Место в накладной резервируется до запроса файла у Telegram и освобождается, если файл не принят
+    if not ledger.reserve(user_id, invoice_number, policy.kind, policy.max_per_invoice):
         await update.message.reply_text(
-            f"❌ Достигнут лимит видео для накладной '{invoice_number}'\n\n"
-            f"Максимум: {MAX_VIDEOS_PER_INVOICE} видео\n"
-            f"Текущее количество: {current_video_count}\n\n"
-            f"Используйте /reset для сброса и начала новой накладной."
+            policy.limit_reached_message.format(
+                invoice=invoice_number, max=policy.max_per_invoice,
+                current=ledger.used(user_id, invoice_number, policy.kind)
+            )
         )
         return
-    
-    video_file = await update.message.video.get_file()
-    
+    job = None
+    try:
+        job = await admit_media(update.message, policy, invoice_number, context.bot)
+    finally:
+        if job is None:
+            ledger.release(user_id, invoice_number, policy.kind)
+    if job is None:
+        return
+
+    logger.info(f"📥 Файл поставлен в очередь загрузки: {job.file_path}")
+    accepted_message = policy.accepted_message
+    if storage.breaker.is_open:
+        accepted_message += "\n\n" + INFO_MESSAGES["upload_deferred"]
+    await context.bot.send_message(
+        update.message.chat_id, accepted_message,
+        reply_to_message_id=update.message.message_id,
+        rate_limit_args=MERGEABLE
+    )
+
+    touch_activity(user_id)
+
+async def admit_media(message, policy: MediaPolicy, invoice_number: str, bot) -> Optional[UploadJob]:
+    """
+    Проверки файла с зарезервированным местом и постановка в очередь загрузки.
+    Возвращает задачу или None, если файл не принят (пользователю уже отправлен ответ).
+    """
+    user_id = message.from_user.id
+
+    # Размер известен из самого сообщения — проверяем его до запроса файла у Telegram
+    media = policy.get_media(message)
+    file_size = media.file_size or 0
+
     # Проверка размера файла
-    if video_file.file_size > MAX_VIDEO_SIZE:
-        await update.message.reply_text(
-            f"❌ Видео слишком большое!\n\n"
-            f"Максимальный размер: {MAX_VIDEO_SIZE // (1024*1024)}MB\n"
-            f"Текущий размер: {video_file.file_size // (1024*1024)}MB"
+    if file_size > policy.max_size:
+        await message.reply_text(
+            policy.too_large_message.format(
+                max_size=policy.max_size // (1024 * 1024), current_size=file_size // (1024 * 1024)
+            )
         )
-        return
-    
+        return None
+
+    # Тот же файл Telegram уже загружен в накладную — не скачиваем его
+    duplicate_of = find_sent_duplicate(invoice_number, media)
+    if duplicate_of is not None:
+        logger.info(f"♻️ Повторно присланный файл пропущен: {duplicate_of}")
+        count_duplicate(file_size)
+        await message.reply_text(INFO_MESSAGES["duplicate_skipped"].format(
+            invoice=invoice_number, filename=duplicate_of.rsplit("/", 1)[-1]
+        ))
+        touch_activity(user_id)
+        return None
+
+    # Проверка свободного места на диске (с учетом файлов в очереди)
+    if not await quota.fits(file_size, upload_pool.pending_bytes):
+        logger.warning(f"⚠️ Недостаточно места на Яндекс.Диске для файла пользователя {user_id}")
+        await message.reply_text(ERROR_MESSAGES["disk_full"].format(
+            size=format_file_size(file_size), free=format_file_size(quota.free)
+        ))
+        return None
+
+    tg_file = await get_tg_file(media)
+
     # Проверка формата файла
-    if not video_file.file_path or not any(video_file.file_path.lower().endswith(fmt) for fmt in SUPPORTED_VIDEO_FORMATS):
-        await update.message.reply_text(
-            "❌ Неподдерживаемый формат видео!\n\n"
-            "Поддерживаются только: MP4, AVI, MOV, MKV, WMV, FLV, WEBM, M4V, 3GP, 3G2, F4V, ASF\n"
-            "Поддерживается разрешение до 4K"
-        )
-        return
+    file_extension = policy.match_extension(tg_file.file_path)
+    if not file_extension:
+        await message.reply_text(policy.unsupported_format_message)
+        return None
 
-    # Создаем уникальное имя файла с временной меткой
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    safe_invoice = get_safe_folder_name(invoice_number)
-    
-    # Определяем расширение файла
-    file_extension = '.mp4'  # По умолчанию
-    if video_file.file_path:
-        for fmt in SUPPORTED_VIDEO_FORMATS:
-            if video_file.file_path.lower().endswith(fmt):
-                file_extension = fmt
-                break
-    
-    file_name = f"{timestamp}_{unique_id}{file_extension}"
-    
-    # Пути для загрузки
-    folder_path = f"/{BASE_FOLDER}/{safe_invoice}"
-    file_path = f"{folder_path}/{file_name}"
+    job = new_upload_job(policy, message, invoice_number, tg_file, file_extension, bot)
 
-    # Создаем папку на Яндекс.Диске, если нет
-    try:
-        if not y.exists(folder_path):
-            y.mkdir(folder_path)
-            logger.info(f"✅ Создана папка на Яндекс.Диске: {folder_path}")
-        else:
-            logger.info(f"📁 Папка уже существует: {folder_path}")
-            
-        # Проверяем доступность папки для записи
-        try:
-            test_file_path = f"{folder_path}/.test_write"
-            upload_text_to_yandex(test_file_path, "test")
-            y.remove(test_file_path)
-            logger.info(f"✅ Папка доступна для записи: {folder_path}")
-        except Exception as write_test_error:
-            logger.warning(f"⚠️ Проблема с правами записи в папку {folder_path}: {write_test_error}")
-            await update.message.reply_text("⚠️ Предупреждение: возможны проблемы с правами записи в папку.")
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при создании папки: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "forbidden" in str(e).lower() or "access" in str(e).lower():
-            await update.message.reply_text("❌ Нет доступа к Яндекс.Диску\n\nПроверьте токен и права доступа.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
-        else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-        return
-    except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при создании папки: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-        return
+    if not upload_pool.submit(job):
+        logger.warning(f"⚠️ Очередь загрузок переполнена, файл пользователя {user_id} отклонен")
+        await message.reply_text(ERROR_MESSAGES["upload_queue_full"])
+        return None
+    return job
 
-    # Сохраняем видео во временный файл
-    temp_path = f"/tmp/{video_file.file_id}_{unique_id}{file_extension}"
-    try:
-        await video_file.download_to_drive(temp_path)
-        logger.info(f"📥 Видео загружено во временную папку: {temp_path}")
-        
-        # Проверяем, что файл действительно загрузился
-        if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-            raise Exception("Видео не было загружено или имеет нулевой размер")
-            
-    except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка при загрузке видео: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте еще раз или отправьте файл меньшего размера.")
+async def ingest_album(key: tuple, items: list) -> None:
+    """
+    Принимает альбом целиком: файлы запрашиваются параллельно, лимит накладной
+    проверяется один раз на группу, пользователь получает одну сводку.
+    """
+    first_policy, first_message, bot = items[0]
+    user_id = first_message.from_user.id
+
+    invoice_number = await require_active_invoice(first_message)
+    if invoice_number is None:
         return
 
-    # Загружаем на Яндекс.Диск
-    try:
-        y.upload(temp_path, file_path, overwrite=True)
-        bot_stats["total_videos"] += 1
-        invoice_video_count[invoice_number] = current_video_count + 1
-        
-        logger.info(f"✅ Видео загружено на Яндекс.Диск: {file_path}")
-        await update.message.reply_text(
-            f"✅ Видео успешно сохранено!\n\n"
-            f"📋 Накладная: {invoice_number}\n"
-            f"📁 Папка: {BASE_FOLDER}/{safe_invoice}\n"
-            f"🎥 Файл: {file_name}\n"
-            f"📏 Размер: {format_file_size(video_file.file_size)}\n"
-            f"📊 Видео в накладной: {invoice_video_count[invoice_number]}/{MAX_VIDEOS_PER_INVOICE}"
-        )
-        
-        # Предупреждение при приближении к лимиту
-        if invoice_video_count[invoice_number] >= MAX_VIDEOS_PER_INVOICE * 0.8:
-            await update.message.reply_text(
-                f"⚠️ Внимание! Приближается лимит видео для накладной '{invoice_number}'\n"
-                f"Осталось: {MAX_VIDEOS_PER_INVOICE - invoice_video_count[invoice_number]} видео"
-            )
-        
-        # Показываем информацию о загруженном видео
-        await update.message.reply_text(
-            f"🎥 Видео загружено! Всего в накладной: {invoice_video_count[invoice_number]}/{MAX_VIDEOS_PER_INVOICE}\n\n"
-            f"Продолжайте загружать файлы или используйте /reset для завершения накладной."
-        )
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при загрузке видео: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
+    group = UploadGroup(bot, first_message.chat_id, first_message.message_id, user_id, invoice_number, send_album_summary)
+
+    # Размер и место на диске проверяем до запроса файлов у Telegram
+    accepted = []
+    queued = upload_pool.pending_bytes
+    for number, (policy, message, _) in enumerate(items, 1):
+        name = f"{policy.label} {number}"
+        media = policy.get_media(message)
+        file_size = media.file_size or 0
+        if file_size > policy.max_size:
+            group.reject(policy, name, ERROR_MESSAGES["album_file_too_large"].format(
+                max_size=policy.max_size // (1024 * 1024), current_size=file_size // (1024 * 1024)
+            ))
+            continue
+        duplicate_of = find_sent_duplicate(invoice_number, media)
+        if duplicate_of is not None:
+            count_duplicate(file_size)
+            group.skip(policy, name, INFO_MESSAGES["album_duplicate"].format(
+                filename=duplicate_of.rsplit("/", 1)[-1]
+            ))
+            continue
+        if not await quota.fits(file_size, queued):
+            group.reject(policy, name, ERROR_MESSAGES["album_disk_full"])
+            continue
+        queued += file_size
+        accepted.append((number, policy, message))
+
+    tg_files = await asyncio.gather(
+        *(get_tg_file(policy.get_media(message)) for _, policy, message in accepted),
+        return_exceptions=True
+    )
+
+    jobs = []
+    for (number, policy, message), tg_file in zip(accepted, tg_files):
+        name = f"{policy.label} {number}"
+        if isinstance(tg_file, Exception):
+            logger.error(f"❌ Не удалось получить файл альбома {key}: {tg_file}")
+            group.reject(policy, name, ERROR_MESSAGES["album_file_unavailable"])
+            continue
+        file_extension = policy.match_extension(tg_file.file_path)
+        if not file_extension:
+            group.reject(policy, name, ERROR_MESSAGES["album_unsupported_format"])
+            continue
+        # Место в накладной резервируется до загрузки, по одному на файл
+        if not ledger.reserve(user_id, invoice_number, policy.kind, policy.max_per_invoice):
+            group.reject(policy, name, ERROR_MESSAGES["album_limit_reached"].format(max=policy.max_per_invoice))
+            continue
+
+        job = new_upload_job(policy, message, invoice_number, tg_file, file_extension, bot)
+        group.attach(job, policy)
+        jobs.append(job)
+
+    for job in jobs:
+        if upload_pool.submit(job):
+            logger.info(f"📥 Файл альбома поставлен в очередь загрузки: {job.file_path}")
         else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-    except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при загрузке на Яндекс.Диск: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-    finally:
-        # Удаляем локальный файл
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"🗑️ Временный файл удален: {temp_path}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл {temp_path}: {e}")
-            # Пытаемся удалить позже через cleanup
+            logger.warning(f"⚠️ Очередь загрузок переполнена, файл альбома пользователя {user_id} отклонен")
+            ledger.release(user_id, invoice_number, job.kind)
+            group.detach(job, ERROR_MESSAGES["album_queue_full"])
 
-    # Обновляем время активности после обработки видео
+    logger.info(f"📦 Альбом для накладной {invoice_number}: файлов {len(items)}, в очереди {len(jobs)}")
     touch_activity(user_id)
+    await group.seal()
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает загрузку документов"""
-    user_id = update.message.from_user.id
-    
-    # Проверяем таймаут бездействия
-    if is_session_expired(user_id):
-        was_active, old_invoice, old_photo_count, old_video_count, old_document_count = reset_user_session(user_id)
-        if was_active:
-            await update.message.reply_text(INFO_MESSAGES.get("session_expired"))
-        # После сброса просим снова отправить накладную
-        await update.message.reply_text(
-            "ℹ️ У вас нет активной накладной.\n\nИспользуйте /start для начала работы.",
-            reply_markup=get_main_menu_keyboard(user_id)
-        )
-        touch_activity(user_id)
-        return
-        
-    if user_id not in user_invoice:
-        await update.message.reply_text(
-            "❌ Сначала пришлите номер накладной командой /start",
-            reply_markup=get_main_menu_keyboard(user_id)
-        )
-        touch_activity(user_id)
-        return
+async def ingest_album_in_order(key: tuple, items: list) -> None:
+    """Альбом разбирается вне обработки обновлений, поэтому берет ту же блокировку пользователя, что и process_update"""
+    async with update_locks.hold(items[0][1].from_user.id):
+        await ingest_album(key, items)
 
-    invoice_number = user_invoice[user_id]
-    
-    # Проверяем лимит документов на накладную
-    current_document_count = invoice_document_count.get(invoice_number, 0)
-    if current_document_count >= MAX_DOCUMENTS_PER_INVOICE:
-        await update.message.reply_text(
-            f"❌ Достигнут лимит документов для накладной '{invoice_number}'\n\n"
-            f"Максимум: {MAX_DOCUMENTS_PER_INVOICE} документов\n"
-            f"Текущее количество: {current_document_count}\n\n"
-            f"Используйте /reset для сброса и начала новой накладной."
-        )
-        return
-    
-    document_file = await update.message.document.get_file()
-    
-    # Проверка размера файла
-    if document_file.file_size > MAX_DOCUMENT_SIZE:
-        await update.message.reply_text(
-            f"❌ Документ слишком большой!\n\n"
-            f"Максимальный размер: {MAX_DOCUMENT_SIZE // (1024*1024)}MB\n"
-            f"Текущий размер: {document_file.file_size // (1024*1024)}MB"
-        )
-        return
-    
-    # Проверка формата файла
-    if not document_file.file_path or not any(document_file.file_path.lower().endswith(fmt) for fmt in SUPPORTED_DOCUMENT_FORMATS):
-        await update.message.reply_text(
-            "❌ Неподдерживаемый формат документа!\n\n"
-            "Поддерживаются только: PDF, DOC, DOCX, XLS, XLSX"
-        )
+async def flush_albums_before(update: Update) -> None:
+    """
+    Альбомы пользователя, еще ждущие окна сбора, разбираются до его следующего обновления
+    (вызывается под блокировкой пользователя): иначе /reset или новая накладная, присланные
+    во время окна, обогнали бы альбом. Файл того же альбома окно только продлевает.
+    """
+    message = update.message
+    if update.effective_user is None or not album_collector:
         return
+    user_id = update.effective_user.id
+    current = (message.chat_id, message.media_group_id) if message is not None and message.media_group_id else None
+    for key, items in album_collector.take(
+        lambda key, items: key != current and items[0][1].from_user.id == user_id
+    ):
+        try:
+            with tracing.stage("album_flush"):
+                await ingest_album(key, items)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки альбома {key}: {e}", exc_info=True)
+
+async def send_album_summary(group: UploadGroup) -> None:
+    """Одна сводка по всем файлам альбома"""
+    files = []
+    kinds = {}
+    for policy, name, ok, detail, duplicate in group.results:
+        kinds[policy.kind] = policy
+        mark = "♻️" if duplicate else "✅" if ok else "❌"
+        files.append(f"{mark} {policy.icon} {name}" + (f" — {detail}" if detail else ""))
+
+    counts = []
+    warnings = []
+    for kind, policy in kinds.items():
+        current = state.get_count(group.user_id, group.invoice, kind)
+        counts.append(f"{policy.icon} {current}/{policy.max_per_invoice}")
+        # Предупреждение при приближении к лимиту
+        if current >= policy.max_per_invoice * 0.8:
+            warnings.append(policy.approaching_limit_message.format(
+                invoice=group.invoice, remaining=policy.max_per_invoice - current
+            ))
+
+    text = SUCCESS_MESSAGES["album_summary"].format(
+        invoice=group.invoice,
+        uploaded=group.uploaded,
+        total=len(group.results),
+        files="\n".join(files),
+        counts=", ".join(counts),
+    )
+    if group.duplicates:
+        text += "\n\n" + INFO_MESSAGES["album_duplicates"].format(count=group.duplicates)
+    if warnings:
+        text += "\n\n" + "\n".join(warnings)
+    await group.bot.send_message(
+        group.chat_id, text,
+        reply_to_message_id=group.message_id,
+        allow_sending_without_reply=True
+    )
 
-    # Создаем уникальное имя файла с временной меткой
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    safe_invoice = get_safe_folder_name(invoice_number)
-    
-    # Определяем расширение файла
-    file_extension = '.pdf'  # По умолчанию
-    if document_file.file_path:
-        for fmt in SUPPORTED_DOCUMENT_FORMATS:
-            if document_file.file_path.lower().endswith(fmt):
-                file_extension = fmt
-                break
-    
-    file_name = f"{timestamp}_{unique_id}{file_extension}"
-    
-    # Пути для загрузки
-    folder_path = f"/{BASE_FOLDER}/{safe_invoice}"
-    file_path = f"{folder_path}/{file_name}"
+async def reply_to_job(job: UploadJob, text: str) -> None:
+    """Ответ на исходное сообщение с файлом (идущие подряд ответы могут объединиться в одно сообщение)"""
+    await job.bot.send_message(
+        job.chat_id, text,
+        reply_to_message_id=job.message_id,
+        allow_sending_without_reply=True,
+        rate_limit_args=MERGEABLE
+    )
+
+async def process_upload_job(job: UploadJob) -> None:
+    """
+    Переносит файл из очереди на Яндекс.Диск и сообщает пользователю результат (выполняется воркером).
+    Ошибки пробрасываются: повторами и сообщением о неудаче занимается пул воркеров.
+    """
+    policy = MEDIA_POLICIES[job.kind]
+    folder_path = job.folder_path
+    file_path = job.file_path
 
     # Создаем папку на Яндекс.Диске, если нет
+    with tracing.stage("ensure_folder"):
+        created = await storage.ensure_folder(folder_path)
+    if created:
+        logger.info(f"✅ Создана папка на Яндекс.Диске: {folder_path}")
+    else:
+        logger.info(f"📁 Папка уже существует: {folder_path}")
+    await ensure_folder_indexed(folder_path, created)
+    await ensure_folder_manifest(folder_path, job.invoice, created)
+
+    # Проверяем доступность папки для записи (результат кэшируется)
     try:
-        if not y.exists(folder_path):
-            y.mkdir(folder_path)
-            logger.info(f"✅ Создана папка на Яндекс.Диске: {folder_path}")
-        else:
-            logger.info(f"📁 Папка уже существует: {folder_path}")
-            
-        # Проверяем доступность папки для записи
+        with tracing.stage("write_check"):
+            await storage.check_writable(folder_path)
+    except Exception as write_test_error:
+        logger.warning(f"⚠️ Проблема с правами записи в папку {folder_path}: {write_test_error}")
+        if job.attempts == 0 and job.group is None:
+            try:
+                await reply_to_job(job, "⚠️ Предупреждение: возможны проблемы с правами записи в папку.")
+            except Exception as e:
+                logger.error(f"❌ Не удалось отправить предупреждение о правах записи: {e}")
+
+    # После перезапуска или повтора ссылка на файл запрашивается заново
+    tg_file = job.tg_file
+    if tg_file is None:
         try:
-            test_file_path = f"{folder_path}/.test_write"
-            upload_text_to_yandex(test_file_path, "test")
-            y.remove(test_file_path)
-            logger.info(f"✅ Папка доступна для записи: {folder_path}")
-        except Exception as write_test_error:
-            logger.warning(f"⚠️ Проблема с правами записи в папку {folder_path}: {write_test_error}")
-            await update.message.reply_text("⚠️ Предупреждение: возможны проблемы с правами записи в папку.")
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при создании папки: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "forbidden" in str(e).lower() or "access" in str(e).lower():
-            await update.message.reply_text("❌ Нет доступа к Яндекс.Диску\n\nПроверьте токен и права доступа.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
-        else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-        return
+            with tracing.stage("get_file"):
+                tg_file = await job.bot.get_file(job.file_id)
+        except BadRequest:
+            raise
+        except Exception as e:
+            raise DownloadError(str(e)) from e
+
+    copied_from = None
+
+    async def check_duplicate(md5: str, size: int, uploaded: bool) -> Optional[str]:
+        nonlocal copied_from
+        if not DEDUP_ENABLED:
+            return None
+        existing = dedup_index.find(folder_path, md5, size)
+        if existing is not None or uploaded or DEDUP_SCOPE != "global":
+            return existing
+        # Такой файл есть в другой накладной — копируем его на стороне Яндекс.Диска
+        source = dedup_index.find_any(md5, size)
+        if source is None:
+            return None
+        try:
+            await storage.copy(source, file_path)
+        except yadisk.exceptions.PathNotFoundError:
+            dedup_index.discard_path(source)
+            return None
+        except yadisk.exceptions.PathExistsError:
+            # Копия уже сделана предыдущей попыткой (ответ на copy не дошел) — проверяем, что это тот же файл
+            target = await storage.get_meta(file_path)
+            if target.md5 != md5:
+                raise
+            logger.info(f"♻️ Копия {file_path} уже на Яндекс.Диске, повторное копирование не нужно")
+        copied_from = source
+        return source
+
+    # Ход передачи большого файла показываем в одном сообщении (кроме файлов альбома — у них общая сводка)
+    progress = None
+    if job.group is None and media_transfer.is_resumable(tg_file):
+        if job.progress is None:
+            job.progress = ProgressMessage(job.bot, job.chat_id, job.message_id, render_progress)
+        progress = job.progress
+        progress.start()
+
+    # Переносим файл на Яндекс.Диск (потоком, через spool-файл с докачкой или через временный файл)
+    temp_path = get_temp_file_path(job.file_id, job.file_name)
+    try:
+        result = await media_transfer.transfer(
+            tg_file, file_path, temp_path, check_duplicate,
+            progress=progress.update if progress is not None else None,
+            spool_key=job.file_id
+        )
     except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при создании папки: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
+        if progress is not None:
+            await progress.stop(None if is_permanent_upload_error(e) else INFO_MESSAGES["progress_interrupted"])
+        raise
+    if progress is not None:
+        await progress.stop(INFO_MESSAGES["progress_done"].format(size=format_file_size(result.size)))
+
+    if result.duplicate_of is not None and copied_from is None:
+        await finish_duplicate_job(job, result)
         return
 
-    # Сохраняем документ во временный файл
-    temp_path = f"/tmp/{document_file.file_id}_{unique_id}{file_extension}"
+    quota.record_upload(result.size)
+    if DEDUP_ENABLED:
+        dedup_index.add(folder_path, result.md5, result.size, file_path, job.file_unique_id or None)
+    if MANIFEST_ENABLED:
+        manifests.record(folder_path, job.invoice, {
+            "name": job.file_name,
+            "kind": job.kind,
+            "size": result.size,
+            "md5": result.md5,
+            "user_id": job.user_id,
+            "uploaded_at": time.time(),
+        })
+    if copied_from is not None:
+        metrics.inc("dedup_copies_total")
+        logger.info(f"♻️ Файл скопирован из {copied_from} без повторной загрузки")
+    else:
+        metrics.inc("upload_bytes_total", result.size, kind=job.kind)
+
+    if not job.settled:
+        state.incr_stat(policy.stats_key)
+    # Резерв переходит в счетчик; накладную могли сбросить, пока файл загружался — тогда счетчик не меняется
+    current = upload_pool.settle(job)
+    # Задача выполнена: дальше только ответы, их ошибки не должны запускать повторную загрузку
+    upload_pool.complete(job)
+
+    logger.info(f"✅ Файл загружен на Яндекс.Диск: {file_path}")
+    # Обновляем время активности после загрузки файла
+    touch_activity(job.user_id)
+
     try:
-        await document_file.download_to_drive(temp_path)
-        logger.info(f"📥 Документ загружен во временную папку: {temp_path}")
-        
-        # Проверяем, что файл действительно загрузился
-        if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-            raise Exception("Документ не был загружен или имеет нулевой размер")
-            
+        await notify_upload_done(job, policy, current)
     except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка при загрузке документа: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте еще раз или отправьте файл меньшего размера.")
+        logger.error(f"❌ Не удалось сообщить о загрузке {file_path}: {e}")
+
+async def notify_upload_done(job: UploadJob, policy: MediaPolicy, current: int) -> None:
+    """Сообщает пользователю о загруженном файле"""
+    # Файл альбома попадает в общую сводку
+    if job.group is not None:
+        await job.group.record(job, True, format_file_size(job.file_size))
         return
 
-    # Загружаем на Яндекс.Диск
-    try:
-        y.upload(temp_path, file_path, overwrite=True)
-        bot_stats["total_documents"] += 1
-        invoice_document_count[invoice_number] = current_document_count + 1
-        
-        logger.info(f"✅ Документ загружен на Яндекс.Диск: {file_path}")
-        await update.message.reply_text(
-            f"✅ Документ успешно сохранен!\n\n"
-            f"📋 Накладная: {invoice_number}\n"
-            f"📁 Папка: {BASE_FOLDER}/{safe_invoice}\n"
-            f"📄 Файл: {file_name}\n"
-            f"📏 Размер: {format_file_size(document_file.file_size)}\n"
-            f"📊 Документы в накладной: {invoice_document_count[invoice_number]}/{MAX_DOCUMENTS_PER_INVOICE}"
+    # Ответы об одном файле уходят одним сообщением: ответы на разные сообщения не объединяются
+    texts = [
+        policy.saved_message.format(
+            invoice=job.invoice,
+            folder=job.folder_path.lstrip("/"),
+            filename=job.file_name,
+            size=format_file_size(job.file_size),
+            current=current,
+            max=policy.max_per_invoice,
         )
-        
-        # Предупреждение при приближении к лимиту
-        if invoice_document_count[invoice_number] >= MAX_DOCUMENTS_PER_INVOICE * 0.8:
-            await update.message.reply_text(
-                f"⚠️ Внимание! Приближается лимит документов для накладной '{invoice_number}'\n"
-                f"Осталось: {MAX_DOCUMENTS_PER_INVOICE - invoice_document_count[invoice_number]} документов"
-            )
-        
-        # Показываем информацию о загруженном документе
-        await update.message.reply_text(
-            f"📄 Документ загружен! Всего в накладной: {invoice_document_count[invoice_number]}/{MAX_DOCUMENTS_PER_INVOICE}\n\n"
-            f"Продолжайте загружать файлы или используйте /reset для завершения накладной."
-        )
-            
-    except yadisk.exceptions.YaDiskError as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Ошибка Яндекс.Диска при загрузке документа: {e}"
-        logger.error(error_msg)
-        
-        # Более детальные сообщения об ошибках
-        if "quota" in str(e).lower():
-            await update.message.reply_text("❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.")
-        elif "network" in str(e).lower() or "timeout" in str(e).lower():
-            await update.message.reply_text("❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.")
-        else:
-            await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-    except Exception as e:
-        bot_stats["errors"] += 1
-        error_msg = f"Неожиданная ошибка при загрузке на Яндекс.Диск: {e}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору.")
-    finally:
-        # Удаляем локальный файл
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"🗑️ Временный файл удален: {temp_path}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл {temp_path}: {e}")
-            # Пытаемся удалить позже через cleanup
+    ]
+
+    # Предупреждение при приближении к лимиту
+    if current >= policy.max_per_invoice * 0.8:
+        texts.append(policy.approaching_limit_message.format(
+            invoice=job.invoice, remaining=policy.max_per_invoice - current
+        ))
+
+    # Показываем информацию о загруженном файле
+    texts.append(policy.uploaded_message.format(current=current, max=policy.max_per_invoice))
+    await reply_to_job(job, "\n\n".join(texts))
+
+def render_progress(phase: str, done: int, total: int) -> str:
+    """Текст сообщения о ходе передачи (с шагом 5%, чтобы не править сообщение без изменений)"""
+    percent = min(100, done * 100 // total) if total else 0
+    percent -= percent % 5
+    bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+    template = INFO_MESSAGES["progress_download"] if phase == "download" else INFO_MESSAGES["progress_upload"]
+    return template.format(size=format_file_size(total), bar=bar, percent=percent)
+
+async def finish_duplicate_job(job: UploadJob, result) -> None:
+    """Файл не загружен, потому что такой уже есть в накладной"""
+    if job.file_unique_id:
+        dedup_index.remember_unique_id(job.folder_path, result.md5, result.size, job.file_unique_id)
+    count_duplicate(result.size)
+    metrics.inc("dedup_skipped_total", kind=job.kind)
+    logger.info(f"♻️ Дубликат {result.duplicate_of} не загружен повторно: {job.file_path}")
+    touch_activity(job.user_id)
+
+    filename = result.duplicate_of.rsplit("/", 1)[-1]
+    if job.group is not None:
+        await job.group.record(job, True, INFO_MESSAGES["album_duplicate"].format(filename=filename), duplicate=True)
+        return
+    await reply_to_job(job, INFO_MESSAGES["duplicate_skipped"].format(invoice=job.invoice, filename=filename))
+
+async def notify_upload_failed(job: UploadJob, e: Exception) -> None:
+    """Сообщает пользователю, что файл не удалось загрузить после всех попыток"""
+    policy = MEDIA_POLICIES[job.kind]
+    state.incr_stat("errors")
+    # Повторов больше не будет — скачанная часть файла не нужна
+    media_transfer.discard_spool(job.file_id)
+    # Категории Яндекс.Диска — только для его ошибок: сетевая ошибка Telegram тоже классифицируется как TRANSIENT
+    telegram_error = isinstance(e, (DownloadError, TelegramError))
+    yandex_error = isinstance(e, (yadisk.exceptions.YaDiskError, CircuitOpenError))
+    category = classify(e) if yandex_error else ErrorCategory.UNKNOWN
+    metrics.inc("upload_errors_total", kind=job.kind, category="telegram" if telegram_error else category.value)
+    if isinstance(e, (DownloadError, BadRequest)):
+        error_msg = f"{policy.download_error}: {e}"
+        text = f"❌ {error_msg}\n\nПопробуйте еще раз или отправьте файл меньшего размера."
+    elif telegram_error:
+        error_msg = f"Ошибка Telegram при загрузке файла: {e}"
+        text = ERROR_MESSAGES["telegram_error"]
+    elif yandex_error:
+        if category is ErrorCategory.QUOTA:
+            # Место закончилось раньше, чем показывал кэш — следующая проверка обновит его
+            quota.invalidate()
+        error_msg = f"{policy.upload_error}: {e}"
+        text = yadisk_error_text(e, error_msg)
+    else:
+        error_msg = f"Неожиданная ошибка при загрузке файла: {e}"
+        text = f"❌ {error_msg}\n\nПопробуйте позже или обратитесь к администратору."
+    logger.error(error_msg)
+    if job.group is not None:
+        await job.group.record(job, False, f"не загружено: {str(e)[:100]}")
+        return
+    await reply_to_job(job, text)
 
-    # Обновляем время активности после обработки документа
-    touch_activity(user_id)
+def is_permanent_upload_error(e: Exception) -> bool:
+    """Ошибки, которые не исправятся повтором загрузки"""
+    return isinstance(e, BadRequest) or classify(e).permanent
+
+def upload_deferral(e: Exception) -> Optional[float]:
+    """Выключатель разомкнут: задача ждет пробного запроса, не расходуя попытку"""
+    if isinstance(e, CircuitOpenError):
+        return max(e.retry_in, 1.0)
+    return None
+
+# Индекс содержимого загруженных файлов (пропуск дубликатов)
+dedup_index = DedupIndex()
+
+# Манифесты накладных на Яндекс.Диске и их локальный индекс (восстановление счетчиков)
+manifests = InvoiceManifests(storage, ManifestIndex())
+
+# Очередь задач загрузки на диске и пул воркеров, выполняющих загрузки в фоне
+job_store = JobStore()
+upload_pool = UploadWorkerPool(
+    process_upload_job,
+    ledger,
+    on_failure=notify_upload_failed,
+    store=job_store,
+    is_permanent=is_permanent_upload_error,
+    defer=upload_deferral,
+)
+
+# Сборщик файлов альбомов (сообщений с общим media_group_id)
+album_collector = MediaGroupCollector(ingest_album_in_order)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает загрузку фото"""
+    await ingest_media(update, context, MEDIA_POLICIES["photo"])
+
+async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает загрузку видео"""
+    await ingest_media(update, context, MEDIA_POLICIES["video"])
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает загрузку документов"""
+    await ingest_media(update, context, MEDIA_POLICIES["document"])
 
 async def reset_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = get_effective_message(update)
@@ -1337,7 +1505,7 @@ async def prompt_invoice_creation(update: Update, context: ContextTypes.DEFAULT_
         return
 
     user_id = get_user_id(update)
-    if user_id is not None and user_id in user_invoice:
+    if user_id is not None and state.get_invoice(user_id) is not None:
         await message.reply_text(
             "ℹ️ У вас уже есть активная накладная. Используйте кнопки меню для управления.",
             reply_markup=get_main_menu_keyboard(user_id)
@@ -1392,6 +1560,10 @@ def cleanup_temp_files():
                             logger.info(f"🗑️ Удален старый временный файл: {filename}")
                     except Exception as e:
                         logger.warning(f"Не удалось удалить временный файл {filename}: {e}")
+        # Заброшенные spool-файлы больших загрузок
+        removed = media_transfer.cleanup_spool(SPOOL_MAX_AGE)
+        if removed:
+            logger.info(f"🗑️ Удалено старых spool-файлов: {removed}")
     except Exception as e:
         logger.error(f"Ошибка при очистке временных файлов: {e}")
 
@@ -1439,7 +1611,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Добавляем пользователя
-        if add_user_access(new_user_id):
+        if await add_user_access(new_user_id):
             await update.message.reply_text(
                 f"✅ Пользователь {new_user_id} добавлен в список разрешенных!\n\n"
                 f"Теперь он может использовать бота."
@@ -1485,7 +1657,7 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Удаляем пользователя
-        if remove_user_access(target_user_id):
+        if await remove_user_access(target_user_id):
             await update.message.reply_text(
                 f"✅ Пользователь {target_user_id} удален из списка разрешенных!\n\n"
                 f"Теперь он не может использовать бота."
@@ -1531,6 +1703,177 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(error_msg)
         await update.message.reply_text(f"❌ {error_msg}")
 
+async def failed_uploads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает загрузки, исчерпавшие попытки (только для администраторов)"""
+    user_id = update.message.from_user.id
+
+    # Проверяем права администратора
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        counts = job_store.counts()
+        dead = job_store.dead()
+        if not dead:
+            await update.message.reply_text(
+                f"✅ Неудачных загрузок нет.\n\n⏳ В очереди: {counts['pending']}"
+            )
+            return
+
+        text = "❌ Неудачные загрузки:\n\n"
+        for row in dead:
+            failed_at = datetime.fromtimestamp(row["failed_at"]).strftime("%d.%m %H:%M")
+            text += (
+                f"#{row['id']} {row['kind']} • {row['invoice']} • пользователь {row['user_id']}\n"
+                f"   {failed_at}, попыток: {row['attempts']}\n"
+                f"   {(row['last_error'] or '')[:200]}\n"
+            )
+        text += (
+            f"\n📊 Всего неудачных: {counts['dead']}, в очереди: {counts['pending']}\n"
+            f"Повторить: /requeue <ID>"
+        )
+        await update.message.reply_text(text)
+
+    except Exception as e:
+        error_msg = f"Ошибка при получении списка неудачных загрузок: {e}"
+        logger.error(error_msg)
+        await update.message.reply_text(f"❌ {error_msg}")
+
+async def requeue_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Возвращает неудачную загрузку в очередь (только для администраторов)"""
+    user_id = update.message.from_user.id
+
+    # Проверяем права администратора
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Укажите ID задачи!\n\n"
+            "Пример: /requeue 42\n"
+            "Список неудачных загрузок: /failed"
+        )
+        return
+
+    try:
+        job_id = int(context.args[0])
+        job = upload_pool.requeue_dead(job_id, context.bot)
+        if job is None:
+            await update.message.reply_text(f"ℹ️ Задача {job_id} не найдена среди неудачных загрузок.")
+            return
+        logger.info(f"🔁 Администратор {user_id} вернул в очередь загрузку {job.file_path}")
+        if not job_store.owns(job.user_id):
+            # Задачу выполнит процесс-обработчик владельца: только у него его накладная и счетчики
+            await update.message.reply_text(
+                f"🔁 Задача {job_id} возвращена в очередь: {job.file_path}\n"
+                f"Загрузку продолжит обработчик пользователя {job.user_id} в течение {JOB_POLL_INTERVAL:.0f}с."
+            )
+            return
+        await update.message.reply_text(f"🔁 Задача {job_id} возвращена в очередь: {job.file_path}")
+
+    except ValueError:
+        await update.message.reply_text("❌ ID задачи должен быть числом!")
+    except Exception as e:
+        error_msg = f"Ошибка при возврате задачи в очередь: {e}"
+        logger.error(error_msg)
+        await update.message.reply_text(f"❌ {error_msg}")
+
+def format_duration(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} мс" if seconds < 1 else f"{seconds:.1f} с"
+
+async def slow_stages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Самые медленные этапы по записанным трассам (только для администраторов)"""
+    user_id = update.message.from_user.id
+
+    # Проверяем права администратора
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    if context.args and context.args[0] == "reset":
+        tracing.slow_stages.clear()
+        await update.message.reply_text("🧹 Статистика этапов сброшена.")
+        return
+
+    stages = tracing.slow_stages.top_stages()
+    if not stages:
+        await update.message.reply_text(
+            f"ℹ️ Трасс пока нет (записывается {TRACE_SAMPLE_RATE:.0%} обновлений и загрузок, TRACE_SAMPLE_RATE)."
+        )
+        return
+
+    text = f"🐢 Этапы по суммарному времени (выборка {TRACE_SAMPLE_RATE:.0%}):\n\n"
+    for name, count, average, peak in stages:
+        text += f"• {name}: {count} раз, в среднем {format_duration(average)}, максимум {format_duration(peak)}\n"
+    text += "\n⏱️ Самые медленные:\n\n"
+    for duration, name, trace_id, at in tracing.slow_stages.slowest()[:10]:
+        text += f"• {format_duration(duration)} {name} • {datetime.fromtimestamp(at).strftime('%H:%M:%S')} • trace {trace_id}\n"
+    text += "\nСбросить: /slow reset"
+    await update.message.reply_text(text)
+
+async def reindex_duplicates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перестраивает индекс дубликатов по файлам на Яндекс.Диске (только для администраторов)"""
+    user_id = update.message.from_user.id
+
+    # Проверяем права администратора
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        if context.args:
+            folders = [get_invoice_folder_path(" ".join(context.args))]
+        else:
+            folders = await list_invoice_folders()
+
+        await update.message.reply_text(f"♻️ Перестраиваю индекс дубликатов, папок: {len(folders)}...")
+        files = 0
+        for folder_path in folders:
+            try:
+                files += await index_folder(folder_path)
+            except yadisk.exceptions.PathNotFoundError:
+                dedup_index.replace_folder(folder_path, [])
+        logger.info(f"♻️ Администратор {user_id} перестроил индекс дубликатов: папок {len(folders)}, файлов {files}")
+        await update.message.reply_text(f"✅ Индекс дубликатов перестроен: папок {len(folders)}, файлов {files}")
+
+    except Exception as e:
+        error_msg = f"Ошибка при перестроении индекса дубликатов: {e}"
+        logger.error(error_msg)
+        await update.message.reply_text(f"❌ {error_msg}")
+
+async def rebuild_manifests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Перестраивает манифесты накладных по файлам на Яндекс.Диске (только для администраторов).
+    Без аргументов — папки без манифеста (загруженные до его появления), с накладной — ее папку заново.
+    """
+    user_id = update.message.from_user.id
+
+    # Проверяем права администратора
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        if context.args:
+            folders = [get_invoice_folder_path(" ".join(context.args))]
+        else:
+            folders = await list_invoice_folders()
+
+        await update.message.reply_text(f"📒 Перестраиваю манифесты накладных, папок: {len(folders)}...")
+        result = await manifests.rebuild(folders, force=bool(context.args))
+        logger.info(f"📒 Администратор {user_id} перестроил манифесты: {result}")
+        await update.message.reply_text(
+            f"✅ Манифесты: папок {result['folders']}, перестроено {result['rebuilt']}, "
+            f"загружено готовых {result['loaded']}, файлов {result['files']}, ошибок {result['errors']}"
+        )
+
+    except Exception as e:
+        error_msg = f"Ошибка при перестроении манифестов: {e}"
+        logger.error(error_msg)
+        await update.message.reply_text(f"❌ {error_msg}")
+
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает информацию о текущем пользователе"""
     user = update.message.from_user
@@ -1553,11 +1896,12 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if has_access:
         # Показываем информацию о накладной
-        if user_id in user_invoice:
-            invoice_number = user_invoice[user_id]
-            photo_count = invoice_photo_count.get(invoice_number, 0)
-            video_count = invoice_video_count.get(invoice_number, 0)
-            document_count = invoice_document_count.get(invoice_number, 0)
+        invoice_number = state.get_invoice(user_id)
+        if invoice_number is not None:
+            counts = state.get_counts(user_id, invoice_number)
+            photo_count = counts["photo"]
+            video_count = counts["video"]
+            document_count = counts["document"]
             user_info_text += (
                 f"📋 **Текущая накладная:**\n"
                 f"• Номер: {invoice_number}\n"
@@ -1574,56 +1918,188 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• /adduser <ID> - Добавить пользователя\n"
             f"• /removeuser <ID> - Удалить пользователя\n"
             f"• /listusers - Список пользователей\n"
+            f"• /failed - Неудачные загрузки\n"
+            f"• /requeue <ID> - Повторить загрузку\n"
+            f"• /reindex [накладная] - Перестроить индекс дубликатов\n"
+            f"• /manifests [накладная] - Перестроить манифесты накладных\n"
+            f"• /slow - Медленные этапы обработки\n"
             f"• /cleanup - Очистка временных файлов"
         )
     
     await update.message.reply_text(user_info_text, parse_mode='Markdown')
 
+# Готовность бота: Яндекс.Диск проверен, список пользователей загружен
+bot_ready = asyncio.Event()
+warm_up_task = None
+metrics_server = MetricsServer()
+
+async def warm_up() -> None:
+    """Проверка Яндекс.Диска и загрузка пользователей; выполняются параллельно, когда webhook уже принимает обновления"""
+    started = time.monotonic()
+    connection, users = await asyncio.gather(
+        check_yandex_connection(), load_allowed_users(), return_exceptions=True
+    )
+    if isinstance(connection, Exception):
+        logger.error(f"❌ Яндекс.Диск недоступен при запуске: {connection}")
+    if isinstance(users, Exception):
+        logger.error(f"❌ Не удалось загрузить список пользователей: {users}")
+    else:
+        set_allowed_users(users)
+        logger.info(f"👥 Загружено {len(ALLOWED_USERS)} разрешенных пользователей")
+    elapsed = time.monotonic() - started
+    metrics.set_gauge("startup_warm_up_seconds", elapsed)
+    bot_ready.set()
+    logger.info(f"✅ Бот готов к работе (прогрев {elapsed:.2f}с)")
+
+async def wait_until_ready(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Придерживает обновления до конца прогрева: они ждут в очереди, а не получают ошибку"""
+    if bot_ready.is_set():
+        return
+    try:
+        await asyncio.wait_for(bot_ready.wait(), STARTUP_READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Прогрев не завершился за {STARTUP_READY_TIMEOUT}с, обрабатываем обновление без него")
+
+async def post_init(app: Application) -> None:
+    """
+    Быстрый запуск: до открытия webhook выполняется только локальная работа,
+    сетевые проверки уходят в фоновый прогрев (warm_up).
+    """
+    global warm_up_task
+    # Восстанавливаем накладные, счетчики и статистику до обработки первых обновлений
+    await state.start()
+    session_sweeper.load(state.activity_timestamps())
+    session_sweeper.start(app.job_queue)
+
+    # Запускаем воркеры фоновой загрузки и продолжаем задачи, не завершенные до перезапуска
+    upload_pool.start()
+    upload_pool.resume(app.bot)
+    if WEBHOOK_WORKERS > 1:
+        # Задачи, возвращенные /requeue в процессе другого пользователя
+        upload_pool.watch(app.bot, JOB_POLL_INTERVAL)
+
+    # С несколькими обработчиками метрики всех процессов отдает диспетчер
+    if WEBHOOK_WORKERS <= 1:
+        metrics_server.start()
+
+    warm_up_task = asyncio.create_task(warm_up(), name="warm-up")
+
+async def post_shutdown(app: Application) -> None:
+    """Дожидается фоновых загрузок и закрывает соединения с Telegram-загрузчиком и Яндекс.Диском"""
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    await metrics_server.stop()
+    await album_collector.stop()
+    await upload_pool.stop()
+    await manifests.stop()
+    await state.close()
+    await quota.close()
+    await media_transfer.close()
+    await storage.close()
+    job_store.close()
+    dedup_index.close()
+    manifests.index.close()
+
+# Обновления одного пользователя обрабатываются по очереди (проверка лимитов накладной и постановка
+# файла в очередь не должны перемежаться), разных пользователей — параллельно, не больше CONCURRENT_UPDATES
+update_locks = KeyedLock("update")
+update_slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+class TracedApplication(Application):
+    """
+    Application, которое открывает трассу на каждое обновление (с выборкой TRACE_SAMPLE_RATE)
+    и обрабатывает обновления одного пользователя по порядку.
+    """
+
+    async def process_update(self, update: object) -> None:
+        attrs = {}
+        key = None
+        if isinstance(update, Update):
+            attrs["update_id"] = update.update_id
+            if update.effective_user is not None:
+                attrs["user_id"] = key = update.effective_user.id
+            elif update.effective_chat is not None:
+                key = update.effective_chat.id
+        # Сначала очередь пользователя, потом общий слот: обновления, ждущие своей очереди, не занимают слоты
+        started = time.monotonic()
+        async with update_locks.hold(key), update_slots:
+            metrics.observe("update_wait_seconds", time.monotonic() - started)
+            with tracing.trace("update", **attrs):
+                if isinstance(update, Update):
+                    await flush_albums_before(update)
+                await super().process_update(update)
+
+def build_application() -> Application:
+    """Создает приложение и регистрирует обработчики"""
+    app = (
+        ApplicationBuilder()
+        .application_class(TracedApplication)
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_BASE_URL)
+        .base_file_url(TELEGRAM_BASE_FILE_URL)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(outbound_limiter)
+        .concurrent_updates(CONCURRENT_UPDATES_WAITING if CONCURRENT_UPDATES > 1 else False)
+        .build()
+    )
+
+    # Добавляем обработчик ошибок
+    async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик ошибок для логирования исключений"""
+        logger.error(f"❌ Ошибка при обработке обновления: {context.error}")
+        if update and hasattr(update, 'message') and update.message:
+            try:
+                await update.message.reply_text(
+                    "❌ Произошла ошибка при обработке сообщения.\n"
+                    "Попробуйте еще раз или обратитесь к администратору."
+                )
+            except Exception as e:
+                logger.error(f"❌ Не удалось отправить сообщение об ошибке: {e}")
+
+    app.add_error_handler(error_handler)
+
+    # Обновления, пришедшие во время прогрева, ждут его окончания
+    app.add_handler(TypeHandler(Update, wait_until_ready), group=-1)
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reset", reset_invoice))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("status", status))
+    app.add_handler(CommandHandler("current", current_invoice))
+    app.add_handler(CommandHandler("cleanup", cleanup))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("menu", show_menu))
+    app.add_handler(CommandHandler("adduser", add_user))
+    app.add_handler(CommandHandler("removeuser", remove_user))
+    app.add_handler(CommandHandler("listusers", list_users))
+    app.add_handler(CommandHandler("userinfo", user_info))
+    app.add_handler(CommandHandler("failed", failed_uploads))
+    app.add_handler(CommandHandler("requeue", requeue_upload))
+    app.add_handler(CommandHandler("reindex", reindex_duplicates))
+    app.add_handler(CommandHandler("manifests", rebuild_manifests))
+    app.add_handler(CommandHandler("slow", slow_stages))
+    app.add_handler(CallbackQueryHandler(handle_main_menu_callback, pattern="^menu_"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.VIDEO, handle_video))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+
+    logger.info("✅ Все обработчики команд зарегистрированы")
+    return app
+
 def main():
     logger.info("🚀 Запуск Telegram бота...")
     
     try:
-        # Загружаем список разрешенных пользователей
-        global ALLOWED_USERS
-        ALLOWED_USERS = load_allowed_users()
-        logger.info(f"👥 Загружено {len(ALLOWED_USERS)} разрешенных пользователей")
-        
-        app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-
-        # Добавляем обработчик ошибок
-        async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-            """Обработчик ошибок для логирования исключений"""
-            logger.error(f"❌ Ошибка при обработке обновления: {context.error}")
-            if update and hasattr(update, 'message') and update.message:
-                try:
-                    await update.message.reply_text(
-                        "❌ Произошла ошибка при обработке сообщения.\n"
-                        "Попробуйте еще раз или обратитесь к администратору."
-                    )
-                except Exception as e:
-                    logger.error(f"❌ Не удалось отправить сообщение об ошибке: {e}")
-
-        app.add_error_handler(error_handler)
-
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("reset", reset_invoice))
-        app.add_handler(CommandHandler("stats", stats))
-        app.add_handler(CommandHandler("status", status))
-        app.add_handler(CommandHandler("current", current_invoice))
-        app.add_handler(CommandHandler("cleanup", cleanup))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(CommandHandler("menu", show_menu))
-        app.add_handler(CommandHandler("adduser", add_user))
-        app.add_handler(CommandHandler("removeuser", remove_user))
-        app.add_handler(CommandHandler("listusers", list_users))
-        app.add_handler(CommandHandler("userinfo", user_info))
-        app.add_handler(CallbackQueryHandler(handle_main_menu_callback, pattern="^menu_"))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        app.add_handler(MessageHandler(filters.VIDEO, handle_video))
-        app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-
-        logger.info("✅ Все обработчики команд зарегистрированы")
+        # Несколько процессов: этот процесс только принимает webhook и раздает обновления
+        if WEBHOOK_WORKERS > 1:
+            run_dispatcher(WEBHOOK_WORKERS, "0.0.0.0", int(os.environ.get("PORT", 8443)),
+                           os.environ.get("WEBHOOK_URL", "https://gidromag-bot.onrender.com/"))
+            return
+
+        app = build_application()
+
         logger.info(f"🌐 Запуск webhook на порту {os.environ.get('PORT', 8443)}")
         logger.info(f"🔗 Webhook URL: {os.environ.get('WEBHOOK_URL', 'https://gidromag-bot.onrender.com/')}")
 
@@ -0,0 +1,67 @@
+"""
+Ограниченный LRU-кэш с временем жизни записей
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    LRU-кэш на maxsize записей, каждая запись живет ttl секунд.
+
+    Попадания и промахи учитываются в метриках cache_hits_total / cache_misses_total
+    с меткой cache=<name>, размер — в cache_size.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, tuple[Any, float]]" = OrderedDict()
+        metrics.register_gauge("cache_size", lambda: len(self._data), cache=name)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > self._clock():
+                self._data.move_to_end(key)
+                metrics.inc("cache_hits_total", cache=self.name)
+                return value
+            del self._data[key]
+        metrics.inc("cache_misses_total", cache=self.name)
+        return default
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key: Hashable, value: Any = True) -> None:
+        self._data[key] = (value, self._clock() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Размер кэша и счетчики попаданий/промахов"""
+        return {
+            "size": len(self._data),
+            "hits": int(metrics.get_counter("cache_hits_total", cache=self.name)),
+            "misses": int(metrics.get_counter("cache_misses_total", cache=self.name)),
+        }
@@ -8,6 +8,9 @@ from typing import List
 # Токены (берутся из переменных окружения)
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 YANDEX_DISK_TOKEN = os.environ.get("YANDEX_DISK_TOKEN")
+# Адреса Bot API (локальный сервер Bot API или заменитель в бенчмарках)
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_BASE_FILE_URL = os.environ.get("TELEGRAM_BASE_FILE_URL", "https://api.telegram.org/file/bot")
 
 # Основные настройки
 BASE_FOLDER = "Фото оборудования"
@@ -32,6 +35,8 @@ AUTO_EXIT_AFTER_PHOTO = False  # Автоматически выходить и
 PHOTOS_FOR_AUTO_EXIT = 0  # Количество фото для автоматического выхода (0 = отключено)
 SHOW_PHOTO_COUNT = True  # Показывать количество загруженных фото
 INACTIVITY_TIMEOUT_SECONDS = 600  # 10 минут бездействия для автосброса накладной
+SESSION_SWEEP_INTERVAL = 15  # Как часто проверять истекшие сессии, секунды
+SESSION_EXPIRY_NOTIFY = True  # Сообщать пользователю об автосбросе накладной
 
 # Валидация
 INVOICE_MIN_LENGTH = 3
@@ -43,6 +48,99 @@ TEMP_DIR = "/tmp"
 TEMP_FILE_CLEANUP_INTERVAL = 3600  # 1 час в секундах
 TEMP_FILE_MAX_AGE = 3600  # 1 час в секундах
 
+# Клиент Яндекс.Диска
+YANDEX_MAX_CONNECTIONS = 20  # Максимум одновременных соединений в пуле
+YANDEX_MAX_KEEPALIVE_CONNECTIONS = 10  # Сколько соединений держать открытыми
+YANDEX_KEEPALIVE_EXPIRY = 30.0  # Время жизни простаивающего соединения, секунды
+YANDEX_EXECUTOR_WORKERS = 4  # Потоки для синхронного клиента (резервный режим)
+FOLDER_CACHE_SIZE = 512  # Сколько известных папок накладных держать в кэше
+FOLDER_CACHE_TTL = 3600  # Время жизни записи кэша папок, секунды
+WRITE_CHECK_TTL = 1800  # Как долго доверять проверке записи в папку, секунды
+QUOTA_REFRESH_INTERVAL = 300  # Как часто запрашивать свободное место на диске, секунды
+QUOTA_SAFETY_MARGIN = 50 * 1024 * 1024  # Запас свободного места, который не занимаем, байты
+YANDEX_RETRY_ATTEMPTS = 3  # Попыток для идемпотентных запросов (проверки, метаданные, создание папок)
+YANDEX_RETRY_BASE_DELAY = 0.5  # Задержка перед первым повтором, секунды (дальше удваивается, со случайным разбросом)
+YANDEX_RETRY_MAX_DELAY = 8.0  # Максимальная задержка между повторами, секунды
+YANDEX_BREAKER_THRESHOLD = 5  # Ошибок подряд, после которых запросы к диску временно прекращаются
+YANDEX_BREAKER_RESET_TIMEOUT = 30.0  # Пауза до пробного запроса, секунды
+
+# Перенос файлов из Telegram на Яндекс.Диск
+STREAMING_ENABLED = True  # Передавать файлы потоком, без временного файла на диске
+STREAM_CHUNK_SIZE = 256 * 1024  # Размер чанка потоковой передачи
+STREAM_BUFFER_CHUNKS = 8  # Сколько чанков может ждать загрузки (пиковая память ~2MB)
+# Файлы от этого размера скачиваются с докачкой через spool-файл (0 — отключить).
+# Меньше 20MB: больше публичный Bot API через getFile не отдает
+RESUMABLE_MIN_SIZE = int(os.environ.get("RESUMABLE_MIN_SIZE", 10 * 1024 * 1024))
+SPOOL_DIR = os.path.join(TEMP_DIR, "gidromag_spool")  # Папка spool-файлов
+SPOOL_MAX_AGE = 24 * 3600  # Через сколько секунд удалять заброшенные spool-файлы
+PROGRESS_UPDATE_INTERVAL = 5.0  # Как часто обновлять сообщение о ходе передачи большого файла, секунды
+
+# Пропуск повторно присланных файлов
+DEDUP_ENABLED = True  # Не загружать файл, если такое же содержимое уже есть в накладной
+DEDUP_SCOPE = os.environ.get("DEDUP_SCOPE", "invoice")  # invoice или global (копировать файл из другой накладной на стороне Яндекс.Диска)
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "dedup.sqlite3"))
+DEDUP_BUFFER_MAX = 16 * 1024 * 1024  # Файлы до этого размера проверяются на дубликат до загрузки (скачиваются в память)
+DEDUP_LIST_PAGE_SIZE = 1000  # Сколько файлов папки запрашивать за раз при восстановлении индекса
+
+# Манифесты накладных: список файлов рядом с файлами на Яндекс.Диске и локальный индекс всех накладных
+MANIFEST_ENABLED = True  # Восстанавливать счетчики накладной при повторном вводе ее номера
+MANIFEST_NAME = ".manifest.json"  # Имя файла манифеста в папке накладной
+MANIFEST_DB_PATH = os.environ.get("MANIFEST_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "manifests.sqlite3"))
+MANIFEST_WRITE_DELAY = 2.0  # Сколько секунд собирать загрузки перед записью манифеста (один файл на альбом)
+MANIFEST_REBUILD_CONCURRENCY = 4  # Сколько папок перестраивать одновременно
+
+# Фоновые загрузки
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))  # Количество параллельных воркеров загрузки
+UPLOAD_QUEUE_SIZE = 200  # Максимум файлов в очереди на загрузку
+ALBUM_WINDOW = 1.0  # Сколько ждать следующий файл альбома, секунды
+ALBUM_MAX_FILES = 10  # Больше файлов в альбоме Telegram не бывает
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3"))
+JOB_MAX_ATTEMPTS = 5  # Попыток загрузки до переноса задачи в неудачные
+JOB_RETRY_BASE_DELAY = 5.0  # Задержка перед первым повтором, секунды (дальше удваивается)
+JOB_RETRY_MAX_DELAY = 600.0  # Максимальная задержка между повторами, секунды
+JOB_POLL_INTERVAL = 5.0  # Как часто обработчик забирает задачи своих пользователей, возвращенные /requeue в другом процессе (WEBHOOK_WORKERS > 1)
+
+# Хранилище состояния (накладные, счетчики, статистика)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")  # memory или sqlite
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "state.sqlite3"))
+STATE_FLUSH_INTERVAL = 1.0  # Как часто сохранять изменения на диск, секунды
+
+# Исходящие сообщения (ограничения Telegram)
+SEND_GLOBAL_RATE = 30.0  # Сообщений в секунду на всего бота
+SEND_GLOBAL_BURST = 30  # Сколько сообщений можно отправить разом
+SEND_PER_CHAT_RATE = 1.0  # Сообщений в секунду в один личный чат
+SEND_PER_CHAT_BURST = 3  # Короткий всплеск сообщений в один чат
+SEND_GROUP_CHAT_RATE = 20 / 60  # Сообщений в секунду в одну группу
+SEND_MAX_RETRIES = 3  # Повторов после RetryAfter
+
+# Доступ к боту
+ACL_REFRESH_MIN_INTERVAL = 60  # Не чаще чем раз в столько секунд проверять список пользователей на Яндекс.Диске
+ACL_DENIED_TTL = 300  # Сколько секунд помнить отказ в доступе
+ACL_DENIED_CACHE_SIZE = 10000  # Сколько отказов помнить
+
+# Запуск
+STARTUP_READY_TIMEOUT = 60  # Сколько обновление может ждать окончания прогрева при запуске, секунды
+
+# Несколько процессов-обработчиков за одним портом webhook (1 — один процесс, как раньше)
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 1))
+WEBHOOK_WORKER_INDEX = int(os.environ.get("WEBHOOK_WORKER_INDEX", 0))  # Номер обработчика, задается диспетчером
+WORKER_RESTART_DELAY = 1.0  # Пауза перед перезапуском упавшего обработчика, секунды
+WORKER_STOP_TIMEOUT = 30.0  # Сколько ждать завершения обработчиков при остановке, секунды
+
+# Параллельная обработка обновлений: разные пользователи — одновременно, обновления одного пользователя — по порядку
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 16))  # Сколько обновлений обрабатывается одновременно (1 — по одному, как раньше)
+CONCURRENT_UPDATES_WAITING = 1024  # Сколько обновлений может ждать своей очереди
+
+# Метрики Prometheus (при WEBHOOK_WORKERS > 1 их отдает диспетчер на порту webhook)
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")  # Пустая строка отключает маршрут
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9090))  # Отдельный порт сервера метрик в режиме одного процесса, 0 отключает
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # Если задан, нужен заголовок Authorization: Bearer <токен>
+
+# Трассировка этапов обработки (JSON в логгер trace, медленные этапы — в /slow)
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.05))  # Доля записываемых обновлений и загрузок, 0 отключает
+TRACE_LOG_MIN_DURATION = 0.0  # Писать в лог только трассы не короче, секунды
+TRACE_SLOWEST_SIZE = 20  # Сколько самых медленных этапов помнить для /slow
+
 # Администраторы (замените на реальные ID)
 ADMIN_IDS: List[int] = [
     177611260,  # Замените на реальные ID администраторов
@@ -57,14 +155,28 @@ ERROR_MESSAGES = {
     "quota_exceeded": "❌ Превышен лимит Яндекс.Диска\n\nОбратитесь к администратору для увеличения места.",
     "network_error": "❌ Проблема с сетью\n\nПопробуйте позже или проверьте интернет-соединение.",
     "access_denied": "❌ Нет доступа к Яндекс.Диску\n\nПроверьте токен и права доступа.",
+    "yandex_rate_limited": "❌ Яндекс.Диск ограничил число запросов\n\nПопробуйте чуть позже.",
+    "yandex_unavailable": "⏳ Яндекс.Диск временно не отвечает\n\nПопробуйте позже.",
+    "telegram_error": "❌ Не удалось получить файл из Telegram\n\nПопробуйте отправить файл еще раз чуть позже.",
     "file_too_large": "❌ Файл слишком большой!\n\nМаксимальный размер: {max_size}MB\nТекущий размер: {current_size}MB",
     "video_too_large": "❌ Видео слишком большое!\n\nМаксимальный размер: {max_size}MB\nТекущий размер: {current_size}MB",
+    "document_too_large": "❌ Документ слишком большой!\n\nМаксимальный размер: {max_size}MB\nТекущий размер: {current_size}MB",
     "unsupported_format": "❌ Неподдерживаемый формат файла!\n\nПоддерживаются фото: JPG, JPEG, PNG\nПоддерживаются видео: MP4, AVI, MOV, MKV, WMV, FLV, WEBM, M4V, 3GP, 3G2, F4V, ASF",
     "unsupported_photo_format": "❌ Неподдерживаемый формат фото!\n\nПоддерживаются только: JPG, JPEG, PNG",
     "unsupported_video_format": "❌ Неподдерживаемый формат видео!\n\nПоддерживаются только: MP4, AVI, MOV, MKV, WMV, FLV, WEBM, M4V, 3GP, 3G2, F4V, ASF\nПоддерживается разрешение до 4K",
     "unsupported_document_format": "❌ Неподдерживаемый формат документа!\n\nПоддерживаются только: PDF, DOC, DOCX, XLS, XLSX",
     "invoice_limit_reached": "❌ Достигнут лимит файлов для накладной '{invoice}'\n\nМаксимум: {max_photos} фото и {max_videos} видео\nТекущее количество: {current_photos} фото, {current_videos} видео\n\nИспользуйте /reset для сброса и начала новой накладной.",
-    "video_limit_reached": "❌ Достигнут лимит видео для накладной '{invoice}'\n\nМаксимум: {max_videos} видео\nТекущее количество: {current_videos}\n\nИспользуйте /reset для сброса и начала новой накладной.",
+    "photo_limit_reached": "❌ Достигнут лимит фото для накладной '{invoice}'\n\nМаксимум: {max} фото\nТекущее количество: {current}\n\nИспользуйте /reset для сброса и начала новой накладной.",
+    "video_limit_reached": "❌ Достигнут лимит видео для накладной '{invoice}'\n\nМаксимум: {max} видео\nТекущее количество: {current}\n\nИспользуйте /reset для сброса и начала новой накладной.",
+    "document_limit_reached": "❌ Достигнут лимит документов для накладной '{invoice}'\n\nМаксимум: {max} документов\nТекущее количество: {current}\n\nИспользуйте /reset для сброса и начала новой накладной.",
+    "album_file_too_large": "слишком большой ({current_size}MB, максимум {max_size}MB)",
+    "album_unsupported_format": "неподдерживаемый формат",
+    "album_limit_reached": "превышен лимит накладной ({max})",
+    "album_file_unavailable": "не удалось получить файл из Telegram",
+    "album_queue_full": "очередь загрузок переполнена",
+    "album_disk_full": "недостаточно места на Яндекс.Диске",
+    "disk_full": "❌ Недостаточно места на Яндекс.Диске\n\nФайл ({size}) не поместится: свободно {free}. Обратитесь к администратору для увеличения места.",
+    "upload_queue_full": "⏳ Сейчас загружается слишком много файлов.\n\nПопробуйте отправить файл чуть позже.",
     "invoice_validation": "❌ {error}\n\nПопробуйте еще раз или используйте команду /reset для сброса.",
 }
 
@@ -74,6 +186,10 @@ SUCCESS_MESSAGES = {
     "photo_saved": "✅ Фото успешно сохранено!\n\n📋 Накладная: {invoice}\n📁 Папка: {folder}\n📸 Файл: {filename}\n📏 Размер: {size}\n📊 Фото в накладной: {current}/{max}",
     "video_saved": "✅ Видео успешно сохранено!\n\n📋 Накладная: {invoice}\n📁 Папка: {folder}\n🎥 Файл: {filename}\n📏 Размер: {size}\n📊 Видео в накладной: {current}/{max}",
     "document_saved": "✅ Документ успешно сохранен!\n\n📋 Накладная: {invoice}\n📁 Папка: {folder}\n📄 Файл: {filename}\n📏 Размер: {size}\n📊 Документы в накладной: {current}/{max}",
+    "photo_uploaded": "📸 Фото загружено! Всего в накладной: {current}/{max}\n\nПродолжайте загружать фото или используйте /reset для завершения накладной.",
+    "video_uploaded": "🎥 Видео загружено! Всего в накладной: {current}/{max}\n\nПродолжайте загружать файлы или используйте /reset для завершения накладной.",
+    "document_uploaded": "📄 Документ загружен! Всего в накладной: {current}/{max}\n\nПродолжайте загружать файлы или используйте /reset для завершения накладной.",
+    "album_summary": "📦 Альбом для накладной '{invoice}': загружено {uploaded} из {total}\n\n{files}\n\n📊 В накладной: {counts}\n\nПродолжайте загружать файлы или используйте /reset для завершения накладной.",
     "invoice_reset": "🔄 Накладная '{invoice}' сброшена.\n📸 Было загружено фото: {photo_count}\n🎥 Было загружено видео: {video_count}\n📄 Было загружено документов: {document_count}\n\nПришлите новый номер накладной.",
     "folder_created": "✅ Создана папка на Яндекс.Диске: {path}",
     "temp_file_cleaned": "🗑️ Временный файл удален: {path}",
@@ -87,8 +203,21 @@ INFO_MESSAGES = {
     "folder_exists": "📁 Папка уже существует: {path}",
     "write_test_warning": "⚠️ Предупреждение: возможны проблемы с правами записи в папку.",
     "approaching_limit": "⚠️ Внимание! Приближается лимит файлов для накладной '{invoice}'\nОсталось: {remaining_photos} фото, {remaining_videos} видео",
+    "approaching_photo_limit": "⚠️ Внимание! Приближается лимит фото для накладной '{invoice}'\nОсталось: {remaining} фото",
     "approaching_video_limit": "⚠️ Внимание! Приближается лимит видео для накладной '{invoice}'\nОсталось: {remaining} видео",
+    "approaching_document_limit": "⚠️ Внимание! Приближается лимит документов для накладной '{invoice}'\nОсталось: {remaining} документов",
+    "photo_accepted": "📥 Фото принято, загружаю на Яндекс.Диск...",
+    "video_accepted": "📥 Видео принято, загружаю на Яндекс.Диск...",
+    "document_accepted": "📥 Документ принят, загружаю на Яндекс.Диск...",
     "session_expired": "⏳ Прошло более 10 минут бездействия. Накладная сброшена.\n\nПришлите новый номер накладной.",
+    "duplicate_skipped": "♻️ Этот файл уже есть в накладной '{invoice}': {filename}\n\nПовторно не загружен. Продолжайте загружать файлы или используйте /reset для завершения накладной.",
+    "album_duplicate": "уже есть в накладной ({filename})",
+    "album_duplicates": "♻️ Пропущено дубликатов: {count}",
+    "progress_download": "📥 Получаю файл из Telegram ({size})\n{bar} {percent}%",
+    "progress_upload": "📤 Загружаю на Яндекс.Диск ({size})\n{bar} {percent}%",
+    "progress_interrupted": "⚠️ Передача прервалась. Повторю автоматически, уже полученная часть файла сохранена.",
+    "progress_done": "✅ Файл передан ({size})",
+    "upload_deferred": "⏳ Яндекс.Диск сейчас не отвечает. Файл в очереди и загрузится автоматически, когда диск станет доступен.",
 }
 
 # Статистика
@@ -114,6 +243,10 @@ HELP_MESSAGE = """🤖 **Справка по командам**
 • /adduser <ID> - Добавить пользователя в список разрешенных
 • /removeuser <ID> - Удалить пользователя из списка разрешенных
 • /listusers - Показать список всех разрешенных пользователей
+• /failed - Неудачные загрузки
+• /requeue <ID> - Повторить неудачную загрузку
+• /reindex [накладная] - Перестроить индекс дубликатов
+• /slow - Самые медленные этапы обработки
 • /cleanup - Очистка временных файлов
 
 📋 **Как использовать:**
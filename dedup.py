@@ -0,0 +1,143 @@
+"""
+Индекс содержимого загруженных файлов для пропуска повторных загрузок (SQLite)
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from config import DEDUP_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    folder TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    file_unique_id TEXT,
+    added_at REAL NOT NULL,
+    PRIMARY KEY (folder, md5, size)
+);
+CREATE INDEX IF NOT EXISTS file_hashes_content ON file_hashes (md5, size);
+CREATE INDEX IF NOT EXISTS file_hashes_unique_id ON file_hashes (folder, file_unique_id);
+CREATE TABLE IF NOT EXISTS indexed_folders (
+    folder TEXT PRIMARY KEY,
+    indexed_at REAL NOT NULL
+);
+"""
+
+
+class DedupIndex:
+    """
+    md5 и размер файлов, уже лежащих в папках накладных (ключ — путь папки).
+
+    Дубликат в той же папке не загружается повторно; при глобальном поиске
+    (find_any) файл из другой накладной копируется на стороне Яндекс.Диска.
+    Индекс — только кэш: Яндекс.Диск хранит md5 каждого файла, поэтому записи
+    папки восстанавливаются по ее содержимому (replace_folder).
+    """
+
+    def __init__(self, path: str = DEDUP_DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def find(self, folder: str, md5: str, size: int) -> Optional[str]:
+        """Путь файла с таким содержимым в папке"""
+        row = self.conn.execute(
+            "SELECT path FROM file_hashes WHERE folder = ? AND md5 = ? AND size = ?",
+            (folder, md5, size)
+        ).fetchone()
+        return row[0] if row else None
+
+    def find_any(self, md5: str, size: int) -> Optional[str]:
+        """Путь файла с таким содержимым в любой папке"""
+        row = self.conn.execute(
+            "SELECT path FROM file_hashes WHERE md5 = ? AND size = ? ORDER BY added_at LIMIT 1",
+            (md5, size)
+        ).fetchone()
+        return row[0] if row else None
+
+    def find_unique_id(self, folder: str, file_unique_id: str) -> Optional[str]:
+        """Путь файла в папке, загруженного из того же файла Telegram"""
+        row = self.conn.execute(
+            "SELECT path FROM file_hashes WHERE folder = ? AND file_unique_id = ?",
+            (folder, file_unique_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, folder: str, md5: str, size: int, path: str, file_unique_id: str = None) -> None:
+        self.conn.execute(
+            "INSERT INTO file_hashes (folder, md5, size, path, file_unique_id, added_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(folder, md5, size) DO UPDATE SET "
+            "file_unique_id = COALESCE(excluded.file_unique_id, file_unique_id)",
+            (folder, md5, size, path, file_unique_id, time.time())
+        )
+
+    def remember_unique_id(self, folder: str, md5: str, size: int, file_unique_id: str) -> None:
+        """Связывает еще один файл Telegram с уже загруженным содержимым"""
+        self.conn.execute(
+            "UPDATE file_hashes SET file_unique_id = ? WHERE folder = ? AND md5 = ? AND size = ?",
+            (file_unique_id, folder, md5, size)
+        )
+
+    def discard_path(self, path: str) -> None:
+        """Файла больше нет на диске"""
+        self.conn.execute("DELETE FROM file_hashes WHERE path = ?", (path,))
+
+    def is_indexed(self, folder: str) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM indexed_folders WHERE folder = ?", (folder,)
+        ).fetchone() is not None
+
+    def replace_folder(self, folder: str, entries: Iterable[tuple]) -> int:
+        """
+        Заменяет записи папки списком (md5, size, path) ее файлов на диске.
+        Связи с файлами Telegram для оставшихся файлов сохраняются.
+        """
+        entries = list(entries)
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            unique_ids = dict(self.conn.execute(
+                "SELECT path, file_unique_id FROM file_hashes WHERE folder = ?", (folder,)
+            ).fetchall())
+            self.conn.execute("DELETE FROM file_hashes WHERE folder = ?", (folder,))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO file_hashes (folder, md5, size, path, file_unique_id, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(folder, md5, size, path, unique_ids.get(path), now) for md5, size, path in entries]
+            )
+            self.conn.execute(
+                "INSERT INTO indexed_folders (folder, indexed_at) VALUES (?, ?) "
+                "ON CONFLICT(folder) DO UPDATE SET indexed_at = excluded.indexed_at",
+                (folder, now)
+            )
+        return len(entries)
+
+    def counts(self) -> dict:
+        return {
+            "files": self.conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0],
+            "folders": self.conn.execute("SELECT COUNT(*) FROM indexed_folders").fetchone()[0],
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,164 @@
+"""
+Хранилище задач загрузки в SQLite (режим WAL)
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+from config import JOBS_DB_PATH, WEBHOOK_WORKERS, WEBHOOK_WORKER_INDEX
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = (
+    "kind", "user_id", "chat_id", "message_id", "invoice",
+    "folder_path", "file_name", "file_size", "file_id",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    invoice TEXT NOT NULL,
+    folder_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    invoice TEXT NOT NULL,
+    folder_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL
+);
+"""
+
+
+class JobStore:
+    """
+    Очередь задач загрузки, переживающая перезапуск процесса.
+
+    Каждый принятый файл записывается в jobs до ответа пользователю и удаляется
+    после успешной загрузки. Задачи, исчерпавшие попытки, переносятся в dead_jobs,
+    откуда администратор может вернуть их в очередь.
+    Файл общий для всех процессов-обработчиков; после перезапуска каждый
+    продолжает задачи своих пользователей (shard = (номер, всего)).
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH, shard: Tuple[int, int] = (WEBHOOK_WORKER_INDEX, WEBHOOK_WORKERS)):
+        self.path = path
+        self.shard = shard
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Соединение открывается при первом обращении, импорт модуля не трогает диск
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            logger.info(f"🗄️ Очередь задач загрузки: {self.path}")
+        return self._conn
+
+    def add(self, job) -> int:
+        """Записывает новую задачу, возвращает ее id"""
+        now = time.time()
+        values = [getattr(job, column) for column in JOB_COLUMNS]
+        cursor = self.conn.execute(
+            f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}, attempts, next_attempt_at, created_at) "
+            f"VALUES ({', '.join('?' * len(JOB_COLUMNS))}, 0, ?, ?)",
+            (*values, now, now)
+        )
+        return cursor.lastrowid
+
+    def reschedule(self, job_id: int, attempts: int, next_attempt_at: float, error: str) -> None:
+        self.conn.execute(
+            "UPDATE jobs SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, next_attempt_at, error, job_id)
+        )
+
+    def complete(self, job_id: int) -> None:
+        self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def bury(self, job_id: int, attempts: int, error: str) -> None:
+        """Переносит задачу в таблицу неудачных"""
+        columns = ", ".join(JOB_COLUMNS)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO dead_jobs (id, {columns}, attempts, last_error, created_at, failed_at) "
+                f"SELECT id, {columns}, ?, ?, created_at, ? FROM jobs WHERE id = ?",
+                (attempts, error, time.time(), job_id)
+            )
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def pending(self) -> List[sqlite3.Row]:
+        """Незавершенные задачи пользователей этого процесса в порядке поступления"""
+        index, workers = self.shard
+        return self.conn.execute(
+            "SELECT * FROM jobs WHERE user_id % ? = ? ORDER BY id", (workers, index)
+        ).fetchall()
+
+    def owns(self, user_id: int) -> bool:
+        """Задачи пользователя выполняет этот процесс"""
+        index, workers = self.shard
+        return user_id % workers == index
+
+    def dead(self, limit: int = 20) -> List[sqlite3.Row]:
+        """Последние неудачные задачи"""
+        return self.conn.execute(
+            "SELECT * FROM dead_jobs ORDER BY failed_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    def requeue(self, job_id: int) -> Optional[sqlite3.Row]:
+        """Возвращает неудачную задачу в очередь, сбрасывая счетчик попыток"""
+        columns = ", ".join(JOB_COLUMNS)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            row = self.conn.execute("SELECT id FROM dead_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                self.conn.execute("ROLLBACK")
+                return None
+            self.conn.execute(
+                f"INSERT INTO jobs (id, {columns}, attempts, next_attempt_at, created_at) "
+                f"SELECT id, {columns}, 0, ?, created_at FROM dead_jobs WHERE id = ?",
+                (time.time(), job_id)
+            )
+            self.conn.execute("DELETE FROM dead_jobs WHERE id = ?", (job_id,))
+        return self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def counts(self) -> dict:
+        return {
+            "pending": self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0],
+            "dead": self.conn.execute("SELECT COUNT(*) FROM dead_jobs").fetchone()[0],
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,80 @@
+"""
+Учет мест в накладных: загруженные файлы и резервы под файлы, которые еще загружаются
+"""
+
+import logging
+from collections import Counter
+from typing import Dict
+
+import metrics
+from state import KINDS
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceLedger:
+    """
+    Места в накладной по ключу (пользователь, накладная, тип файла).
+
+    Загруженные файлы считает хранилище состояния (state.get_count / add_file),
+    здесь — резервы под принятые, но еще не загруженные файлы. Место резервируется
+    до скачивания файла: reserve() проверяет лимит с учетом загруженных и уже
+    зарезервированных файлов и занимает место без единого await, поэтому параллельные
+    загрузки одной накладной не превышают лимит. Загруженный файл переводит резерв
+    в счетчик (commit), окончательно не загруженный или не принятый — освобождает (release).
+    Резервы не сохраняются: после перезапуска их восстанавливают задачи из JobStore (hold).
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._reserved: Counter = Counter()
+        metrics.register_gauge("invoice_reservations", lambda: sum(self._reserved.values()))
+
+    def reserved(self, user_id: int, invoice: str, kind: str) -> int:
+        """Сколько файлов ждут, выполняют или повторяют загрузку"""
+        return self._reserved[(user_id, invoice, kind)]
+
+    def reservations(self, user_id: int, invoice: str) -> Dict[str, int]:
+        return {kind: self._reserved[(user_id, invoice, kind)] for kind in KINDS}
+
+    def used(self, user_id: int, invoice: str, kind: str) -> int:
+        """Загруженные и зарезервированные места"""
+        return self.state.get_count(user_id, invoice, kind) + self.reserved(user_id, invoice, kind)
+
+    def reserve(self, user_id: int, invoice: str, kind: str, limit: int) -> bool:
+        """Занимает место, если накладная не заполнена. Возвращает False, если мест нет."""
+        if self.used(user_id, invoice, kind) >= limit:
+            metrics.inc("invoice_reservations_total", result="rejected")
+            return False
+        self._reserved[(user_id, invoice, kind)] += 1
+        metrics.inc("invoice_reservations_total", result="reserved")
+        return True
+
+    def hold(self, user_id: int, invoice: str, kind: str) -> None:
+        """Резерв без проверки лимита: задача уже была принята (продолжение после перезапуска, /requeue)"""
+        self._reserved[(user_id, invoice, kind)] += 1
+
+    def release(self, user_id: int, invoice: str, kind: str) -> None:
+        """Файл не будет загружен — место освобождается"""
+        if self._take(user_id, invoice, kind):
+            metrics.inc("invoice_reservations_total", result="released")
+
+    def commit(self, user_id: int, invoice: str, kind: str) -> int:
+        """
+        Файл загружен: резерв переходит в счетчик накладной.
+        Возвращает значение счетчика (0, если накладную уже сбросили).
+        """
+        if self._take(user_id, invoice, kind):
+            metrics.inc("invoice_reservations_total", result="committed")
+        return self.state.add_file(user_id, invoice, kind)
+
+    def _take(self, user_id: int, invoice: str, kind: str) -> bool:
+        """Снимает резерв. Возвращает False, если резерва нет (ошибка учета, счетчик не уходит в минус)."""
+        key = (user_id, invoice, kind)
+        if self._reserved[key] <= 0:
+            logger.warning(f"⚠️ Снятие несуществующего резерва: пользователь {user_id}, накладная '{invoice}', {kind}")
+            return False
+        self._reserved[key] -= 1
+        if self._reserved[key] <= 0:
+            del self._reserved[key]
+        return True
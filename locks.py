@@ -0,0 +1,52 @@
+"""
+Блокировки по ключу: обновления одного пользователя выполняются по очереди, разных — параллельно
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable
+
+import metrics
+
+
+class KeyedLock:
+    """
+    asyncio.Lock на каждый ключ. Блокировка создается при первом обращении и удаляется,
+    когда ее никто не держит и не ждет, поэтому словарь не растет с числом пользователей.
+
+    Порядок сохраняется: до ожидания блокировки в hold() нет ни одного await, а asyncio.Lock
+    пропускает ожидающих в порядке очереди. Число ключей, по которым сейчас кто-то держит
+    или ждет блокировку, — в метрике keyed_locks_active с меткой lock=<name>.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._holders: Dict[Hashable, int] = {}
+        metrics.register_gauge("keyed_locks_active", lambda: len(self._locks), lock=name)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def locked(self, key: Hashable) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def waiting(self, key: Hashable) -> int:
+        """Сколько задач держат или ждут блокировку ключа"""
+        return self._holders.get(key, 0)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
@@ -0,0 +1,357 @@
+"""
+Манифесты накладных: список загруженных файлов рядом с файлами на Яндекс.Диске
+и локальный индекс всех накладных, по которому восстанавливаются счетчики
+"""
+
+import asyncio
+import json
+import logging
+import os
+import posixpath
+import sqlite3
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import yadisk
+
+import metrics
+from config import (
+    MANIFEST_DB_PATH, MANIFEST_NAME, MANIFEST_WRITE_DELAY, MANIFEST_REBUILD_CONCURRENCY, DEDUP_LIST_PAGE_SIZE
+)
+from pipeline import MEDIA_POLICIES
+from state import KINDS
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+ENTRY_FIELDS = ("name", "kind", "size", "md5", "user_id", "uploaded_at")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest_folders (
+    folder TEXT PRIMARY KEY,
+    invoice TEXT NOT NULL,
+    source TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifest_files (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT,
+    user_id INTEGER,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+"""
+
+
+def kind_of(name: str) -> Optional[str]:
+    """Тип файла по расширению (для папок, загруженных до появления манифестов)"""
+    for policy in MEDIA_POLICIES.values():
+        if policy.match_extension(name):
+            return policy.kind
+    return None
+
+
+class ManifestIndex:
+    """
+    Локальный индекс манифестов: файлы всех известных боту папок накладных (SQLite).
+
+    Папка известна, если ее список получен из манифеста, перестроен по содержимому
+    папки или папку создал сам бот; счетчики такой накладной берутся отсюда без
+    запросов к Яндекс.Диску. Загрузивший файл пользователь неизвестен только для
+    файлов, восстановленных по содержимому папки, — они учитываются всем пользователям.
+    """
+
+    def __init__(self, path: str = MANIFEST_DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def is_known(self, folder: str) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM manifest_folders WHERE folder = ?", (folder,)
+        ).fetchone() is not None
+
+    def invoice(self, folder: str) -> Optional[str]:
+        row = self.conn.execute("SELECT invoice FROM manifest_folders WHERE folder = ?", (folder,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, folder: str, invoice: str, entry: dict) -> None:
+        """Добавляет загруженный файл в список папки"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO manifest_files (folder, name, kind, size, md5, user_id, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (folder, *(entry.get(key) for key in ENTRY_FIELDS[:-1]), entry.get("uploaded_at") or now)
+            )
+            self.conn.execute(
+                "INSERT INTO manifest_folders (folder, invoice, source, updated_at) VALUES (?, ?, 'bot', ?) "
+                "ON CONFLICT(folder) DO UPDATE SET updated_at = excluded.updated_at",
+                (folder, invoice, now)
+            )
+
+    def replace_folder(self, folder: str, invoice: str, entries: Iterable[dict], source: str) -> int:
+        """Заменяет список папки (source: manifest — из манифеста, listing — по содержимому, new — новая папка)"""
+        entries = list(entries)
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM manifest_files WHERE folder = ?", (folder,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest_files (folder, name, kind, size, md5, user_id, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(folder, *(entry.get(key) for key in ENTRY_FIELDS[:-1]), entry.get("uploaded_at") or now)
+                 for entry in entries]
+            )
+            self.conn.execute(
+                "INSERT INTO manifest_folders (folder, invoice, source, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(folder) DO UPDATE SET invoice = excluded.invoice, source = excluded.source, "
+                "updated_at = excluded.updated_at",
+                (folder, invoice, source, now)
+            )
+        return len(entries)
+
+    def entries(self, folder: str) -> List[dict]:
+        rows = self.conn.execute(
+            f"SELECT {', '.join(ENTRY_FIELDS)} FROM manifest_files WHERE folder = ? ORDER BY uploaded_at, name",
+            (folder,)
+        ).fetchall()
+        return [dict(zip(ENTRY_FIELDS, row)) for row in rows]
+
+    def counts(self, folder: str, user_id: int) -> Dict[str, int]:
+        """Файлы папки по типам: загруженные пользователем и те, чей автор неизвестен"""
+        counts = {kind: 0 for kind in KINDS}
+        for kind, count in self.conn.execute(
+            "SELECT kind, COUNT(*) FROM manifest_files WHERE folder = ? AND (user_id = ? OR user_id IS NULL) "
+            "GROUP BY kind", (folder, user_id)
+        ):
+            counts[kind] = count
+        return counts
+
+    def stats(self) -> dict:
+        return {
+            "folders": self.conn.execute("SELECT COUNT(*) FROM manifest_folders").fetchone()[0],
+            "files": self.conn.execute("SELECT COUNT(*) FROM manifest_files").fetchone()[0],
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class InvoiceManifests:
+    """
+    Манифест накладной — файл MANIFEST_NAME в ее папке: JSON со списком загруженных
+    файлов (имя, тип, размер, md5, кто загрузил).
+
+    После каждой загрузки файл добавляется в локальный индекс (record), а манифест
+    переписывается из индекса целиком через write_delay секунд: альбом дает одну
+    запись на диск, а не десять. Неудачная запись повторится со следующей загрузкой.
+
+    При повторном вводе накладной (restore_counts) счетчики берутся из локального
+    индекса, а если папка ему неизвестна — из манифеста: не больше одного чтения
+    небольшого файла вместо постраничного просмотра папки. Папки без манифеста
+    перестраиваются по содержимому (rebuild), по несколько одновременно.
+    """
+
+    def __init__(self, storage, index: ManifestIndex, write_delay: float = MANIFEST_WRITE_DELAY):
+        self.storage = storage
+        self.index = index
+        self.write_delay = write_delay
+        self._dirty: set = set()
+        self._writers: Dict[str, asyncio.Task] = {}
+        metrics.register_gauge("manifest_writes_pending", lambda: len(self._dirty))
+
+    @staticmethod
+    def path(folder: str) -> str:
+        return f"{folder}/{MANIFEST_NAME}"
+
+    # Восстановление счетчиков
+
+    async def restore_counts(self, folder: str, invoice: str, user_id: int) -> Optional[Dict[str, int]]:
+        """
+        Сколько файлов пользователя уже лежит в папке накладной.
+        None, если манифеста нет (новая накладная или папка без манифеста) или его не удалось прочитать.
+        """
+        if self.index.is_known(folder):
+            metrics.inc("manifest_restores_total", source="index")
+            return self.index.counts(folder, user_id)
+        try:
+            entries = await self.read(folder)
+        except yadisk.exceptions.PathNotFoundError:
+            metrics.inc("manifest_restores_total", source="missing")
+            return None
+        except Exception as e:
+            metrics.inc("manifest_restores_total", source="error")
+            logger.warning(f"⚠️ Не удалось прочитать манифест {folder}: {e}")
+            return None
+        self.index.replace_folder(folder, invoice, entries, "manifest")
+        metrics.inc("manifest_restores_total", source="manifest")
+        return self.index.counts(folder, user_id)
+
+    async def read(self, folder: str) -> List[dict]:
+        document = json.loads(await self.storage.read_text(self.path(folder)))
+        return [
+            {key: entry.get(key) for key in ENTRY_FIELDS}
+            for entry in document.get("files", [])
+            if entry.get("name") and entry.get("kind") in KINDS
+        ]
+
+    async def ensure_known(self, folder: str, invoice: str, created: bool) -> None:
+        """
+        Перед первой загрузкой в папку, неизвестную индексу: иначе манифест перезапишется
+        списком из одного нового файла. Новая папка пуста, у старой читается манифест,
+        а если его нет — список строится по содержимому папки.
+        """
+        if self.index.is_known(folder):
+            return
+        if created:
+            self.index.replace_folder(folder, invoice, [], "new")
+            return
+        try:
+            self.index.replace_folder(folder, invoice, await self.read(folder), "manifest")
+        except yadisk.exceptions.PathNotFoundError:
+            outcome, files = await self.rebuild_folder(folder, invoice, force=True)
+            logger.info(f"📒 Манифест папки {folder} построен по ее содержимому: файлов {files}")
+
+    # Запись
+
+    def record(self, folder: str, invoice: str, entry: dict) -> None:
+        """Файл загружен в папку накладной; манифест будет переписан через write_delay"""
+        self.index.add(folder, invoice, entry)
+        self._dirty.add(folder)
+        if folder not in self._writers:
+            self._writers[folder] = asyncio.create_task(self._write_later(folder), name=f"manifest-{folder}")
+
+    async def _write_later(self, folder: str) -> None:
+        try:
+            while folder in self._dirty:
+                await asyncio.sleep(self.write_delay)
+                # Файлы, загруженные во время записи, снова отметят папку
+                self._dirty.discard(folder)
+                try:
+                    await self.write(folder)
+                except asyncio.CancelledError:
+                    self._dirty.add(folder)
+                    raise
+        finally:
+            self._writers.pop(folder, None)
+
+    async def write(self, folder: str) -> bool:
+        """Переписывает манифест папки из локального индекса"""
+        document = {
+            "version": MANIFEST_VERSION,
+            "invoice": self.index.invoice(folder) or posixpath.basename(folder),
+            "updated_at": time.time(),
+            "files": self.index.entries(folder),
+        }
+        try:
+            await self.storage.write_text(self.path(folder), json.dumps(document, ensure_ascii=False))
+        except Exception as e:
+            metrics.inc("manifest_writes_total", result="error")
+            logger.warning(f"⚠️ Не удалось записать манифест {folder}: {e}")
+            return False
+        metrics.inc("manifest_writes_total", result="ok")
+        return True
+
+    async def stop(self) -> None:
+        """Записывает отложенные манифесты, не дожидаясь задержки"""
+        writers = list(self._writers.values())
+        for task in writers:
+            task.cancel()
+        await asyncio.gather(*writers, return_exceptions=True)
+        folders = list(self._dirty)
+        self._dirty.clear()
+        await asyncio.gather(*(self.write(folder) for folder in folders))
+
+    # Перестроение по содержимому папок
+
+    async def list_folder(self, folder: str) -> list:
+        """Все ресурсы папки, постранично"""
+        items = []
+        offset = 0
+        while True:
+            page = await self.storage.list_page(folder, DEDUP_LIST_PAGE_SIZE, offset)
+            items.extend(page)
+            if len(page) < DEDUP_LIST_PAGE_SIZE:
+                return items
+            offset += len(page)
+
+    async def rebuild_folder(self, folder: str, invoice: Optional[str] = None, force: bool = False) -> Tuple[str, int]:
+        """
+        Список папки по ее содержимому; авторы файлов, уже известные индексу, сохраняются.
+        Если манифест есть и не force, он только загружается в индекс.
+        Возвращает (loaded или rebuilt, число файлов).
+        """
+        invoice = invoice or self.index.invoice(folder) or posixpath.basename(folder)
+        items = await self.list_folder(folder)
+        if not force and any(item.name == MANIFEST_NAME for item in items):
+            return "loaded", self.index.replace_folder(folder, invoice, await self.read(folder), "manifest")
+
+        known = {entry["name"]: entry for entry in self.index.entries(folder)}
+        entries = []
+        for item in items:
+            if item.type != "file" or item.name == MANIFEST_NAME:
+                continue
+            kind = kind_of(item.name)
+            if kind is None:
+                continue
+            previous = known.get(item.name, {})
+            created = getattr(item, "created", None)
+            entries.append({
+                "name": item.name,
+                "kind": kind,
+                "size": item.size or 0,
+                "md5": item.md5,
+                "user_id": previous.get("user_id"),
+                "uploaded_at": previous.get("uploaded_at") or (created.timestamp() if created else None),
+            })
+        files = self.index.replace_folder(folder, invoice, entries, "listing")
+        if not await self.write(folder):
+            raise RuntimeError(f"манифест {folder} не записан")
+        return "rebuilt", files
+
+    async def rebuild(self, folders: Iterable[str], force: bool = False,
+                      concurrency: int = MANIFEST_REBUILD_CONCURRENCY) -> Dict[str, int]:
+        """
+        Перестраивает манифесты папок, по concurrency папок одновременно.
+        Возвращает {folders, rebuilt, loaded, files, errors}.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        result = Counter()
+
+        async def rebuild_one(folder: str) -> None:
+            async with semaphore:
+                try:
+                    outcome, files = await self.rebuild_folder(folder, force=force)
+                except yadisk.exceptions.PathNotFoundError:
+                    return
+                except Exception as e:
+                    result["errors"] += 1
+                    logger.warning(f"⚠️ Не удалось перестроить манифест {folder}: {e}")
+                    return
+                result[outcome] += 1
+                result["files"] += files
+
+        folders = list(folders)
+        await asyncio.gather(*(rebuild_one(folder) for folder in folders))
+        metrics.inc("manifest_rebuilds_total", result.get("rebuilt", 0))
+        return {"folders": len(folders), **{key: result.get(key, 0) for key in ("rebuilt", "loaded", "files", "errors")}}
@@ -0,0 +1,206 @@
+"""
+Метрики бота (счетчики и показатели в памяти процесса)
+"""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_counters: Dict[MetricKey, float] = defaultdict(float)
+_gauges: Dict[MetricKey, float] = {}
+_gauge_callbacks: Dict[MetricKey, Callable[[], float]] = {}
+_histograms: Dict[MetricKey, "Histogram"] = {}
+
+# Границы корзин гистограмм длительностей, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Распределение значений по корзинам (накопительно, как в Prometheus)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+
+def _key(name: str, labels: dict) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_key(key: MetricKey) -> str:
+    """Имя метрики в виде name{label="value"}"""
+    name, labels = key
+    if not labels:
+        return name
+    rendered = ",".join(f'{k}="{v}"' for k, v in labels)
+    return f"{name}{{{rendered}}}"
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Увеличивает счетчик"""
+    _counters[_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """Устанавливает текущее значение показателя"""
+    _gauges[_key(name, labels)] = value
+
+
+def register_gauge(name: str, callback: Callable[[], float], **labels) -> None:
+    """Регистрирует показатель, значение которого вычисляется при чтении"""
+    _gauge_callbacks[_key(name, labels)] = callback
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Добавляет значение в гистограмму (например, длительность в секундах)"""
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.observe(value)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Время этапа обработки файла в pipeline_stage_seconds{stage}, ошибки — в pipeline_stage_errors_total"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("pipeline_stage_errors_total", stage=name)
+        raise
+    finally:
+        observe("pipeline_stage_seconds", time.perf_counter() - started, stage=name)
+
+
+def get_histogram(name: str, **labels) -> Optional[Histogram]:
+    return _histograms.get(_key(name, labels))
+
+
+def get_counter(name: str, **labels) -> float:
+    return _counters.get(_key(name, labels), 0)
+
+
+def total_counter(name: str) -> float:
+    """Сумма счетчика по всем значениям меток"""
+    return sum(value for (key_name, _), value in _counters.items() if key_name == name)
+
+
+def get_gauge(name: str, **labels) -> float:
+    key = _key(name, labels)
+    if key in _gauge_callbacks:
+        return _gauge_callbacks[key]()
+    return _gauges.get(key, 0)
+
+
+def snapshot() -> dict:
+    """Возвращает все метрики: {'counters': {...}, 'gauges': {...}, 'histograms': {...}}"""
+    gauges = {format_key(k): v for k, v in _gauges.items()}
+    for key, callback in _gauge_callbacks.items():
+        try:
+            gauges[format_key(key)] = callback()
+        except Exception:
+            continue
+    return {
+        "counters": {format_key(k): v for k, v in _counters.items()},
+        "gauges": gauges,
+        "histograms": {
+            format_key(k): {"count": h.count, "sum": h.sum, "buckets": dict(zip(h.buckets, h.counts))}
+            for k, h in _histograms.items()
+        },
+    }
+
+
+# Формат текстовой выдачи Prometheus
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = tuple(labels) + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def collect_families(labels: Optional[dict] = None) -> Dict[str, Tuple[str, list]]:
+    """
+    Строки метрик по семействам: {имя: (тип, строки)}.
+    labels добавляются к каждой строке (например, номер процесса-обработчика).
+    """
+    families: Dict[str, Tuple[str, list]] = {}
+    extra = tuple((k, str(v)) for k, v in (labels or {}).items())
+
+    def family(name: str, kind: str) -> list:
+        return families.setdefault(name, (kind, []))[1]
+
+    for (name, key_labels), value in list(_counters.items()):
+        family(name, "counter").append(f"{name}{_labels(key_labels, extra)} {_number(value)}")
+    gauges = dict(_gauges)
+    for key, callback in list(_gauge_callbacks.items()):
+        try:
+            gauges[key] = callback()
+        except Exception:
+            continue
+    for (name, key_labels), value in gauges.items():
+        family(name, "gauge").append(f"{name}{_labels(key_labels, extra)} {_number(value)}")
+    for (name, key_labels), histogram in list(_histograms.items()):
+        lines = family(name, "histogram")
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f"{name}_bucket{_labels(key_labels, extra + (('le', _number(bound)),))} {count}")
+        lines.append(f"{name}_bucket{_labels(key_labels, extra + (('le', '+Inf'),))} {histogram.count}")
+        lines.append(f"{name}_sum{_labels(key_labels, extra)} {_number(histogram.sum)}")
+        lines.append(f"{name}_count{_labels(key_labels, extra)} {histogram.count}")
+    return families
+
+
+def format_families(*sources: Dict[str, Tuple[str, list]]) -> str:
+    """Текстовый формат Prometheus; семейства из нескольких источников объединяются"""
+    merged: Dict[str, Tuple[str, list]] = {}
+    for families in sources:
+        for name, (kind, lines) in families.items():
+            merged.setdefault(name, (kind, []))[1].extend(lines)
+    output = []
+    for name in sorted(merged):
+        kind, lines = merged[name]
+        output.append(f"# TYPE {name} {kind}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus (для /metrics)"""
+    return format_families(collect_families())
@@ -0,0 +1,231 @@
+"""
+Планировщик исходящих запросов к Telegram: ограничение частоты и объединение сообщений
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+import tracing
+from config import (
+    SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST,
+    SEND_GROUP_CHAT_RATE, SEND_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину текста сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+# Сколько корзин чатов держать, прежде чем удалять простаивающие
+MAX_IDLE_CHAT_BUCKETS = 1000
+
+# rate_limit_args для информационных сообщений, которые можно объединять
+MERGEABLE = {"merge": True}
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+    reserve() сразу списывает токен (баланс может уйти в минус) и возвращает,
+    сколько нужно подождать, поэтому ожидающие обслуживаются по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (после RetryAfter)"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class _MergeBatch:
+    """
+    Информационные сообщения одного чата, ожидающие отправки одним сообщением.
+    Объединенный текст уходит с клавиатурой и ответом на сообщение первого из них,
+    поэтому присоединяются только сообщения с теми же reply_markup и reply_to_message_id.
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.texts = [data["text"]]
+        self.reply_markup = data.get("reply_markup")
+        self.reply_to_message_id = data.get("reply_to_message_id")
+        self.followers: List[asyncio.Future] = []
+        self.open = True
+
+    def accepts(self, data: dict) -> bool:
+        return (
+            self.open
+            and data.get("reply_markup") == self.reply_markup
+            and data.get("reply_to_message_id") == self.reply_to_message_id
+            and data.get("parse_mode") == self.data.get("parse_mode")
+            and sum(len(t) + 2 for t in self.texts) + len(data["text"]) <= MAX_MESSAGE_LENGTH
+        )
+
+
+class OutboundRateLimiter(BaseRateLimiter[dict]):
+    """
+    Ограничитель исходящих запросов бота (подключается через ApplicationBuilder.rate_limiter).
+
+    Запросы к чатам проходят через корзину токенов чата (около 1 сообщения в секунду,
+    для групп — 20 в минуту) и общую корзину (около 30 сообщений в секунду).
+    Информационные сообщения, отправленные с rate_limit_args=MERGEABLE, пока ждут
+    своей очереди, принимают в себя следующие такие же сообщения того же чата —
+    пользователь получает одно сообщение вместо нескольких.
+    При RetryAfter чат (или весь бот) приостанавливается и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, global_burst: float = SEND_GLOBAL_BURST,
+                 chat_rate: float = SEND_PER_CHAT_RATE, chat_burst: float = SEND_PER_CHAT_BURST,
+                 group_rate: float = SEND_GROUP_CHAT_RATE, max_retries: int = SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._batches: Dict[Any, _MergeBatch] = {}
+        self._waiting = 0
+        metrics.register_gauge("outbound_queue_depth", lambda: self._waiting)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for batch in self._batches.values():
+            batch.open = False
+        self._batches.clear()
+
+    @property
+    def queue_depth(self) -> int:
+        """Запросы, ожидающие отправки"""
+        return self._waiting
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_CHAT_BUCKETS:
+                # Полная корзина ничем не отличается от новой — простаивающие можно удалить
+                for key in [key for key, b in self._chats.items() if b.idle]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id) -> None:
+        await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        # Общий токен берем только когда подошла очередь чата, чтобы не занимать его зря
+        delay = self._global.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _call(self, callback, args, kwargs, endpoint: str, chat_id):
+        retries = 0
+        while True:
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retries += 1
+                metrics.inc("outbound_retry_after_total", endpoint=endpoint)
+                if retries > self.max_retries:
+                    raise
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after}с ({endpoint}, чат {chat_id})")
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after + 0.1)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[dict],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get("chat_id")
+        # Запросы не к чатам (getFile, setWebhook, answerCallbackQuery) не ограничиваем
+        if chat_id is None:
+            return await self._call(callback, args, kwargs, endpoint, None)
+
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            with tracing.span(f"telegram.{endpoint}"):
+                merge = bool(rate_limit_args and rate_limit_args.get("merge")) and endpoint == "sendMessage"
+                if merge:
+                    batch = self._batches.get(chat_id)
+                    if batch is not None and batch.accepts(data):
+                        return await self._join(batch, data)
+                    result = await self._send_batch(chat_id, callback, args, kwargs, endpoint, data)
+                else:
+                    await self._acquire(chat_id)
+                    result = await self._call(callback, args, kwargs, endpoint, chat_id)
+        finally:
+            self._waiting -= 1
+            metrics.observe("outbound_send_seconds", time.monotonic() - started, endpoint=endpoint)
+        metrics.inc("outbound_requests_total", endpoint=endpoint)
+        return result
+
+    async def _join(self, batch: _MergeBatch, data: dict):
+        batch.texts.append(data["text"])
+        future = asyncio.get_running_loop().create_future()
+        batch.followers.append(future)
+        metrics.inc("outbound_merged_total")
+        return await future
+
+    async def _send_batch(self, chat_id, callback, args, kwargs, endpoint: str, data: dict):
+        batch = _MergeBatch(data)
+        self._batches[chat_id] = batch
+        try:
+            try:
+                # Пока ждем токен, к сообщению могут присоединиться следующие
+                await self._acquire(chat_id)
+            finally:
+                batch.open = False
+                if self._batches.get(chat_id) is batch:
+                    del self._batches[chat_id]
+
+            if len(batch.texts) > 1:
+                data["text"] = "\n\n".join(batch.texts)
+            result = await self._call(callback, args, kwargs, endpoint, chat_id)
+        except asyncio.CancelledError:
+            for future in batch.followers:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.followers:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        for future in batch.followers:
+            if not future.done():
+                future.set_result(result)
+        return result
@@ -0,0 +1,666 @@
+"""
+Общий конвейер приема медиафайлов: политики по типам файлов, сбор альбомов и пул воркеров загрузки
+"""
+
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+import metrics
+import tracing
+from config import (
+    MAX_FILE_SIZE, MAX_VIDEO_SIZE, MAX_DOCUMENT_SIZE,
+    MAX_PHOTOS_PER_INVOICE, MAX_VIDEOS_PER_INVOICE, MAX_DOCUMENTS_PER_INVOICE,
+    SUPPORTED_PHOTO_FORMATS, SUPPORTED_VIDEO_FORMATS, SUPPORTED_DOCUMENT_FORMATS,
+    UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE, ALBUM_WINDOW, ALBUM_MAX_FILES, JOB_MAX_ATTEMPTS, JOB_RETRY_BASE_DELAY, JOB_RETRY_MAX_DELAY,
+    PROGRESS_UPDATE_INTERVAL,
+    ERROR_MESSAGES, SUCCESS_MESSAGES, INFO_MESSAGES
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MediaPolicy:
+    """Правила приема одного типа файлов"""
+    kind: str  # photo / video / document
+    icon: str
+    label: str  # подпись в сводке альбома
+    max_size: int
+    formats: tuple
+    default_extension: str
+    max_per_invoice: int
+    stats_key: str  # ключ счетчика в bot_stats
+    # Тексты сообщений (шаблоны из config)
+    too_large_message: str
+    unsupported_format_message: str
+    limit_reached_message: str
+    accepted_message: str
+    saved_message: str
+    approaching_limit_message: str
+    uploaded_message: str
+    download_error: str
+    upload_error: str
+
+    def get_media(self, message) -> Any:
+        """Объект файла нужного типа из сообщения"""
+        if self.kind == "photo":
+            return message.photo[-1] if message.photo else None
+        return getattr(message, self.kind, None)
+
+    def match_extension(self, file_path: Optional[str]) -> Optional[str]:
+        """Расширение файла, если формат поддерживается, иначе None"""
+        if not file_path:
+            return None
+        lowered = file_path.lower()
+        for fmt in self.formats:
+            if lowered.endswith(fmt):
+                return fmt
+        return None
+
+
+MEDIA_POLICIES = {
+    "photo": MediaPolicy(
+        kind="photo",
+        icon="📸",
+        label="Фото",
+        max_size=MAX_FILE_SIZE,
+        formats=tuple(SUPPORTED_PHOTO_FORMATS),
+        default_extension=".jpg",
+        max_per_invoice=MAX_PHOTOS_PER_INVOICE,
+        stats_key="total_photos",
+        too_large_message=ERROR_MESSAGES["file_too_large"],
+        unsupported_format_message=ERROR_MESSAGES["unsupported_photo_format"],
+        limit_reached_message=ERROR_MESSAGES["photo_limit_reached"],
+        accepted_message=INFO_MESSAGES["photo_accepted"],
+        saved_message=SUCCESS_MESSAGES["photo_saved"],
+        approaching_limit_message=INFO_MESSAGES["approaching_photo_limit"],
+        uploaded_message=SUCCESS_MESSAGES["photo_uploaded"],
+        download_error="Ошибка при загрузке файла",
+        upload_error="Ошибка Яндекс.Диска при загрузке файла",
+    ),
+    "video": MediaPolicy(
+        kind="video",
+        icon="🎥",
+        label="Видео",
+        max_size=MAX_VIDEO_SIZE,
+        formats=tuple(SUPPORTED_VIDEO_FORMATS),
+        default_extension=".mp4",
+        max_per_invoice=MAX_VIDEOS_PER_INVOICE,
+        stats_key="total_videos",
+        too_large_message=ERROR_MESSAGES["video_too_large"],
+        unsupported_format_message=ERROR_MESSAGES["unsupported_video_format"],
+        limit_reached_message=ERROR_MESSAGES["video_limit_reached"],
+        accepted_message=INFO_MESSAGES["video_accepted"],
+        saved_message=SUCCESS_MESSAGES["video_saved"],
+        approaching_limit_message=INFO_MESSAGES["approaching_video_limit"],
+        uploaded_message=SUCCESS_MESSAGES["video_uploaded"],
+        download_error="Ошибка при загрузке видео",
+        upload_error="Ошибка Яндекс.Диска при загрузке видео",
+    ),
+    "document": MediaPolicy(
+        kind="document",
+        icon="📄",
+        label="Документы",
+        max_size=MAX_DOCUMENT_SIZE,
+        formats=tuple(SUPPORTED_DOCUMENT_FORMATS),
+        default_extension=".pdf",
+        max_per_invoice=MAX_DOCUMENTS_PER_INVOICE,
+        stats_key="total_documents",
+        too_large_message=ERROR_MESSAGES["document_too_large"],
+        unsupported_format_message=ERROR_MESSAGES["unsupported_document_format"],
+        limit_reached_message=ERROR_MESSAGES["document_limit_reached"],
+        accepted_message=INFO_MESSAGES["document_accepted"],
+        saved_message=SUCCESS_MESSAGES["document_saved"],
+        approaching_limit_message=INFO_MESSAGES["approaching_document_limit"],
+        uploaded_message=SUCCESS_MESSAGES["document_uploaded"],
+        download_error="Ошибка при загрузке документа",
+        upload_error="Ошибка Яндекс.Диска при загрузке документа",
+    ),
+}
+
+
+@dataclass
+class UploadJob:
+    """Принятый файл, ожидающий загрузки на Яндекс.Диск"""
+    kind: str
+    user_id: int
+    chat_id: int
+    message_id: int
+    invoice: str
+    folder_path: str
+    file_name: str
+    file_size: int
+    file_id: str
+    file_unique_id: str = ""  # Для индекса дубликатов (не сохраняется в JobStore)
+    tg_file: Any = field(default=None, repr=False)  # None — получить заново по file_id
+    bot: Any = field(default=None, repr=False)
+    job_id: Optional[int] = None
+    attempts: int = 0
+    # Альбом, в сводку которого попадет результат (не сохраняется в JobStore)
+    group: Any = field(default=None, repr=False, compare=False)
+    group_index: int = 0
+    # Сообщение о ходе передачи, общее для всех попыток (не сохраняется в JobStore)
+    progress: Any = field(default=None, repr=False, compare=False)
+    # Трасса обновления, из которого пришел файл ('' — вне выборки; не сохраняется в JobStore)
+    trace_id: str = ""
+    # Резерв места в накладной уже переведен в счетчик или освобожден
+    settled: bool = field(default=False, repr=False, compare=False)
+    # Файл загружен и учтен, задача удалена из JobStore: ошибки после этого не повторяют загрузку
+    completed: bool = field(default=False, repr=False, compare=False)
+
+    @property
+    def file_path(self) -> str:
+        return f"{self.folder_path}/{self.file_name}"
+
+    @classmethod
+    def from_row(cls, row, bot=None) -> "UploadJob":
+        """Задача из строки JobStore"""
+        return cls(
+            kind=row["kind"],
+            user_id=row["user_id"],
+            chat_id=row["chat_id"],
+            message_id=row["message_id"],
+            invoice=row["invoice"],
+            folder_path=row["folder_path"],
+            file_name=row["file_name"],
+            file_size=row["file_size"],
+            file_id=row["file_id"],
+            bot=bot,
+            job_id=row["id"],
+            attempts=row["attempts"],
+        )
+
+
+class UploadWorkerPool:
+    """
+    Очередь загрузок и пул асинхронных воркеров.
+
+    Обработчики только ставят задачу в очередь; воркеры выполняют перенос
+    и сообщают о результате. Пропускная способность задается числом воркеров.
+    Если передан store (JobStore), задачи сохраняются на диск, незавершенные
+    продолжаются после перезапуска, неудачные повторяются с экспоненциальной
+    задержкой и после max_attempts попадают в таблицу неудачных.
+    Ошибка, для которой defer возвращает задержку (сервис временно недоступен
+    и запрос не отправлялся), откладывает задачу, не расходуя попытку.
+    Место в накладной под задачу резервирует в ledger (InvoiceLedger) тот, кто
+    ее ставит в очередь; пул переводит резерв в счетчик (settle) или освобождает,
+    когда задача завершилась без загрузки.
+    """
+
+    def __init__(self, process: Callable[[UploadJob], Awaitable[None]],
+                 ledger,
+                 on_failure: Optional[Callable[[UploadJob, Exception], Awaitable[None]]] = None,
+                 store=None,
+                 is_permanent: Callable[[Exception], bool] = lambda e: False,
+                 defer: Callable[[Exception], Optional[float]] = lambda e: None,
+                 workers: int = UPLOAD_WORKERS, max_queue: int = UPLOAD_QUEUE_SIZE,
+                 max_attempts: int = JOB_MAX_ATTEMPTS,
+                 retry_base_delay: float = JOB_RETRY_BASE_DELAY,
+                 retry_max_delay: float = JOB_RETRY_MAX_DELAY):
+        self._process = process
+        self.ledger = ledger
+        self._on_failure = on_failure
+        self.store = store
+        self._is_permanent = is_permanent
+        self._defer = defer
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+        self._timers: dict = {}
+        self._poller: Optional[asyncio.Task] = None
+        self._known: set = set()  # id задач JobStore, которые выполняет этот процесс
+        self._pending_bytes = 0
+        self._in_flight = 0
+        metrics.register_gauge("upload_queue_depth", lambda: self.queue_depth)
+        metrics.register_gauge("uploads_in_flight", lambda: self._in_flight)
+        metrics.register_gauge("upload_retries_scheduled", lambda: len(self._timers))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def pending_bytes(self) -> int:
+        """Суммарный размер файлов, которые еще не загружены"""
+        return self._pending_bytes
+
+    def _track(self, job: UploadJob) -> None:
+        self._pending_bytes += job.file_size
+        if job.job_id is not None:
+            self._known.add(job.job_id)
+
+    def start(self) -> None:
+        """Запускает воркеры в текущем цикле событий"""
+        self._queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._worker(n), name=f"upload-worker-{n}")
+            for n in range(self.workers)
+        ]
+        logger.info(f"⚙️ Запущено воркеров загрузки: {self.workers}")
+
+    def resume(self, bot) -> int:
+        """
+        Ставит в очередь незавершенные задачи из хранилища, которые этот процесс еще не выполняет.
+        Возвращает их количество.
+        """
+        if self.store is None:
+            return 0
+        rows = [row for row in self.store.pending() if row["id"] not in self._known]
+        now = time.time()
+        for row in rows:
+            job = UploadJob.from_row(row, bot)
+            self.ledger.hold(job.user_id, job.invoice, job.kind)
+            self._track(job)
+            self._schedule(job, max(0.0, row["next_attempt_at"] - now))
+        if rows:
+            logger.info(f"🔁 Возобновлено незавершенных загрузок: {len(rows)}")
+        return len(rows)
+
+    def watch(self, bot, interval: float) -> None:
+        """
+        Периодически забирает задачи своих пользователей, появившиеся в хранилище без
+        участия этого процесса (/requeue в другом процессе-обработчике).
+        """
+        async def poll() -> None:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    self.resume(bot)
+                except Exception as e:
+                    logger.error(f"❌ Не удалось проверить очередь задач: {e}")
+
+        self._poller = asyncio.create_task(poll(), name="upload-poller")
+
+    def submit(self, job: UploadJob) -> bool:
+        """
+        Ставит задачу с зарезервированным местом в очередь.
+        Возвращает False, если очередь переполнена (резерв остается за вызывающим).
+        """
+        if self._queue is None or self.queue_depth >= self.max_queue:
+            return False
+        if self.store is not None:
+            job.job_id = self.store.add(job)
+        self._track(job)
+        self._queue.put_nowait(job)
+        metrics.inc("upload_jobs_submitted_total", kind=job.kind)
+        return True
+
+    def requeue_dead(self, job_id: int, bot) -> Optional[UploadJob]:
+        """
+        Возвращает неудачную задачу в очередь. Задачу чужого пользователя только
+        возвращает в хранилище: ее заберет процесс, который обслуживает пользователя (watch).
+        """
+        if self.store is None or self._queue is None:
+            return None
+        row = self.store.requeue(job_id)
+        if row is None:
+            return None
+        job = UploadJob.from_row(row, bot)
+        metrics.inc("upload_jobs_requeued_total", kind=job.kind)
+        if not self.store.owns(job.user_id):
+            return job
+        self.ledger.hold(job.user_id, job.invoice, job.kind)
+        self._track(job)
+        self._queue.put_nowait(job)
+        return job
+
+    def backoff(self, attempts: int) -> float:
+        """Задержка перед повтором: экспонента с джиттером"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _schedule(self, job: UploadJob, delay: float) -> None:
+        if delay <= 0:
+            self._queue.put_nowait(job)
+            return
+        key = id(job)
+        loop = asyncio.get_running_loop()
+
+        def enqueue():
+            self._timers.pop(key, None)
+            self._queue.put_nowait(job)
+
+        self._timers[key] = loop.call_later(delay, enqueue)
+
+    def settle(self, job: UploadJob) -> int:
+        """
+        Файл загружен: резерв переходит в счетчик накладной сразу, не дожидаясь
+        ответов пользователю. Возвращает значение счетчика (0, если накладную сбросили).
+        Повторный вызов для той же задачи счетчик не меняет.
+        """
+        if job.settled:
+            return self.ledger.state.get_count(job.user_id, job.invoice, job.kind)
+        job.settled = True
+        return self.ledger.commit(job.user_id, job.invoice, job.kind)
+
+    def complete(self, job: UploadJob) -> None:
+        """
+        Файл загружен и учтен: задача удаляется из хранилища до ответов пользователю,
+        поэтому ошибка отправки ответа не приводит к повторной загрузке.
+        """
+        job.completed = True
+        if self.store is not None and job.job_id is not None:
+            self.store.complete(job.job_id)
+
+    def _finish(self, job: UploadJob) -> None:
+        self._pending_bytes -= job.file_size
+        self._known.discard(job.job_id)
+        # Задача завершилась без загрузки (дубликат или окончательная ошибка) — место свободно
+        if not job.settled:
+            job.settled = True
+            self.ledger.release(job.user_id, job.invoice, job.kind)
+
+    async def _handle_failure(self, job: UploadJob, error: Exception) -> None:
+        if job.completed:
+            # Файл уже на Яндекс.Диске и учтен — повтор загрузил бы его еще раз
+            logger.error(f"❌ Ошибка после загрузки {job.file_path}, повтора не будет: {error}")
+            self._finish(job)
+            metrics.inc("upload_jobs_completed_total", kind=job.kind)
+            return
+
+        deferred = self._defer(error)
+        if deferred is not None:
+            job.tg_file = None
+            logger.info(f"⏸ Загрузка {job.file_path} отложена на {deferred:.0f}с: {error}")
+            if self.store is not None and job.job_id is not None:
+                self.store.reschedule(job.job_id, job.attempts, time.time() + deferred, str(error))
+            metrics.inc("upload_jobs_deferred_total", kind=job.kind)
+            self._schedule(job, deferred)
+            return
+
+        job.attempts += 1
+        # Ссылка на файл Telegram могла устареть — при повторе получим новую
+        job.tg_file = None
+        if self._is_permanent(error) or job.attempts >= self.max_attempts:
+            logger.error(f"❌ Загрузка {job.file_path} не удалась (попыток: {job.attempts}): {error}")
+            if self.store is not None and job.job_id is not None:
+                self.store.bury(job.job_id, job.attempts, str(error))
+            self._finish(job)
+            metrics.inc("upload_jobs_failed_total", kind=job.kind)
+            if self._on_failure is not None:
+                try:
+                    await self._on_failure(job, error)
+                except Exception as e:
+                    logger.error(f"❌ Не удалось сообщить об ошибке загрузки {job.file_path}: {e}")
+            return
+
+        delay = self.backoff(job.attempts)
+        logger.warning(
+            f"⚠️ Загрузка {job.file_path} не удалась (попытка {job.attempts}), повтор через {delay:.0f}с: {error}"
+        )
+        if self.store is not None and job.job_id is not None:
+            self.store.reschedule(job.job_id, job.attempts, time.time() + delay, str(error))
+        metrics.inc("upload_job_retries_total", kind=job.kind)
+        self._schedule(job, delay)
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            job = await self._queue.get()
+            self._in_flight += 1
+            try:
+                with tracing.trace("upload", trace_id=job.trace_id or None, media=job.kind,
+                                   invoice=job.invoice, attempt=job.attempts + 1, size=job.file_size):
+                    await self._process(job)
+            except asyncio.CancelledError:
+                # Задача остается в хранилище и будет продолжена после перезапуска
+                raise
+            except Exception as e:
+                await self._handle_failure(job, e)
+            else:
+                if self.store is not None and job.job_id is not None:
+                    self.store.complete(job.job_id)
+                self._finish(job)
+                metrics.inc("upload_jobs_completed_total", kind=job.kind)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def join(self) -> None:
+        """Ждет, пока очередь опустеет (отложенные повторы не учитываются)"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Дожидается текущих загрузок (не дольше timeout) и останавливает воркеры"""
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ Не дождались завершения загрузок: в очереди {self.queue_depth}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class UploadGroup:
+    """
+    Результаты загрузки файлов одного альбома.
+
+    Каждый файл отчитывается один раз (загружен, окончательно не загружен
+    или отклонен при приеме); когда отчитались все, вызывается on_complete.
+    После перезапуска бота группа не восстанавливается: продолженные задачи
+    отвечают пользователю по отдельности.
+    """
+
+    def __init__(self, bot, chat_id: int, message_id: int, user_id: int, invoice: str,
+                 on_complete: Callable[["UploadGroup"], Awaitable[None]]):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.invoice = invoice
+        self.results: list = []  # [политика, имя файла, ok, подробности, дубликат] в порядке альбома
+        self._on_complete = on_complete
+        self._waiting = 0
+        self._sealed = False
+        self._done = False
+
+    @property
+    def uploaded(self) -> int:
+        return sum(1 for result in self.results if result[2] and not result[4])
+
+    @property
+    def duplicates(self) -> int:
+        return sum(1 for result in self.results if result[4])
+
+    def reject(self, policy: MediaPolicy, name: str, reason: str) -> None:
+        """Файл не принят к загрузке"""
+        self.results.append([policy, name, False, reason, False])
+
+    def skip(self, policy: MediaPolicy, name: str, reason: str) -> None:
+        """Файл не загружается: такой уже есть в накладной"""
+        self.results.append([policy, name, True, reason, True])
+
+    def attach(self, job: UploadJob, policy: MediaPolicy) -> None:
+        """Файл поставлен в очередь, результат придет через record()"""
+        job.group = self
+        job.group_index = len(self.results)
+        self.results.append([policy, job.file_name, None, "", False])
+        self._waiting += 1
+
+    def detach(self, job: UploadJob, reason: str) -> None:
+        """Файл все-таки не попал в очередь"""
+        job.group = None
+        self.results[job.group_index][2:] = [False, reason, False]
+        self._waiting -= 1
+
+    async def record(self, job: UploadJob, ok: bool, detail: str = "", duplicate: bool = False) -> None:
+        self.results[job.group_index][2:] = [ok, detail, duplicate]
+        self._waiting -= 1
+        await self._maybe_complete()
+
+    async def seal(self) -> None:
+        """Все файлы альбома учтены; если ждать нечего, сводка отправляется сразу"""
+        self._sealed = True
+        await self._maybe_complete()
+
+    async def _maybe_complete(self) -> None:
+        if not self._sealed or self._waiting > 0 or self._done:
+            return
+        self._done = True
+        try:
+            await self._on_complete(self)
+        except Exception as e:
+            # Ошибка отправки сводки не должна считаться ошибкой загрузки файла
+            logger.error(f"❌ Не удалось отправить сводку альбома {self.invoice}: {e}")
+
+
+class ProgressMessage:
+    """
+    Одно сообщение о ходе передачи файла, которое редактируется не чаще раза в interval секунд.
+
+    update() только запоминает последнее значение (его можно вызывать из потока
+    синхронного клиента на каждый чанк); отправкой и правкой сообщения занимается
+    задача в цикле событий. Сообщение правится, только если изменился его текст,
+    поэтому render стоит округлять, например, до 5%.
+    """
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: int,
+                 render: Callable[[str, int, int], str], interval: float = PROGRESS_UPDATE_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.render = render
+        self.interval = interval
+        self.message_id: Optional[int] = None
+        self._latest: Optional[tuple] = None
+        self._text: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, phase: str, done: int, total: int) -> None:
+        self._latest = (phase, done, total)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"progress-{self.chat_id}")
+
+    async def _run(self) -> None:
+        while True:
+            await self._show()
+            await asyncio.sleep(self.interval)
+
+    async def _show(self, text: Optional[str] = None) -> None:
+        if text is None:
+            if self._latest is None:
+                return
+            text = self.render(*self._latest)
+        if text == self._text:
+            return
+        try:
+            if self.message_id is None:
+                message = await self.bot.send_message(
+                    self.chat_id, text,
+                    reply_to_message_id=self.reply_to_message_id,
+                    allow_sending_without_reply=True
+                )
+                self.message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self._text = text
+            metrics.inc("progress_updates_total")
+        except Exception as e:
+            # Прогресс — только информация, ошибки его отправки не влияют на загрузку
+            logger.warning(f"⚠️ Не удалось обновить сообщение о ходе передачи: {e}")
+
+    async def stop(self, text: Optional[str] = None) -> None:
+        """Останавливает обновления; text — итоговый текст сообщения (если оно уже отправлено)"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if text is not None and self.message_id is not None:
+            await self._show(text)
+
+
+class MediaGroupCollector:
+    """
+    Собирает сообщения одного альбома (общий media_group_id).
+
+    Telegram присылает каждый файл альбома отдельным обновлением. Сообщения
+    копятся, пока новые приходят чаще, чем раз в window секунд (или пока их
+    не наберется max_items), затем вся группа передается в flush одним вызовом.
+    take() отдает накопленные группы раньше окна — тому, кто должен обработать их
+    до следующего обновления того же пользователя.
+    """
+
+    def __init__(self, flush: Callable[[Any, list], Awaitable[None]],
+                 window: float = ALBUM_WINDOW, max_items: int = ALBUM_MAX_FILES):
+        self._flush = flush
+        self.window = window
+        self.max_items = max_items
+        self._groups: dict = {}
+        self._timers: dict = {}
+        self._tasks: set = set()
+        metrics.register_gauge("album_groups_buffered", lambda: len(self._groups))
+
+    def __len__(self) -> int:
+        """Сколько групп ждут окна"""
+        return len(self._groups)
+
+    def add(self, key, item) -> None:
+        items = self._groups.setdefault(key, [])
+        items.append(item)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if len(items) >= self.max_items:
+            self._dispatch(key)
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._dispatch, key)
+
+    def _pop(self, key) -> Optional[list]:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._groups.pop(key, None)
+        if items:
+            metrics.inc("album_groups_total")
+            metrics.inc("album_files_total", len(items))
+        return items
+
+    def take(self, match: Callable[[Any, list], bool]) -> list:
+        """Забирает накопленные группы, для которых match(key, items) истинно: [(key, items)]"""
+        keys = [key for key, items in self._groups.items() if match(key, items)]
+        return [(key, self._pop(key)) for key in keys]
+
+    def _dispatch(self, key) -> None:
+        items = self._pop(key)
+        if not items:
+            return
+        task = asyncio.create_task(self._run(key, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, items: list) -> None:
+        try:
+            # Альбом обрабатывается вне обновлений, из которых он собран, — своя трасса
+            with tracing.trace("album", files=len(items)):
+                await self._flush(key, items)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки альбома {key}: {e}", exc_info=True)
+
+    async def stop(self) -> None:
+        """Обрабатывает накопленные альбомы, не дожидаясь окна"""
+        for key in list(self._groups):
+            self._dispatch(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,138 @@
+"""
+Учет свободного места на Яндекс.Диске без запроса к API на каждое сообщение
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+import metrics
+from config import QUOTA_REFRESH_INTERVAL, QUOTA_SAFETY_MARGIN
+
+logger = logging.getLogger(__name__)
+
+
+def parse_disk_info(disk_info) -> Optional[tuple]:
+    """
+    (всего, занято) в байтах из ответа get_disk_info или None, если структура незнакома.
+    yadisk возвращает DiskInfoObject с полями total_space и used_space.
+    """
+    total = getattr(disk_info, "total_space", None)
+    used = getattr(disk_info, "used_space", None)
+    if total is not None and used is not None:
+        return total, used
+    free = getattr(disk_info, "free", None)
+    total = getattr(disk_info, "total", None)
+    if free is not None and total is not None:
+        return total, total - free
+    return None
+
+
+class QuotaTracker:
+    """
+    Снимок места на диске, который обновляется не чаще раза в ttl секунд.
+
+    Между обновлениями свободное место уменьшается на размер загруженных ботом
+    файлов (record_upload), поэтому проверка перед скачиванием файла не ходит в API.
+    Устаревший снимок обновляется в фоне, пока обработчики пользуются прежним;
+    запрос к API выполняется один на всех одновременно ожидающих.
+    Пока место неизвестно (API не ответил), файлы не отклоняются.
+    """
+
+    def __init__(self, storage, base_path: str, ttl: float = QUOTA_REFRESH_INTERVAL,
+                 margin: int = QUOTA_SAFETY_MARGIN):
+        self.storage = storage
+        self.base_path = base_path
+        self.ttl = ttl
+        self.margin = margin
+        self.total: Optional[int] = None
+        self.used: Optional[int] = None
+        self.uploaded = 0  # Загружено ботом после последнего обновления, байты
+        self.base_folder_exists: Optional[bool] = None
+        self.refreshed_at: Optional[datetime] = None
+        self._checked_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        metrics.register_gauge("disk_free_bytes", lambda: self.free if self.free is not None else 0)
+
+    @property
+    def available(self) -> bool:
+        return self.total is not None
+
+    @property
+    def free(self) -> Optional[int]:
+        """Свободное место с учетом загрузок после обновления"""
+        if self.total is None:
+            return None
+        return max(0, self.total - self.used - self.uploaded)
+
+    @property
+    def stale(self) -> bool:
+        """Пора обновить снимок (после неудачного запроса следующий — тоже через ttl)"""
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.ttl
+
+    async def _fetch(self) -> None:
+        self._checked_at = time.monotonic()
+        # Загрузки, учтенные во время запроса, могут не попасть в ответ — их оставляем в uploaded
+        uploaded_before = self.uploaded
+        disk_info, exists = await asyncio.gather(
+            self.storage.get_disk_info(), self.storage.exists(self.base_path),
+            return_exceptions=True
+        )
+        if isinstance(disk_info, Exception):
+            metrics.inc("disk_info_refresh_total", result="error")
+            logger.error(f"❌ Ошибка при получении информации о диске: {disk_info}")
+            return
+        space = parse_disk_info(disk_info)
+        if space is None:
+            metrics.inc("disk_info_refresh_total", result="unknown")
+            logger.warning(f"⚠️ Неизвестная структура ответа API: {type(disk_info)}")
+            return
+        self.total, self.used = space
+        self.uploaded -= uploaded_before
+        if not isinstance(exists, Exception):
+            self.base_folder_exists = exists
+        self.refreshed_at = datetime.now()
+        metrics.inc("disk_info_refresh_total", result="ok")
+
+    def refresh_in_background(self) -> asyncio.Task:
+        """Запускает обновление, если оно еще не идет"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch(), name="disk-info-refresh")
+        return self._refresh_task
+
+    async def refresh(self) -> None:
+        """Обновляет снимок; параллельные вызовы ждут один запрос"""
+        await asyncio.shield(self.refresh_in_background())
+
+    async def fits(self, size: int, queued: int = 0) -> bool:
+        """
+        Поместится ли файл size байт вместе с queued байтами, ожидающими загрузки.
+        Первый раз ждет обновления снимка, дальше устаревший снимок обновляется в фоне.
+        """
+        if self._checked_at is None:
+            await self.refresh()
+        elif self.stale:
+            self.refresh_in_background()
+        free = self.free
+        if free is None:
+            return True
+        if size + queued + self.margin > free:
+            metrics.inc("quota_rejections_total")
+            return False
+        return True
+
+    def record_upload(self, size: int) -> None:
+        """Учитывает загруженный файл до следующего обновления"""
+        self.uploaded += size
+
+    def invalidate(self) -> None:
+        """Диск ответил, что место закончилось: следующая проверка обновит снимок"""
+        self._checked_at = None
+
+    async def close(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+        self._refresh_task = None
@@ -0,0 +1,199 @@
+"""
+Устойчивость вызовов Яндекс.Диска: категории ошибок, повторы с задержкой и автоматический выключатель
+"""
+
+import asyncio
+import enum
+import logging
+import random
+import time
+from typing import Callable
+
+import httpx
+import yadisk
+
+import metrics
+from config import (
+    YANDEX_RETRY_ATTEMPTS, YANDEX_RETRY_BASE_DELAY, YANDEX_RETRY_MAX_DELAY,
+    YANDEX_BREAKER_THRESHOLD, YANDEX_BREAKER_RESET_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorCategory(enum.Enum):
+    QUOTA = "quota"  # Закончилось место на диске
+    AUTH = "auth"  # Неверный токен или нет прав
+    NOT_FOUND = "not_found"
+    CONFLICT = "conflict"  # Ресурс уже существует, md5 не совпал
+    INVALID = "invalid"  # Запрос, который не выполнится и при повторе
+    RATE_LIMITED = "rate_limited"  # Слишком много запросов, исчерпан лимит трафика
+    TRANSIENT = "transient"  # Сеть, таймауты, 5xx
+    UNAVAILABLE = "unavailable"  # Выключатель разомкнут, запрос не отправлялся
+    UNKNOWN = "unknown"
+
+    @property
+    def permanent(self) -> bool:
+        """Повтор той же операции не поможет"""
+        return self in PERMANENT_CATEGORIES
+
+    @property
+    def degraded(self) -> bool:
+        """Ошибка говорит о проблемах на стороне Яндекс.Диска (учитывается выключателем)"""
+        return self in (ErrorCategory.TRANSIENT, ErrorCategory.RATE_LIMITED)
+
+
+PERMANENT_CATEGORIES = frozenset({
+    ErrorCategory.QUOTA, ErrorCategory.AUTH, ErrorCategory.CONFLICT, ErrorCategory.INVALID,
+})
+
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут: Яндекс.Диск недавно не отвечал, запрос не отправлен"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name}: сервис временно недоступен, повтор через {retry_in:.0f}с")
+        self.retry_in = retry_in
+
+
+# Порядок важен: подклассы раньше базовых классов
+_CATEGORIES = (
+    (CircuitOpenError, ErrorCategory.UNAVAILABLE),
+    (yadisk.exceptions.InsufficientStorageError, ErrorCategory.QUOTA),
+    (yadisk.exceptions.UploadTrafficLimitExceededError, ErrorCategory.RATE_LIMITED),
+    (yadisk.exceptions.TooManyRequestsError, ErrorCategory.RATE_LIMITED),
+    (yadisk.exceptions.UnauthorizedError, ErrorCategory.AUTH),
+    (yadisk.exceptions.ForbiddenError, ErrorCategory.AUTH),
+    (yadisk.exceptions.ParentNotFoundError, ErrorCategory.NOT_FOUND),
+    (yadisk.exceptions.NotFoundError, ErrorCategory.NOT_FOUND),
+    (yadisk.exceptions.ConflictError, ErrorCategory.CONFLICT),
+    (yadisk.exceptions.RetriableYaDiskError, ErrorCategory.TRANSIENT),
+    (yadisk.exceptions.RequestError, ErrorCategory.TRANSIENT),
+    (yadisk.exceptions.LockedError, ErrorCategory.TRANSIENT),
+    (yadisk.exceptions.BadRequestError, ErrorCategory.INVALID),
+    (yadisk.exceptions.PayloadTooLargeError, ErrorCategory.INVALID),
+    (yadisk.exceptions.UnsupportedMediaError, ErrorCategory.INVALID),
+    (yadisk.exceptions.WrongResourceTypeError, ErrorCategory.INVALID),
+    (httpx.TransportError, ErrorCategory.TRANSIENT),
+    (asyncio.TimeoutError, ErrorCategory.TRANSIENT),
+    (ConnectionError, ErrorCategory.TRANSIENT),
+)
+
+
+def classify(error: BaseException) -> ErrorCategory:
+    """Категория ошибки вызова Яндекс.Диска"""
+    for error_type, category in _CATEGORIES:
+        if isinstance(error, error_type):
+            return category
+    return ErrorCategory.UNKNOWN
+
+
+def backoff_delay(attempt: int, base: float = YANDEX_RETRY_BASE_DELAY,
+                  maximum: float = YANDEX_RETRY_MAX_DELAY) -> float:
+    """Задержка перед повтором номер attempt (с 1): экспонента с полным джиттером"""
+    return random.uniform(0, min(maximum, base * (2 ** (attempt - 1))))
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель вокруг внешнего сервиса.
+
+    closed — запросы идут как обычно; после threshold ошибок подряд, говорящих
+    о деградации сервиса, выключатель размыкается (open) и запросы сразу получают
+    CircuitOpenError, не дожидаясь таймаутов. Через reset_timeout один пробный запрос
+    пропускается (half_open): успех замыкает выключатель, ошибка снова размыкает.
+    Осмысленный ответ сервиса (нет ресурса, конфликт, квота) — это тоже ответ: он считается
+    успехом и прерывает серию ошибок. Неизвестная ошибка считается как деградация.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, threshold: int = YANDEX_BREAKER_THRESHOLD,
+                 reset_timeout: float = YANDEX_BREAKER_RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        metrics.register_gauge("circuit_breaker_state", lambda: self._STATE_VALUES[self.state], breaker=name)
+        metrics.register_gauge("circuit_breaker_failures", lambda: self.failures, breaker=name)
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and self._clock() - self.opened_at < self.reset_timeout
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        previous, self.state = self.state, state
+        metrics.inc("circuit_breaker_transitions_total", breaker=self.name, to=state)
+        if state == self.OPEN:
+            logger.warning(
+                f"🔌 Выключатель {self.name} разомкнут после {self.failures} ошибок подряд, "
+                f"пауза {self.reset_timeout:.0f}с"
+            )
+        elif state == self.CLOSED:
+            logger.info(f"🔌 Выключатель {self.name} замкнут, сервис снова отвечает")
+        else:
+            logger.info(f"🔌 Выключатель {self.name}: пробный запрос ({previous} → {state})")
+
+    def before_call(self) -> None:
+        """Пропускает запрос или выбрасывает CircuitOpenError"""
+        if self.state == self.CLOSED:
+            return
+        elapsed = self._clock() - self.opened_at
+        if self.state == self.OPEN and elapsed >= self.reset_timeout:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        metrics.inc("circuit_breaker_rejections_total", breaker=self.name)
+        raise CircuitOpenError(self.name, max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        self._transition(self.CLOSED)
+
+    def record_failure(self, category: ErrorCategory) -> None:
+        if not category.degraded and category is not ErrorCategory.UNKNOWN:
+            # Сервис ответил осмысленной ошибкой — он работает, серия ошибок прервана
+            self.record_success()
+            return
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self._probe_in_flight = False
+            self.opened_at = self._clock()
+            self._transition(self.OPEN)
+
+    def release(self) -> None:
+        """Пробный запрос завершился без результата (например, отменен)"""
+        self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejections": int(metrics.get_counter("circuit_breaker_rejections_total", breaker=self.name)),
+        }
+
+
+class RetryPolicy:
+    """Повторы идемпотентных операций с экспоненциальной задержкой и джиттером"""
+
+    def __init__(self, attempts: int = YANDEX_RETRY_ATTEMPTS, base_delay: float = YANDEX_RETRY_BASE_DELAY,
+                 max_delay: float = YANDEX_RETRY_MAX_DELAY):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt: int, category: ErrorCategory) -> bool:
+        return attempt < self.attempts and category.degraded
+
+    def delay(self, attempt: int) -> float:
+        return backoff_delay(attempt, self.base_delay, self.max_delay)
@@ -0,0 +1,358 @@
+"""
+Хранилище состояния бота: активные накладные, время активности, счетчики файлов и статистика
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from config import STATE_BACKEND, STATE_DB_PATH, STATE_FLUSH_INTERVAL, WEBHOOK_WORKERS, WEBHOOK_WORKER_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Типы файлов, для которых ведутся счетчики по накладным
+KINDS = ("photo", "video", "document")
+
+
+class MemoryStateStore:
+    """
+    Состояние в памяти процесса (теряется при перезапуске).
+
+    Все обработчики работают с состоянием только через методы этого класса;
+    постоянные хранилища наследуют его и сохраняют изменения через хуки _*_changed.
+    """
+
+    def __init__(self):
+        self._invoices: Dict[int, str] = {}
+        self._activity: Dict[int, datetime] = {}
+        # Счетчики загруженных файлов по (пользователь, накладная): у двух пользователей
+        # с одинаковым номером накладной счетчики свои
+        self._counts: Dict[Tuple[int, str], Dict[str, int]] = {}
+        self._stats: Counter = Counter()
+
+    # Сессии пользователей
+
+    def get_invoice(self, user_id: int) -> Optional[str]:
+        """Активная накладная пользователя"""
+        return self._invoices.get(user_id)
+
+    def start_invoice(self, user_id: int, invoice: str, counts: Optional[Dict[str, int]] = None) -> None:
+        """Открывает накладную пользователя: с нулевыми счетчиками или с уже загруженными файлами (counts)"""
+        self._invoices[user_id] = invoice
+        self._counts[(user_id, invoice)] = {kind: (counts or {}).get(kind, 0) for kind in KINDS}
+        self._user_changed(user_id)
+        self._counts_changed((user_id, invoice))
+
+    def end_session(self, user_id: int) -> Optional[Tuple[str, Dict[str, int]]]:
+        """
+        Закрывает накладную пользователя.
+        Возвращает (накладная, счетчики файлов) или None, если накладной не было.
+        """
+        invoice = self._invoices.pop(user_id, None)
+        if invoice is None:
+            return None
+        counts = self._counts.pop((user_id, invoice), None) or {kind: 0 for kind in KINDS}
+        self._user_changed(user_id)
+        self._counts_changed((user_id, invoice))
+        return invoice, counts
+
+    def sessions(self) -> Dict[int, str]:
+        """Активные накладные: {user_id: накладная}"""
+        return dict(self._invoices)
+
+    def get_activity(self, user_id: int) -> Optional[datetime]:
+        return self._activity.get(user_id)
+
+    def touch(self, user_id: int, when: Optional[datetime] = None) -> None:
+        """Отмечает активность пользователя"""
+        self._activity[user_id] = when or datetime.now()
+        self._user_changed(user_id)
+
+    def forget_user(self, user_id: int) -> None:
+        """Удаляет запись об активности пользователя без накладной"""
+        if user_id in self._invoices:
+            return
+        if self._activity.pop(user_id, None) is not None:
+            self._user_changed(user_id)
+
+    def activity_timestamps(self) -> Dict[int, float]:
+        """Время последней активности всех пользователей: {user_id: unix time}"""
+        return {user_id: when.timestamp() for user_id, when in self._activity.items()}
+
+    # Счетчики файлов по накладным пользователей
+
+    def get_count(self, user_id: int, invoice: str, kind: str) -> int:
+        return self._counts.get((user_id, invoice), {}).get(kind, 0)
+
+    def get_counts(self, user_id: int, invoice: str) -> Dict[str, int]:
+        return dict(self._counts.get((user_id, invoice)) or {kind: 0 for kind in KINDS})
+
+    def add_file(self, user_id: int, invoice: str, kind: str) -> int:
+        """
+        Учитывает загруженный файл, если накладная пользователя еще открыта
+        (ее могли сбросить, пока файл загружался). Возвращает текущее значение счетчика.
+        """
+        counts = self._counts.get((user_id, invoice))
+        if counts is None:
+            return 0
+        counts[kind] = counts.get(kind, 0) + 1
+        self._counts_changed((user_id, invoice))
+        return counts[kind]
+
+    def count_totals(self) -> Dict[str, int]:
+        """Сумма счетчиков по всем открытым накладным"""
+        totals = {kind: 0 for kind in KINDS}
+        for counts in self._counts.values():
+            for kind, value in counts.items():
+                totals[kind] = totals.get(kind, 0) + value
+        return totals
+
+    # Статистика
+
+    def incr_stat(self, key: str, value: int = 1) -> None:
+        self._stats[key] += value
+        self._stat_changed(key, value)
+
+    def get_stat(self, key: str) -> int:
+        return self._stats.get(key, 0)
+
+    # Жизненный цикл
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def _user_changed(self, user_id: int) -> None:
+        pass
+
+    def _counts_changed(self, key: Tuple[int, str]) -> None:
+        pass
+
+    def _stat_changed(self, key: str, value: int) -> None:
+        pass
+
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    invoice TEXT,
+    last_activity REAL
+);
+CREATE TABLE IF NOT EXISTS session_counts (
+    user_id INTEGER NOT NULL,
+    invoice TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, invoice, kind)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """
+    Состояние в памяти с отложенной записью в SQLite (write-behind).
+
+    Чтение и изменение идут в памяти, как у MemoryStateStore; измененные ключи
+    запоминаются и раз в flush_interval записываются одной транзакцией в отдельном
+    потоке. Статистика сохраняется приращениями, поэтому несколько процессов
+    с общим файлом не затирают счетчики друг друга.
+    При запуске состояние загружается из файла.
+
+    Если процессов-обработчиков несколько (shard = (номер, всего)), каждый загружает
+    только сессии своих пользователей (user_id % всего == номер) и их накладные:
+    обновления пользователя всегда приходят в один и тот же процесс.
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH, flush_interval: float = STATE_FLUSH_INTERVAL,
+                 shard: Tuple[int, int] = (WEBHOOK_WORKER_INDEX, WEBHOOK_WORKERS)):
+        super().__init__()
+        self.path = path
+        self.flush_interval = flush_interval
+        self.shard = shard
+        self._conn: Optional[sqlite3.Connection] = None
+        self._dirty_users: set = set()
+        self._dirty_counts: set = set()
+        self._stat_deltas: Counter = Counter()
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(STATE_SCHEMA)
+            self._migrate(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection) -> None:
+        """Счетчики из прежней таблицы invoice_counts (по номеру накладной) — каждому пользователю с этой накладной"""
+        # IMMEDIATE: из нескольких одновременно запущенных процессов переносит один
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'invoice_counts'"
+            ).fetchone() is None:
+                return
+            conn.execute(
+                "INSERT OR IGNORE INTO session_counts (user_id, invoice, kind, count) "
+                "SELECT sessions.user_id, invoice_counts.invoice, invoice_counts.kind, invoice_counts.count "
+                "FROM invoice_counts JOIN sessions ON sessions.invoice = invoice_counts.invoice"
+            )
+            conn.execute("DROP TABLE invoice_counts")
+        logger.info("💾 Счетчики накладных перенесены в session_counts")
+
+    def load(self) -> None:
+        """Загружает сохраненное состояние в память"""
+        conn = self.conn
+        index, workers = self.shard
+        for user_id, invoice, last_activity in conn.execute(
+            "SELECT user_id, invoice, last_activity FROM sessions WHERE user_id % ? = ?", (workers, index)
+        ):
+            if invoice is not None:
+                self._invoices[user_id] = invoice
+            if last_activity is not None:
+                self._activity[user_id] = datetime.fromtimestamp(last_activity)
+        for user_id, invoice, kind, count in conn.execute(
+            "SELECT user_id, invoice, kind, count FROM session_counts WHERE user_id % ? = ?", (workers, index)
+        ):
+            self._counts.setdefault((user_id, invoice), {k: 0 for k in KINDS})[kind] = count
+        for key, value in conn.execute("SELECT key, value FROM stats"):
+            self._stats[key] = value
+        logger.info(
+            f"💾 Состояние загружено из {self.path}: накладных {len(self._invoices)}, "
+            f"пользователей {len(self._activity)}"
+        )
+
+    def _user_changed(self, user_id: int) -> None:
+        self._dirty_users.add(user_id)
+
+    def _counts_changed(self, key: Tuple[int, str]) -> None:
+        self._dirty_counts.add(key)
+
+    def _stat_changed(self, key: str, value: int) -> None:
+        self._stat_deltas[key] += value
+
+    @property
+    def dirty(self) -> int:
+        """Сколько изменений ждет записи"""
+        return len(self._dirty_users) + len(self._dirty_counts) + len(self._stat_deltas)
+
+    def _take_batch(self) -> tuple:
+        """Снимок изменений для записи; собирается в цикле событий, пока состояние не меняется"""
+        sessions = []
+        for user_id in self._dirty_users:
+            invoice = self._invoices.get(user_id)
+            activity = self._activity.get(user_id)
+            sessions.append((user_id, invoice, activity.timestamp() if activity else None))
+        counts = [(key, dict(self._counts[key]) if key in self._counts else None)
+                  for key in self._dirty_counts]
+        stats = list(self._stat_deltas.items())
+        self._dirty_users = set()
+        self._dirty_counts = set()
+        self._stat_deltas = Counter()
+        return sessions, counts, stats
+
+    def _restore_batch(self, batch: tuple) -> None:
+        """Возвращает неудавшуюся запись в очередь изменений"""
+        sessions, counts, stats = batch
+        self._dirty_users.update(user_id for user_id, _, _ in sessions)
+        self._dirty_counts.update(key for key, _ in counts)
+        for key, value in stats:
+            self._stat_deltas[key] += value
+
+    def _write_batch(self, batch: tuple) -> Dict[str, int]:
+        sessions, counts, stats = batch
+        conn = self.conn
+        with conn:
+            conn.execute("BEGIN")
+            for user_id, invoice, last_activity in sessions:
+                if invoice is None and last_activity is None:
+                    conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                else:
+                    conn.execute(
+                        "INSERT INTO sessions (user_id, invoice, last_activity) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET invoice = excluded.invoice, "
+                        "last_activity = excluded.last_activity",
+                        (user_id, invoice, last_activity)
+                    )
+            for (user_id, invoice), session_counts in counts:
+                conn.execute("DELETE FROM session_counts WHERE user_id = ? AND invoice = ?", (user_id, invoice))
+                if session_counts is not None:
+                    conn.executemany(
+                        "INSERT INTO session_counts (user_id, invoice, kind, count) VALUES (?, ?, ?, ?)",
+                        [(user_id, invoice, kind, count) for kind, count in session_counts.items()]
+                    )
+            conn.executemany(
+                "INSERT INTO stats (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                stats
+            )
+        # Итоги статистики с учетом приращений других процессов
+        return dict(conn.execute("SELECT key, value FROM stats").fetchall())
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            started = time.monotonic()
+            batch = self._take_batch()
+            try:
+                totals = await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                self._restore_batch(batch)
+                logger.error(f"❌ Не удалось сохранить состояние: {e}")
+                return
+            # Приращения, накопленные во время записи, еще не в файле
+            self._stats = Counter(totals)
+            self._stats.update(self._stat_deltas)
+            logger.debug(
+                f"💾 Состояние сохранено: сессий {len(batch[0])}, накладных {len(batch[1])}, "
+                f"за {time.monotonic() - started:.3f}с"
+            )
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self) -> None:
+        self.load()
+        self._flusher = asyncio.create_task(self._flush_loop(), name="state-flush")
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def create_state_store(backend: str = STATE_BACKEND) -> MemoryStateStore:
+    """Хранилище состояния по настройке STATE_BACKEND: 'memory' или 'sqlite'"""
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        return SQLiteStateStore()
+    raise ValueError(f"Неизвестное хранилище состояния: {backend}")
@@ -0,0 +1,272 @@
+"""
+Асинхронный слой доступа к Яндекс.Диску
+"""
+
+import asyncio
+import functools
+import io
+import logging
+import posixpath
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+import yadisk
+
+import metrics
+import tracing
+from cache import TTLCache
+from resilience import CircuitBreaker, RetryPolicy, classify
+from config import (
+    YANDEX_MAX_CONNECTIONS, YANDEX_MAX_KEEPALIVE_CONNECTIONS, YANDEX_KEEPALIVE_EXPIRY,
+    YANDEX_EXECUTOR_WORKERS, FOLDER_CACHE_SIZE, FOLDER_CACHE_TTL, WRITE_CHECK_TTL
+)
+
+try:
+    import httpx
+    from yadisk.sessions.async_httpx_session import AsyncHTTPXSession
+except ImportError:
+    httpx = None
+    AsyncHTTPXSession = None
+
+logger = logging.getLogger(__name__)
+
+# Повтор этих запросов безопасен: они ничего не меняют или приводят к тому же результату.
+# Загрузки, копирования и удаления не повторяются здесь — их повторяет очередь задач
+IDEMPOTENT_METHODS = frozenset({"exists", "get_meta", "get_disk_info", "mkdir"})
+
+
+class YandexStorage:
+    """
+    Клиент Яндекс.Диска для async-кода бота.
+
+    Основной режим — yadisk.AsyncClient поверх httpx с пулом keep-alive соединений.
+    Если асинхронный клиент недоступен (или передан синхронный клиент),
+    вызовы синхронного yadisk.Client выполняются в ограниченном пуле потоков,
+    чтобы не блокировать цикл событий.
+
+    Все вызовы проходят через выключатель (breaker): после серии сетевых ошибок
+    и 5xx запросы сразу завершаются CircuitOpenError. Идемпотентные запросы
+    повторяются с экспоненциальной задержкой (retry).
+    """
+
+    def __init__(self, token: str, *, sync_client: Any = None,
+                 max_connections: int = YANDEX_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = YANDEX_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = YANDEX_KEEPALIVE_EXPIRY,
+                 executor_workers: int = YANDEX_EXECUTOR_WORKERS,
+                 breaker: Optional[CircuitBreaker] = None,
+                 retry: Optional[RetryPolicy] = None):
+        self.token = token
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.executor_workers = executor_workers
+
+        self._sync_client = sync_client
+        self._use_async = sync_client is None and AsyncHTTPXSession is not None
+        self._async_client: Optional[yadisk.AsyncClient] = None
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.breaker = breaker or CircuitBreaker("yandex_disk")
+        self.retry = retry or RetryPolicy()
+
+        # Папки, которые точно существуют на диске
+        self.folders = TTLCache("folders", FOLDER_CACHE_SIZE, FOLDER_CACHE_TTL)
+        # Папки, запись в которые проверена
+        self.writable = TTLCache("writable", FOLDER_CACHE_SIZE, WRITE_CHECK_TTL)
+
+    @property
+    def mode(self) -> str:
+        """Режим работы клиента: 'async' или 'executor'."""
+        return "async" if self._use_async else "executor"
+
+    def _get_async_client(self) -> yadisk.AsyncClient:
+        # httpx-пул привязан к циклу событий, поэтому клиент создается в том цикле, где используется
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+            session = AsyncHTTPXSession(limits=limits)
+            self._async_client = yadisk.AsyncClient(token=self.token, session=session)
+            # Повторы выполняет _call, с учетом выключателя
+            self._async_client.default_args["n_retries"] = 0
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _get_sync_client(self):
+        if self._sync_client is None:
+            self._sync_client = yadisk.Client(token=self.token)
+            self._sync_client.default_args["n_retries"] = 0
+        return self._sync_client
+
+    async def _call(self, method: str, *args, expected: tuple = (), **kwargs) -> Any:
+        """
+        Единая точка вызова методов yadisk: выключатель, повторы, учет ошибок.
+        Исключения из expected — ожидаемый ответ (например, папка уже есть): они
+        пробрасываются, но учитываются как успешный запрос, а не как ошибка.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            started = time.perf_counter()
+            try:
+                with tracing.span(f"yandex.{method}", attempt=attempt):
+                    result = await self._invoke(method, *args, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except expected:
+                metrics.observe("yandex_request_seconds", time.perf_counter() - started, method=method)
+                self.breaker.record_success()
+                raise
+            except Exception as e:
+                metrics.observe("yandex_request_seconds", time.perf_counter() - started, method=method)
+                category = classify(e)
+                self.breaker.record_failure(category)
+                metrics.inc("yandex_errors_total", method=method, category=category.value)
+                if (method not in IDEMPOTENT_METHODS or self.breaker.is_open
+                        or not self.retry.should_retry(attempt, category)):
+                    raise
+                delay = self.retry.delay(attempt)
+                metrics.inc("yandex_retries_total", method=method)
+                logger.warning(f"🔁 {method}: {category.value} ({e}), повтор {attempt} через {delay:.1f}с")
+                await asyncio.sleep(delay)
+                continue
+            metrics.observe("yandex_request_seconds", time.perf_counter() - started, method=method)
+            self.breaker.record_success()
+            return result
+
+    async def _invoke(self, method: str, *args, **kwargs) -> Any:
+        if self._use_async:
+            client = self._get_async_client()
+            return await getattr(client, method)(*args, **kwargs)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.executor_workers,
+                thread_name_prefix="yadisk"
+            )
+        client = self._get_sync_client()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(getattr(client, method), *args, **kwargs)
+        )
+
+    async def exists(self, path: str) -> bool:
+        return await self._call("exists", path)
+
+    async def get_meta(self, path: str):
+        """Метаданные ресурса (md5, modified, size); PathNotFoundError, если его нет"""
+        return await self._call("get_meta", path)
+
+    async def mkdir(self, path: str):
+        return await self._call("mkdir", path)
+
+    async def ensure_folder(self, path: str) -> bool:
+        """
+        Гарантирует существование папки.
+        Возвращает True, если папка была создана этим вызовом.
+        """
+        if path in self.folders:
+            return False
+        try:
+            await self._call("mkdir", path, expected=(yadisk.exceptions.PathExistsError,))
+            created = True
+        except yadisk.exceptions.PathExistsError:
+            created = False
+        self.folders.set(path)
+        return created
+
+    async def check_writable(self, folder_path: str) -> None:
+        """
+        Проверяет запись в папку тестовым файлом.
+        Успешная проверка кэшируется на WRITE_CHECK_TTL; при ошибке выбрасывает исключение.
+        """
+        if folder_path in self.writable:
+            return
+        test_file_path = f"{folder_path}/.test_write"
+        await self.write_bytes(test_file_path, b"test")
+        await self.remove(test_file_path)
+        self.writable.set(folder_path)
+
+    def forget_folder(self, folder_path: str) -> None:
+        """Убирает папку из кэшей существования и записи"""
+        self.folders.discard(folder_path)
+        self.writable.discard(folder_path)
+
+    async def remove(self, path: str, permanently: bool = False):
+        return await self._call("remove", path, permanently=permanently)
+
+    async def copy(self, src_path: str, dst_path: str, overwrite: bool = False):
+        """Копирование на стороне Яндекс.Диска, без передачи содержимого"""
+        return await self._call("copy", src_path, dst_path, overwrite=overwrite)
+
+    async def list_page(self, path: str, limit: int, offset: int = 0) -> list:
+        """
+        Одна страница содержимого папки (ресурсы с name, path, size, md5, sha256).
+        PathNotFoundError, если папки нет.
+        """
+        meta = await self._call("get_meta", path, limit=limit, offset=offset)
+        embedded = getattr(meta, "embedded", None)
+        return list(embedded.items or []) if embedded is not None else []
+
+    async def upload(self, src, dst_path: str, overwrite: bool = True):
+        try:
+            if isinstance(src, str) and self._use_async:
+                # Без aiofiles AsyncClient не может закрыть файл, который открыл сам
+                with open(src, "rb") as f:
+                    return await self._call("upload", f, dst_path, overwrite=overwrite)
+            return await self._call("upload", src, dst_path, overwrite=overwrite)
+        except Exception:
+            # Реальная ошибка загрузки отменяет закэшированную проверку записи
+            self.writable.discard(posixpath.dirname(dst_path))
+            raise
+
+    async def download(self, src_path: str, dst):
+        if isinstance(dst, str) and self._use_async:
+            with open(dst, "wb") as f:
+                return await self._call("download", src_path, f)
+        return await self._call("download", src_path, dst)
+
+    # Небольшие файлы (списки, служебные файлы) — через буферы в памяти, без временных файлов
+
+    async def read_bytes(self, path: str) -> bytes:
+        buffer = io.BytesIO()
+        await self.download(path, buffer)
+        data = buffer.getvalue()
+        metrics.inc("small_object_ops_total", op="read")
+        metrics.inc("small_object_bytes_total", len(data), op="read")
+        return data
+
+    async def write_bytes(self, path: str, data: bytes, overwrite: bool = True) -> None:
+        await self.upload(io.BytesIO(data), path, overwrite=overwrite)
+        metrics.inc("small_object_ops_total", op="write")
+        metrics.inc("small_object_bytes_total", len(data), op="write")
+
+    async def read_text(self, path: str, encoding: str = "utf-8") -> str:
+        return (await self.read_bytes(path)).decode(encoding)
+
+    async def write_text(self, path: str, text: str, encoding: str = "utf-8", overwrite: bool = True) -> None:
+        await self.write_bytes(path, text.encode(encoding), overwrite=overwrite)
+
+    async def get_disk_info(self):
+        return await self._call("get_disk_info")
+
+    async def close(self) -> None:
+        """Закрывает соединения и пул потоков."""
+        if self._async_client is not None:
+            try:
+                await self._async_client.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось закрыть клиент Яндекс.Диска: {e}")
+            self._async_client = None
+            self._async_client_loop = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,99 @@
+"""
+Истечение сессий пользователей по таймауту бездействия
+"""
+
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import metrics
+from config import INACTIVITY_TIMEOUT_SECONDS, SESSION_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class SessionSweeper:
+    """
+    Сроки бездействия пользователей в min-куче.
+
+    touch() кладет в кучу новый срок, старые записи пользователя остаются
+    в куче и отбрасываются при извлечении (ленивое удаление). Проверка по
+    таймеру JobQueue достает из кучи только наступившие сроки, поэтому работа
+    за тик пропорциональна числу истекающих записей, а не числу пользователей.
+    Куча пересобирается, если устаревших записей становится больше, чем актуальных.
+    """
+
+    def __init__(self, on_expire: Callable[[int, object], Awaitable[None]],
+                 timeout: float = INACTIVITY_TIMEOUT_SECONDS,
+                 interval: float = SESSION_SWEEP_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        self._on_expire = on_expire
+        self.timeout = timeout
+        self.interval = interval
+        self._clock = clock
+        self._heap: List[tuple] = []
+        self._deadlines: Dict[int, float] = {}
+        metrics.register_gauge("session_sweeper_tracked", lambda: len(self._deadlines))
+        metrics.register_gauge("session_sweeper_heap_size", lambda: len(self._heap))
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def touch(self, user_id: int, at: Optional[float] = None) -> None:
+        """Переносит срок пользователя на timeout от момента активности"""
+        deadline = (at if at is not None else self._clock()) + self.timeout
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def discard(self, user_id: int) -> None:
+        """Больше не отслеживать пользователя (запись в куче удалится лениво)"""
+        self._deadlines.pop(user_id, None)
+
+    def load(self, activity: Dict[int, float]) -> None:
+        """Заполняет кучу после перезапуска: {user_id: время последней активности}"""
+        self._deadlines = {user_id: at + self.timeout for user_id, at in activity.items()}
+        self._compact()
+
+    def _compact(self) -> None:
+        self._heap = [(deadline, user_id) for user_id, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def pop_expired(self, now: Optional[float] = None) -> List[int]:
+        """Извлекает пользователей, чей срок наступил"""
+        now = now if now is not None else self._clock()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._heap)
+            # Пользователь был активен позже или уже не отслеживается
+            if self._deadlines.get(user_id) != deadline:
+                continue
+            del self._deadlines[user_id]
+            expired.append(user_id)
+        return expired
+
+    async def sweep(self, context) -> None:
+        """Тик JobQueue: истекает наступившие сессии"""
+        started = time.monotonic()
+        expired = self.pop_expired()
+        for user_id in expired:
+            try:
+                await self._on_expire(user_id, context.bot)
+            except Exception as e:
+                logger.error(f"❌ Ошибка при истечении сессии пользователя {user_id}: {e}")
+        if expired:
+            metrics.inc("sessions_expired_total", len(expired))
+            logger.info(f"⏳ Истекло сессий: {len(expired)} за {time.monotonic() - started:.3f}с")
+
+    def start(self, job_queue) -> None:
+        """Запускает периодическую проверку в JobQueue приложения"""
+        if job_queue is None:
+            logger.warning(
+                "⚠️ JobQueue недоступна (нужен python-telegram-bot[job-queue]), "
+                "сессии истекают только при следующем сообщении пользователя"
+            )
+            return
+        job_queue.run_repeating(self.sweep, interval=self.interval, first=self.interval, name="session-sweeper")
+        logger.info(f"⏳ Проверка истечения сессий каждые {self.interval:.0f}с, отслеживается: {len(self)}")
@@ -0,0 +1,168 @@
+"""
+Трассировка обработки обновлений и загрузок: этапы (span) с длительностями в JSON-логе
+"""
+
+import contextvars
+import heapq
+import json
+import logging
+import random
+import secrets
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterator, Optional
+
+import metrics
+from config import TRACE_SAMPLE_RATE, TRACE_LOG_MIN_DURATION, TRACE_SLOWEST_SIZE
+
+# Отдельный логгер, чтобы трассы можно было направить в свой обработчик
+trace_logger = logging.getLogger("trace")
+
+
+class Trace:
+    """Одна трасса: обработка обновления или выполнение задачи загрузки"""
+
+    __slots__ = ("trace_id", "kind", "attrs", "started", "spans")
+
+    def __init__(self, trace_id: str, kind: str, attrs: dict):
+        self.trace_id = trace_id
+        self.kind = kind
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans: list = []
+
+    def to_dict(self, duration: float, error: Optional[str]) -> dict:
+        record = {
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "duration_ms": round(duration * 1000, 1),
+            **self.attrs,
+            "spans": self.spans,
+        }
+        if error:
+            record["error"] = error
+        return record
+
+
+class SlowStages:
+    """Статистика этапов из трасс и самые медленные из них (для /slow)"""
+
+    def __init__(self, size: int = TRACE_SLOWEST_SIZE):
+        self.size = size
+        self.stages: dict = {}  # имя -> [количество, сумма, максимум]
+        self._slowest: list = []  # куча (длительность, имя, trace_id, время)
+
+    def add(self, name: str, duration: float, trace_id: str) -> None:
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        item = (duration, name, trace_id, time.time())
+        if len(self._slowest) < self.size:
+            heapq.heappush(self._slowest, item)
+        elif duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def top_stages(self, limit: int = 10) -> list:
+        """(имя, количество, среднее, максимум) по убыванию суммарного времени"""
+        ranked = sorted(self.stages.items(), key=lambda kv: kv[1][1], reverse=True)
+        return [(name, count, total / count, peak) for name, (count, total, peak) in ranked[:limit]]
+
+    def slowest(self) -> list:
+        """(длительность, имя, trace_id, время) от самого медленного"""
+        return sorted(self._slowest, reverse=True)
+
+    def clear(self) -> None:
+        self.stages.clear()
+        self._slowest.clear()
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+slow_stages = SlowStages()
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(8)
+
+
+def current_trace_id() -> str:
+    """Идентификатор трассы текущей задачи ('' — вне выборки)"""
+    trace = _current.get()
+    return trace.trace_id if trace is not None else ""
+
+
+@contextmanager
+def trace(kind: str, trace_id: Optional[str] = None, sample_rate: float = TRACE_SAMPLE_RATE,
+          **attrs) -> Iterator[Optional[Trace]]:
+    """
+    Открывает трассу для текущей задачи asyncio.
+    Без trace_id решение о записи принимается по sample_rate; переданный trace_id
+    (продолжение трассы обновления в воркере загрузки) записывается всегда.
+    """
+    if trace_id is None and (sample_rate <= 0 or random.random() >= sample_rate):
+        # Задача могла унаследовать чужую трассу вместе с контекстом — отключаем ее
+        token = _current.set(None)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+    current = Trace(trace_id or new_trace_id(), kind, attrs)
+    token = _current.set(current)
+    error = None
+    try:
+        yield current
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        duration = time.perf_counter() - current.started
+        metrics.inc("traces_total", kind=kind)
+        if duration >= TRACE_LOG_MIN_DURATION:
+            trace_logger.info(json.dumps(current.to_dict(duration, error), ensure_ascii=False, default=str))
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "started")
+
+    def __init__(self, trace: Trace, name: str, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        duration = time.perf_counter() - self.started
+        record = {
+            "name": self.name,
+            "start_ms": round((self.started - self.trace.started) * 1000, 1),
+            "duration_ms": round(duration * 1000, 1),
+            **self.attrs,
+        }
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.trace.spans.append(record)
+        slow_stages.add(self.name, duration, self.trace.trace_id)
+
+
+_NO_SPAN = nullcontext()
+
+
+def span(name: str, **attrs):
+    """Этап внутри трассы; вне выборки — общий пустой контекстный менеджер"""
+    current = _current.get()
+    if current is None:
+        return _NO_SPAN
+    return _Span(current, name, attrs)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Этап обработки файла: всегда в метриках pipeline_stage_*, в трассе — если она записывается"""
+    with metrics.stage(name), span(name):
+        yield
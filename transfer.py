@@ -0,0 +1,397 @@
+"""
+Перенос медиафайлов из Telegram на Яндекс.Диск
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+from urllib import parse as urllib_parse
+
+import httpx
+
+import metrics
+import tracing
+from config import (
+    STREAMING_ENABLED, STREAM_CHUNK_SIZE, STREAM_BUFFER_CHUNKS, DEDUP_BUFFER_MAX,
+    RESUMABLE_MIN_SIZE, SPOOL_DIR
+)
+from resilience import ErrorCategory, classify
+
+logger = logging.getLogger(__name__)
+
+
+def _fallback_useless(error: Exception) -> bool:
+    """Повтор через временный файл ничего не даст: ошибка постоянная или диск недоступен"""
+    category = classify(error)
+    return category.permanent or category is ErrorCategory.UNAVAILABLE
+
+
+class DownloadError(Exception):
+    """Не удалось получить файл из Telegram"""
+
+
+# Проверка дубликата: (md5, размер, файл уже загружен) -> путь файла с тем же содержимым или None
+DuplicateCheck = Callable[[str, int, bool], Awaitable[Optional[str]]]
+
+# Ход передачи: (этап "download" или "upload", передано байт, всего байт).
+# Может вызываться из потока синхронного клиента, поэтому должен быть быстрым и потокобезопасным
+Progress = Callable[[str, int, int], None]
+
+
+@dataclass
+class TransferResult:
+    size: int
+    md5: str
+    # Файл не загружался (или загруженная копия удалена): то же содержимое уже лежит по этому пути
+    duplicate_of: Optional[str] = None
+
+
+def file_md5(path: str, chunk_size: int = STREAM_CHUNK_SIZE) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProgressReader:
+    """Файл для загрузки, который сообщает, сколько байт из него прочитано"""
+
+    def __init__(self, f, total: int, progress: Progress):
+        self._f = f
+        self._total = total
+        self._progress = progress
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._position += len(data)
+        self._progress("upload", self._position, self._total)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # yadisk перематывает файл в начало перед каждой попыткой
+        self._position = self._f.seek(offset, whence)
+        return self._position
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    def seekable(self) -> bool:
+        return True
+
+
+def _is_remote(file_path: Optional[str]) -> bool:
+    return bool(file_path) and file_path.startswith(("http://", "https://"))
+
+
+def _encoded_url(file_path: str) -> str:
+    """URL файла с экранированными не-ASCII символами в пути"""
+    parts = urllib_parse.urlsplit(file_path)
+    return urllib_parse.urlunsplit(parts._replace(path=urllib_parse.quote(parts.path)))
+
+
+class MediaTransfer:
+    """
+    Переносит файл из Telegram на Яндекс.Диск.
+
+    Потоковый режим: чанки скачивания из Telegram через ограниченную очередь
+    сразу уходят в PUT загрузки на Яндекс.Диск, скачивание и загрузка идут параллельно,
+    в памяти не больше buffer_chunks чанков, диск не используется.
+    Если поток недоступен или оборвался, файл переносится через временный файл.
+
+    По пути считается md5 содержимого. Если передана проверка дубликатов, небольшие
+    файлы (до buffer_max) сначала скачиваются в память и не загружаются, когда такое
+    содержимое уже есть; временный файл проверяется перед загрузкой. Файлы, идущие
+    потоком, проверяются только после загрузки — тогда новая копия удаляется.
+
+    Большие файлы (от resumable_min_size, по умолчанию меньше предела getFile публичного
+    Bot API в 20MB) скачиваются в spool-файл запросами Range:
+    уже полученная часть файла — это контрольная точка, и повтор задачи после обрыва
+    продолжает скачивание с нее, а не с начала. Загрузка на Яндекс.Диск идет из
+    spool-файла; API Яндекс.Диска не умеет продолжать PUT, поэтому при ее обрыве
+    повтор загружает файл заново, но уже без повторного скачивания из Telegram.
+    spool-файл удаляется после успешной загрузки или discard_spool().
+    """
+
+    def __init__(self, storage, *, streaming: bool = STREAMING_ENABLED,
+                 chunk_size: int = STREAM_CHUNK_SIZE, buffer_chunks: int = STREAM_BUFFER_CHUNKS,
+                 buffer_max: int = DEDUP_BUFFER_MAX, resumable_min_size: int = RESUMABLE_MIN_SIZE,
+                 spool_dir: str = SPOOL_DIR):
+        self.storage = storage
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.buffer_chunks = buffer_chunks
+        self.buffer_max = buffer_max
+        self.resumable_min_size = resumable_min_size
+        self.spool_dir = spool_dir
+        self._http: Optional[httpx.AsyncClient] = None
+        self._http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_http(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http_loop is not loop:
+            self._http = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0))
+            self._http_loop = loop
+        return self._http
+
+    def can_stream(self, tg_file) -> bool:
+        # Синхронному клиенту нельзя передать асинхронный поток,
+        # а локальный Bot API сервер отдает путь к файлу, а не URL
+        return self.streaming and self.storage.mode == "async" and _is_remote(tg_file.file_path)
+
+    def is_resumable(self, tg_file) -> bool:
+        return (
+            self.resumable_min_size > 0
+            and (tg_file.file_size or 0) >= self.resumable_min_size
+            and _is_remote(tg_file.file_path)
+        )
+
+    def spool_path(self, file_key: str) -> str:
+        """spool-файл задачи"""
+        return os.path.join(self.spool_dir, f"{file_key}.part")
+
+    def discard_spool(self, file_key: str) -> None:
+        """Удаляет spool-файл задачи, которая больше не будет повторяться"""
+        try:
+            os.remove(self.spool_path(file_key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить spool-файл {file_key}: {e}")
+
+    def cleanup_spool(self, max_age: float) -> int:
+        """Удаляет заброшенные spool-файлы старше max_age секунд"""
+        if not os.path.isdir(self.spool_dir):
+            return 0
+        removed = 0
+        deadline = time.time() - max_age
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить spool-файл {name}: {e}")
+        return removed
+
+    async def transfer(self, tg_file, dst_path: str, temp_path: str,
+                       check_duplicate: Optional[DuplicateCheck] = None,
+                       progress: Optional[Progress] = None, spool_key: Optional[str] = None) -> TransferResult:
+        """
+        Переносит файл Telegram в dst_path на Яндекс.Диске.
+        Возвращает размер и md5 файла; duplicate_of заполнен, если файл оказался дубликатом.
+        progress получает ход передачи больших файлов; spool_key — имя spool-файла,
+        одинаковое для всех попыток задачи (по умолчанию file_unique_id).
+
+        Выбрасывает DownloadError при ошибке на стороне Telegram
+        и yadisk.exceptions.YaDiskError при ошибке Яндекс.Диска.
+        """
+        if self.is_resumable(tg_file):
+            # Без запасного пути: повтор задачи продолжит с сохраненной части
+            key = spool_key or tg_file.file_unique_id or tg_file.file_id
+            return await self._spooled(tg_file, dst_path, key, check_duplicate, progress)
+        if self.can_stream(tg_file):
+            try:
+                if check_duplicate is not None and 0 < (tg_file.file_size or 0) <= self.buffer_max:
+                    return await self._buffered(tg_file, dst_path, check_duplicate)
+                return await self._stream(tg_file, dst_path, check_duplicate)
+            except Exception as e:
+                if _fallback_useless(e):
+                    raise
+                metrics.inc("transfer_fallback_total")
+                logger.warning(f"⚠️ Потоковая передача не удалась, используем временный файл: {e}")
+        return await self._via_temp_file(tg_file, dst_path, temp_path, check_duplicate)
+
+    async def _buffered(self, tg_file, dst_path: str, check_duplicate: DuplicateCheck) -> TransferResult:
+        """Скачивает небольшой файл в память, проверяет дубликат и только потом загружает"""
+        buffer = io.BytesIO()
+        digest = hashlib.md5()
+        with tracing.stage("telegram_download"):
+            async with self._get_http().stream("GET", _encoded_url(tg_file.file_path)) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f"Telegram вернул HTTP {response.status_code}")
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    digest.update(chunk)
+                    buffer.write(chunk)
+        size = buffer.tell()
+        if size != tg_file.file_size:
+            raise DownloadError(f"Получено {size} байт из {tg_file.file_size}")
+        md5 = digest.hexdigest()
+
+        duplicate_of = await check_duplicate(md5, size, False)
+        if duplicate_of is not None:
+            return TransferResult(size, md5, duplicate_of)
+
+        buffer.seek(0)
+        with tracing.stage("yandex_upload"):
+            await self.storage.upload(buffer, dst_path, overwrite=True)
+        logger.info(f"📥 Файл передан через память на Яндекс.Диск: {dst_path} ({size} байт)")
+        metrics.inc("transfer_total", mode="buffered")
+        metrics.inc("transfer_bytes_total", size, mode="buffered")
+        return TransferResult(size, md5)
+
+    async def _stream(self, tg_file, dst_path: str, check_duplicate: Optional[DuplicateCheck] = None) -> TransferResult:
+        url = _encoded_url(tg_file.file_path)
+        expected_size = tg_file.file_size
+        transferred = [0, None]
+
+        async def body():
+            # Вызывается заново на каждую попытку загрузки yadisk, поэтому поток повторяем
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.buffer_chunks)
+
+            async def produce():
+                try:
+                    async with self._get_http().stream("GET", url) as response:
+                        if response.status_code != 200:
+                            raise DownloadError(f"Telegram вернул HTTP {response.status_code}")
+                        async for chunk in response.aiter_bytes(self.chunk_size):
+                            await queue.put(chunk)
+                    await queue.put(None)
+                except Exception as e:
+                    await queue.put(e)
+
+            producer = asyncio.create_task(produce())
+            received = 0
+            digest = hashlib.md5()
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    received += len(item)
+                    digest.update(item)
+                    yield item
+                if received == 0 or (expected_size and received != expected_size):
+                    raise DownloadError(f"Получено {received} байт из {expected_size}")
+                transferred[:] = [received, digest.hexdigest()]
+            finally:
+                producer.cancel()
+
+        # Скачивание и загрузка идут одновременно, поэтому это один этап
+        with tracing.stage("stream"):
+            await self.storage.upload(body, dst_path, overwrite=True)
+        logger.info(f"📥 Файл передан потоком на Яндекс.Диск: {dst_path} ({transferred[0]} байт)")
+        metrics.inc("transfer_total", mode="stream")
+        metrics.inc("transfer_bytes_total", transferred[0], mode="stream")
+        size, md5 = transferred
+
+        if check_duplicate is not None:
+            duplicate_of = await check_duplicate(md5, size, True)
+            if duplicate_of is not None and duplicate_of != dst_path:
+                await self.storage.remove(dst_path, permanently=True)
+                logger.info(f"♻️ Загруженный файл оказался дубликатом {duplicate_of}, копия удалена: {dst_path}")
+                return TransferResult(size, md5, duplicate_of)
+        return TransferResult(size, md5)
+
+    async def _download_resumable(self, url: str, spool_path: str, expected_size: int,
+                                  progress: Optional[Progress]) -> None:
+        """Докачивает файл в spool_path, начиная с уже сохраненной части"""
+        offset = os.path.getsize(spool_path) if os.path.exists(spool_path) else 0
+        if offset > expected_size:
+            offset = 0
+        if offset == expected_size:
+            return
+        if offset:
+            metrics.inc("transfer_resumed_total")
+            metrics.inc("transfer_resumed_bytes_total", offset)
+            logger.info(f"⏯️ Продолжаем скачивание с {offset} из {expected_size} байт: {spool_path}")
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        async with self._get_http().stream("GET", url, headers=headers) as response:
+            if response.status_code == 200:
+                # Сервер не поддержал Range — начинаем с начала
+                offset = 0
+            elif response.status_code != 206:
+                raise DownloadError(f"Telegram вернул HTTP {response.status_code}")
+            with open(spool_path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                received = offset
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress("download", received, expected_size)
+        if received != expected_size:
+            raise DownloadError(f"Получено {received} байт из {expected_size}")
+
+    async def _spooled(self, tg_file, dst_path: str, spool_key: str,
+                       check_duplicate: Optional[DuplicateCheck], progress: Optional[Progress]) -> TransferResult:
+        os.makedirs(self.spool_dir, exist_ok=True)
+        spool_path = self.spool_path(spool_key)
+        size = tg_file.file_size
+        try:
+            with tracing.stage("telegram_download"):
+                await self._download_resumable(_encoded_url(tg_file.file_path), spool_path, size, progress)
+        except DownloadError:
+            raise
+        except (httpx.HTTPError, OSError) as e:
+            raise DownloadError(str(e)) from e
+
+        md5 = await asyncio.to_thread(file_md5, spool_path, self.chunk_size)
+        if check_duplicate is not None:
+            duplicate_of = await check_duplicate(md5, size, False)
+            if duplicate_of is not None:
+                self.discard_spool(spool_key)
+                return TransferResult(size, md5, duplicate_of)
+
+        with open(spool_path, "rb") as f:
+            src = ProgressReader(f, size, progress) if progress is not None else f
+            with tracing.stage("yandex_upload"):
+                await self.storage.upload(src, dst_path, overwrite=True)
+        self.discard_spool(spool_key)
+        logger.info(f"📥 Файл передан через spool-файл на Яндекс.Диск: {dst_path} ({size} байт)")
+        metrics.inc("transfer_total", mode="spool")
+        metrics.inc("transfer_bytes_total", size, mode="spool")
+        return TransferResult(size, md5)
+
+    async def _via_temp_file(self, tg_file, dst_path: str, temp_path: str,
+                             check_duplicate: Optional[DuplicateCheck] = None) -> TransferResult:
+        try:
+            try:
+                with tracing.stage("telegram_download"):
+                    await tg_file.download_to_drive(temp_path)
+            except Exception as e:
+                raise DownloadError(str(e)) from e
+            logger.info(f"📥 Файл загружен во временную папку: {temp_path}")
+
+            # Проверяем, что файл действительно загрузился
+            if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
+                raise DownloadError("Файл не был загружен или имеет нулевой размер")
+            size = os.path.getsize(temp_path)
+            md5 = await asyncio.to_thread(file_md5, temp_path, self.chunk_size)
+
+            if check_duplicate is not None:
+                duplicate_of = await check_duplicate(md5, size, False)
+                if duplicate_of is not None:
+                    return TransferResult(size, md5, duplicate_of)
+
+            with tracing.stage("yandex_upload"):
+                await self.storage.upload(temp_path, dst_path, overwrite=True)
+            metrics.inc("transfer_total", mode="temp_file")
+            metrics.inc("transfer_bytes_total", size, mode="temp_file")
+            return TransferResult(size, md5)
+        finally:
+            # Удаляем локальный файл
+            try:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                    logger.info(f"🗑️ Временный файл удален: {temp_path}")
+            except Exception as e:
+                logger.warning(f"Не удалось удалить временный файл {temp_path}: {e}")
+                # Пытаемся удалить позже через cleanup
+
+    async def close(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._http_loop = None
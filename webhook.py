@@ -0,0 +1,81 @@
+"""
+Сервер метрик в формате Prometheus для режима одного процесса
+"""
+
+import hmac
+import logging
+import re
+from typing import Optional
+
+import tornado.httpserver
+import tornado.web
+
+import metrics
+from config import METRICS_PATH, METRICS_PORT, METRICS_TOKEN
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics — все метрики бота в текстовом формате Prometheus"""
+
+    def initialize(self, token: str) -> None:
+        self.token = token
+
+    def _authorized(self) -> bool:
+        if not self.token:
+            return True
+        header = self.request.headers.get("Authorization", "")
+        return hmac.compare_digest(header.encode(), f"Bearer {self.token}".encode())
+
+    async def collect(self) -> str:
+        return metrics.render_prometheus()
+
+    async def get(self) -> None:
+        if not self._authorized():
+            self.set_status(401)
+            return
+        metrics.inc("metrics_scrapes_total")
+        self.set_header("Content-Type", metrics.PROMETHEUS_CONTENT_TYPE)
+        self.write(await self.collect())
+
+
+class MetricsServer:
+    """
+    Отдельный HTTP-сервер метрик на порту METRICS_PORT.
+    Webhook принимает сервер python-telegram-bot, в его приложение маршрут не добавляется,
+    поэтому метрики не зависят от внутреннего устройства библиотеки.
+    """
+
+    def __init__(self, port: int = METRICS_PORT, path: str = METRICS_PATH, token: str = METRICS_TOKEN,
+                 listen: str = "0.0.0.0"):
+        self.port = port
+        self.path = path
+        self.token = token
+        self.listen = listen
+        self._server: Optional[tornado.httpserver.HTTPServer] = None
+
+    def start(self) -> bool:
+        """
+        Открывает порт в текущем цикле событий.
+        Возвращает False, если метрики отключены или порт занят — бот при этом работает дальше.
+        """
+        if not self.path or not self.port:
+            return False
+        app = tornado.web.Application([(re.escape(self.path), MetricsHandler, {"token": self.token})])
+        server = tornado.httpserver.HTTPServer(app)
+        try:
+            server.listen(self.port, address=self.listen)
+        except OSError as e:
+            logger.error(f"❌ Не удалось открыть порт метрик {self.port}: {e}")
+            return False
+        self._server = server
+        logger.info(f"📈 Метрики Prometheus: порт {self.port}, {self.path}{' (с токеном)' if self.token else ''}")
+        return True
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.stop()
+        await self._server.close_all_connections()
+        self._server = None
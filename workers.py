@@ -0,0 +1,339 @@
+"""
+Несколько процессов-обработчиков за одним портом webhook.
+
+Диспетчер принимает обновления от Telegram и по номеру пользователя передает каждое
+в свой процесс-обработчик (user_id % WEBHOOK_WORKERS): обновления одного пользователя
+всегда обрабатываются одним процессом и по порядку. Обработчики — обычное приложение
+из build_application(), только обновления приходят не по HTTP, а по unix-сокету от диспетчера.
+Состояние, очередь загрузок и индекс дубликатов — общие файлы SQLite.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import tornado.httpserver
+import tornado.web
+from telegram import Bot
+
+import metrics
+from config import (
+    TELEGRAM_TOKEN, TELEGRAM_BASE_URL, METRICS_PATH, METRICS_TOKEN, STARTUP_READY_TIMEOUT,
+    WORKER_RESTART_DELAY, WORKER_STOP_TIMEOUT
+)
+from webhook import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+# Кадр между диспетчером и обработчиком: тип (1 байт) и длина содержимого
+_FRAME = struct.Struct("!cI")
+FRAME_UPDATE = b"U"  # Обновление Telegram (JSON как пришел от Telegram)
+FRAME_METRICS = b"M"  # Запрос метрик обработчика и ответ на него
+
+# Номер пользователя ищется в теле запроса без разбора JSON: отправитель идет
+# первым полем "from" обновления; для обновлений без него — чат или номер обновления
+_USER_ID = re.compile(rb'"from"\s*:\s*\{\s*"id"\s*:\s*(\d+)')
+_CHAT_ID = re.compile(rb'"chat"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+_UPDATE_ID = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+
+def route_key(body: bytes) -> int:
+    """Ключ маршрутизации обновления: пользователь, иначе чат, иначе само обновление"""
+    for pattern in (_USER_ID, _CHAT_ID, _UPDATE_ID):
+        match = pattern.search(body)
+        if match is not None:
+            return int(match.group(1))
+    return 0
+
+
+def worker_for(key: int, workers: int) -> int:
+    """Номер обработчика для ключа; совпадает с отбором user_id % workers в SQLite"""
+    return key % workers
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple:
+    header = await reader.readexactly(_FRAME.size)
+    kind, size = _FRAME.unpack(header)
+    return kind, await reader.readexactly(size)
+
+
+def write_frame(writer: asyncio.StreamWriter, kind: bytes, payload: bytes) -> None:
+    # Один вызов write на кадр: кадры разных запросов не перемешиваются
+    writer.write(_FRAME.pack(kind, len(payload)) + payload)
+
+
+class WorkerLink:
+    """Процесс-обработчик и соединение диспетчера с ним"""
+
+    def __init__(self, index: int, workers: int, socket_dir: str):
+        self.index = index
+        self.workers = workers
+        self.path = os.path.join(socket_dir, f"worker{index}.sock")
+        self.process: Optional[subprocess.Popen] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = asyncio.Event()
+        self.restarts = 0
+        self._metrics_lock = asyncio.Lock()
+
+    def spawn(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        env = dict(os.environ, WEBHOOK_WORKERS=str(self.workers), WEBHOOK_WORKER_INDEX=str(self.index))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", self.path], env=env
+        )
+        logger.info(f"👷 Обработчик {self.index} запущен (pid {self.process.pid})")
+
+    async def connect(self, timeout: float = STARTUP_READY_TIMEOUT) -> bool:
+        """Подключается к сокету обработчика, пока он запускается"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process is not None and self.process.poll() is not None:
+                return False
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+                continue
+            self.connected.set()
+            return True
+        return False
+
+    def disconnect(self) -> None:
+        self.connected.clear()
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def send(self, body: bytes) -> None:
+        """Передает обновление; ожидание учитывает переполненный буфер сокета"""
+        if not self.connected.is_set():
+            await asyncio.wait_for(self.connected.wait(), STARTUP_READY_TIMEOUT)
+        write_frame(self.writer, FRAME_UPDATE, body)
+        await self.writer.drain()
+
+    async def collect_metrics(self) -> dict:
+        """Метрики обработчика: {семейство: (тип, строки)} с меткой process"""
+        if not self.connected.is_set():
+            return {}
+        async with self._metrics_lock:
+            write_frame(self.writer, FRAME_METRICS, b"")
+            await self.writer.drain()
+            _, payload = await read_frame(self.reader)
+        return json.loads(payload)
+
+
+class DispatchHandler(tornado.web.RequestHandler):
+    """POST от Telegram: обновление уходит обработчику пользователя, ответ — сразу после передачи"""
+
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, dispatcher: "Dispatcher") -> None:
+        self.dispatcher = dispatcher
+
+    async def post(self) -> None:
+        if self.request.headers.get("Content-Type") != "application/json":
+            raise tornado.web.HTTPError(403)
+        body = self.request.body
+        link = self.dispatcher.links[worker_for(route_key(body), len(self.dispatcher.links))]
+        started = time.perf_counter()
+        try:
+            await link.send(body)
+        except Exception as e:
+            # Telegram повторит обновление позже, обработчик к тому времени перезапустится
+            logger.warning(f"⚠️ Обработчик {link.index} не принял обновление: {e}")
+            metrics.inc("dispatcher_errors_total", worker=str(link.index))
+            self.set_status(503)
+            return
+        metrics.inc("dispatcher_updates_total", worker=str(link.index))
+        metrics.observe("dispatcher_send_seconds", time.perf_counter() - started)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb) -> None:
+        if isinstance(value, tornado.web.HTTPError):
+            return
+        super().log_exception(typ, value, tb)
+
+
+class ClusterMetricsHandler(MetricsHandler):
+    """/metrics диспетчера: его метрики и метрики всех обработчиков с меткой process"""
+
+    def initialize(self, token: str, dispatcher: "Dispatcher") -> None:
+        super().initialize(token)
+        self.dispatcher = dispatcher
+
+    async def collect(self) -> str:
+        results = await asyncio.gather(
+            *(link.collect_metrics() for link in self.dispatcher.links), return_exceptions=True
+        )
+        sources = [metrics.collect_families({"process": "dispatcher"})]
+        sources.extend(result for result in results if isinstance(result, dict))
+        return metrics.format_families(*sources)
+
+
+class Dispatcher:
+    """Прием webhook и распределение обновлений между процессами-обработчиками"""
+
+    def __init__(self, workers: int):
+        self.socket_dir = tempfile.mkdtemp(prefix="gidromag-workers-")
+        self.links: List[WorkerLink] = [WorkerLink(index, workers, self.socket_dir) for index in range(workers)]
+        self._stopping = False
+        metrics.register_gauge("dispatcher_workers_alive", lambda: sum(link.connected.is_set() for link in self.links))
+
+    def application(self) -> tornado.web.Application:
+        handlers = [(r"/?", DispatchHandler, {"dispatcher": self})]
+        if METRICS_PATH:
+            handlers.insert(0, (re.escape(METRICS_PATH), ClusterMetricsHandler,
+                                {"token": METRICS_TOKEN, "dispatcher": self}))
+        return tornado.web.Application(handlers)
+
+    async def _supervise(self, link: WorkerLink) -> None:
+        """Держит обработчик запущенным: перезапускает его, если процесс завершился"""
+        while not self._stopping:
+            link.spawn()
+            if not await link.connect():
+                logger.error(f"❌ Обработчик {link.index} не запустился")
+            while not self._stopping and link.process.poll() is None:
+                await asyncio.sleep(0.5)
+            link.disconnect()
+            if self._stopping:
+                return
+            link.restarts += 1
+            metrics.inc("dispatcher_worker_restarts_total", worker=str(link.index))
+            logger.error(
+                f"❌ Обработчик {link.index} завершился с кодом {link.process.returncode}, "
+                f"перезапуск через {WORKER_RESTART_DELAY:.0f}с"
+            )
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def _stop_workers(self) -> None:
+        self._stopping = True
+        for link in self.links:
+            # Закрытый сокет — сигнал обработчику: дообработать очередь и завершиться
+            link.disconnect()
+            if link.process is not None and link.process.poll() is None:
+                link.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for link in self.links:
+            if link.process is None:
+                continue
+            while link.process.poll() is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if link.process.poll() is None:
+                logger.warning(f"⚠️ Обработчик {link.index} не завершился за {WORKER_STOP_TIMEOUT:.0f}с")
+                link.process.kill()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    async def serve(self, listen: str, port: int, webhook_url: str) -> None:
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        supervisors = [asyncio.create_task(self._supervise(link)) for link in self.links]
+        server = tornado.httpserver.HTTPServer(self.application())
+        server.listen(port, address=listen)
+        logger.info(f"🔀 Диспетчер webhook на порту {port}, обработчиков: {len(self.links)}")
+
+        if webhook_url:
+            try:
+                async with Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_BASE_URL) as bot:
+                    await bot.set_webhook(url=webhook_url)
+                logger.info(f"🔗 Webhook установлен: {webhook_url}")
+            except Exception as e:
+                logger.error(f"❌ Не удалось установить webhook: {e}")
+
+        await stop.wait()
+        logger.info("📴 Останавливаем диспетчер и обработчики...")
+        server.stop()
+        await server.close_all_connections()
+        await self._stop_workers()
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+def run_dispatcher(workers: int, listen: str, port: int, webhook_url: str) -> None:
+    """Точка входа режима нескольких обработчиков (вызывается из main())"""
+    asyncio.run(Dispatcher(workers).serve(listen, port, webhook_url))
+
+
+async def _serve_link(app, index: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      stop: asyncio.Event) -> None:
+    """Кадры от диспетчера: обновления в очередь приложения, ответы на запросы метрик"""
+    from telegram import Update
+    from telegram.ext import ExtBot
+
+    try:
+        while True:
+            kind, payload = await read_frame(reader)
+            if kind == FRAME_UPDATE:
+                try:
+                    update = Update.de_json(json.loads(payload), app.bot)
+                except Exception as e:
+                    logger.error(f"❌ Не удалось разобрать обновление от диспетчера: {e}")
+                    continue
+                if isinstance(app.bot, ExtBot):
+                    app.bot.insert_callback_data(update)
+                await app.update_queue.put(update)
+            elif kind == FRAME_METRICS:
+                families = metrics.collect_families({"process": str(index)})
+                write_frame(writer, FRAME_METRICS, json.dumps(families, ensure_ascii=False).encode())
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # Диспетчер закрыл соединение — завершаемся вместе с ним
+        stop.set()
+    finally:
+        writer.close()
+
+
+async def _serve_worker(app, socket_path: str, index: int) -> None:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    if app.post_init is not None:
+        await app.post_init(app)
+    await app.start()
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: _serve_link(app, index, reader, writer, stop), socket_path
+    )
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        # stop() дообрабатывает обновления, уже принятые от диспетчера
+        await app.stop()
+        if app.post_shutdown is not None:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+
+def run_worker(socket_path: str) -> None:
+    """Процесс-обработчик: приложение бота, получающее обновления от диспетчера"""
+    import bot
+
+    index = int(os.environ.get("WEBHOOK_WORKER_INDEX", 0))
+    app = bot.build_application()
+    asyncio.run(_serve_worker(app, socket_path, index))
+    logger.info(f"👷 Обработчик {index} остановлен")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2])
+    else:
+        sys.exit("Использование: python workers.py worker <путь к сокету>")